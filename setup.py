@@ -82,13 +82,20 @@ def params():
 	include_package_data = True
 	zip_safe = False
 	install_requires = open("requirements.txt").read().split("\n")
+	extras_require = {
+		# faster JSON decoding and incremental decoding of large pages
+		"speedups": ["simplejson", "ijson"]
+	}
 
 	entry_points = {
 		"console_scripts": [
 			"gitissuebot = gitissuebot:main",
 			"gitissuebot-approve = gitissuebot.approve:main",
 			"gitissuebot-autolabel = gitissuebot.autolabel:main",
-			"gitissuebot-prcheck = gitissuebot.prcheck:main"
+			"gitissuebot-prcheck = gitissuebot.prcheck:main",
+			"gitissuebot-combined = gitissuebot.combined:main",
+			"gitissuebot-sync = gitissuebot.sync:main",
+			"gitissuebot-benchmark = gitissuebot.benchmark:main"
 		]
 	}
 
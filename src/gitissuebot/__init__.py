@@ -12,6 +12,9 @@ del get_versions
 from .approve import argparser as approve_argparser, main as approve_main
 from .autolabel import argparser as autolabel_argparser, main as autolabel_main
 from .prcheck import argparser as prcheck_argparser, main as prcheck_main
+from .combined import argparser as combined_argparser, main as combined_main
+from .sync import argparser as sync_argparser, main as sync_main
+from .benchmark import argparser as benchmark_argparser, main as benchmark_main
 
 def main():
 	import argparse
@@ -34,6 +37,18 @@ def main():
 	prcheck_argparser(prcheck_parser)
 	prcheck_parser.set_defaults(func=prcheck_main)
 
+	combined_parser = subparsers.add_parser("combined")
+	combined_argparser(combined_parser)
+	combined_parser.set_defaults(func=combined_main)
+
+	sync_parser = subparsers.add_parser("sync")
+	sync_argparser(sync_parser)
+	sync_parser.set_defaults(func=sync_main)
+
+	benchmark_parser = subparsers.add_parser("benchmark")
+	benchmark_argparser(benchmark_parser)
+	benchmark_parser.set_defaults(func=benchmark_main)
+
 	args = parser.parse_args()
 
 	args.func(args)
@@ -0,0 +1,431 @@
+# coding=utf-8
+from __future__ import print_function, absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
+
+import collections
+import datetime
+import json
+import os
+import time
+import dateutil.parser, dateutil.tz
+from multiprocessing.pool import ThreadPool
+
+from .profiling import phase
+from . import concurrency, mirror, tracing
+from .leases import LeaseLost
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# action types
+COMMENT = "comment"
+LABELS = "labels"
+CLOSE = "close"
+
+# maximum number of issues whose actions are executed in parallel, how many writes are actually in flight at the same
+# time is up to the adaptive write limit
+WRITE_WORKERS = concurrency.writes.maximum
+
+# number of attempts per action before giving up on it for this run
+MAX_ATTEMPTS = 3
+
+# seconds to wait before the first retry of an action, doubled for each further one
+RETRY_BACKOFF = 1
+
+# maximum number of seconds to wait before retrying an action
+MAX_RETRY_WAIT = 60
+
+
+# actions planned but not yet executed, None if not planning
+_pending = None
+
+# all actions planned during the run
+_planned = []
+
+# all planned actions that failed during the run
+_failed = []
+
+
+class ActionFailed(Exception):
+	pass
+
+
+class ActionRejected(ActionFailed):
+	pass
+
+
+##~~ actions
+
+
+def comment(issue, body, headers, dryrun=False):
+	"""
+	Comments on the (converted) issue or PR.
+
+	:param issue:   the issue to comment on
+	:param body:    the comment's text
+	:param headers: headers to use for requests against API
+	:param dryrun:  whether to only simulate the writing API calls
+	"""
+
+	_submit(dict(type=COMMENT, issue=issue["number"], url=issue["comments_url"], body=body), headers, dryrun)
+
+
+def set_labels(issue, before, headers, dryrun=False):
+	"""
+	Sets the labels of the (converted) issue or PR to its current ``labels``.
+
+	:param issue:   the issue to label
+	:param before:  the labels the issue carried before, to record what was added and removed
+	:param headers: headers to use for requests against API
+	:param dryrun:  whether to only simulate the writing API calls
+	"""
+
+	labels = list(issue["labels"])
+	_submit(dict(type=LABELS, issue=issue["number"], url=issue.get("issue_url") or issue["url"], labels=labels,
+	             added=filter(lambda x: not x in before, labels),
+	             removed=filter(lambda x: not x in labels, before)),
+	        headers, dryrun)
+
+
+def close(issue, headers, dryrun=False):
+	"""
+	Closes the (converted) issue.
+
+	:param issue:   the issue to close
+	:param headers: headers to use for requests against API
+	:param dryrun:  whether to only simulate the writing API calls
+	"""
+
+	_submit(dict(type=CLOSE, issue=issue["number"], url=issue["url"]), headers, dryrun)
+
+
+def _submit(action, headers, dryrun):
+	if _pending is not None:
+		_pending.append(action)
+		_planned.append(action)
+	elif not dryrun:
+		with phase("writes"):
+			_execute_action(action, headers)
+
+
+##~~ planning
+
+
+def start():
+	"""
+	Starts planning: from now on actions are only recorded, to be executed by :func:`flush`.
+	"""
+
+	global _pending, _planned, _failed
+	_pending = []
+	_planned = []
+	_failed = []
+
+
+def flush(headers, dryrun=False, workers=WRITE_WORKERS, dead_letters=None):
+	"""
+	Executes all actions planned since the last flush, unless this is a dry run.
+
+	:param headers:      headers to use for requests against API
+	:param dryrun:       whether to only plan, without executing anything
+	:param workers:      number of issues whose actions to execute in parallel
+	:param dead_letters: file to save the actions that failed to right away, instead of when the run finishes, see
+	                     :func:`dead_letter`
+	:return: list of the actions that could not be executed
+	"""
+
+	global _pending
+	if _pending is None:
+		return []
+
+	actions, _pending = _pending, []
+	if dryrun or not actions:
+		return []
+
+	with phase("writes"):
+		failed = execute(actions, headers, workers=workers)
+	if dead_letters is not None:
+		dead_letter(dead_letters, failed)
+	else:
+		_failed.extend(failed)
+	return failed
+
+
+def finish(dump=None, dead_letters=None):
+	"""
+	Stops planning and logs a summary of the planned actions.
+
+	:param dump:         file to write all planned actions to as JSON, None to not write them anywhere
+	:param dead_letters: file to save the actions that failed to for replaying them during the next run, see
+	                     :func:`replay`. None to only log them
+	:return: all actions planned during the run
+	"""
+
+	global _pending
+	_pending = None
+
+	counts = collections.Counter(map(lambda x: x["type"], _planned))
+	logger.info("Planned %d actions%s" % (len(_planned), "".join(map(lambda x: ", %d %s" % (counts[x], x), sorted(counts)))))
+
+	if dump is not None:
+		with open(dump, "w") as f:
+			json.dump(_planned, f, indent=2)
+		logger.info("Wrote plan to %s" % dump)
+
+	if dead_letters is not None:
+		dead_letter(dead_letters, _failed)
+	elif _failed:
+		logger.error("Lost %d failed action(s), configure a dead letter file to retry them during the next run" % len(_failed))
+
+	return _planned
+
+
+##~~ execution
+
+
+def execute(actions, headers, workers=WRITE_WORKERS):
+	"""
+	Executes the actions. Actions on different issues are executed in parallel, the actions on the same issue in the
+	order they were planned. If an action on an issue fails for good, the remaining ones on that issue are skipped.
+
+	:param actions: the actions to execute
+	:param headers: headers to use for requests against API
+	:param workers: number of issues whose actions to execute in parallel
+	:return: list of the actions that could not be executed but might succeed later, actions rejected by the API are
+	         logged and dropped
+	"""
+
+	by_issue = collections.OrderedDict()
+	for action in actions:
+		by_issue.setdefault(action["issue"], []).append(action)
+
+	groups = by_issue.values()
+	with tracing.span("writes", actions=len(actions)):
+		# the actions executed by the pool belong to the writes as well
+		parent = tracing.current()
+
+		def execute_group(group):
+			with tracing.attach(parent):
+				return _execute_group(group, headers)
+
+		if workers <= 1 or len(groups) <= 1:
+			results = map(execute_group, groups)
+		else:
+			pool = ThreadPool(min(workers, len(groups)))
+			try:
+				results = pool.map(execute_group, groups)
+			finally:
+				pool.close()
+				pool.join()
+
+	failed = sum(results, [])
+	if failed:
+		logger.warn("%d of %d actions could not be executed" % (len(failed), len(actions)))
+	return failed
+
+
+def _execute_group(actions, headers):
+	for index, action in enumerate(actions):
+		try:
+			with tracing.span("action", type=action["type"], issue=action["issue"]):
+				_execute_action(action, headers)
+		except ActionRejected as e:
+			# no point in trying again, and the issue's remaining actions would likely fail too
+			logger.error("Dropping %d action(s) on #%d: %s" % (len(actions) - index, action["issue"], e))
+			return []
+		except ActionFailed as e:
+			# don't e.g. close an issue if the closing comment couldn't be posted
+			logger.error("Giving up on %d action(s) on #%d for now: %s" % (len(actions) - index, action["issue"], e))
+			return actions[index:]
+	return []
+
+
+def _execute_action(action, headers):
+	"""
+	Executes a single action, retrying it with backoff if it failed for a reason that might go away.
+
+	Comments aren't idempotent, so before a comment is retried after a failure that might still have created it (e.g.
+	a 502 from a proxy in front of the API) it's checked whether the comment made it after all.
+	"""
+
+	if not "attempted" in action:
+		action["attempted"] = datetime.datetime.utcnow().replace(tzinfo=dateutil.tz.tzutc()).isoformat()
+
+	uncertain = action.get("uncertain", False)
+	for attempt in range(1, MAX_ATTEMPTS + 1):
+		if uncertain and action["type"] == COMMENT and _comment_exists(action, headers):
+			logger.info("Comment on #%d was created despite the failure, not posting it again" % action["issue"])
+			return
+
+		wait = RETRY_BACKOFF * 2 ** (attempt - 1)
+		try:
+			r = _perform(action, headers)
+		except LeaseLost:
+			# nothing was sent, and whatever is left is up to the instance that took over
+			raise
+		except Exception as e:
+			action["error"] = str(e)
+			uncertain = True
+		else:
+			if r.status_code < 400:
+				action["executed"] = True
+				_apply_to_mirror(action, r)
+				return
+
+			action["error"] = "{url} responded with status {status}".format(url=action["url"], status=r.status_code)
+			if _rate_limited(r):
+				# rejected without being processed, safe to retry once the limit is lifted
+				if "Retry-After" in r.headers:
+					wait = max(wait, int(r.headers["Retry-After"]))
+			elif r.status_code >= 500:
+				uncertain = True
+			else:
+				raise ActionRejected(action["error"])
+
+		action["uncertain"] = uncertain
+		if attempt < MAX_ATTEMPTS:
+			logger.warn("Error executing %s on #%d (attempt %d of %d), retrying in %ds: %s" % (action["type"], action["issue"], attempt, MAX_ATTEMPTS, min(wait, MAX_RETRY_WAIT), action["error"]))
+			time.sleep(min(wait, MAX_RETRY_WAIT))
+
+	raise ActionFailed(action["error"])
+
+
+def _perform(action, headers):
+	from .util import api_post, api_patch
+
+	if action["type"] == COMMENT:
+		return api_post(action["url"], headers=headers, data=json.dumps({"body": action["body"]}))
+	elif action["type"] == LABELS:
+		return api_patch(action["url"], headers=headers, data=json.dumps({"labels": action["labels"]}))
+	elif action["type"] == CLOSE:
+		return api_patch(action["url"], headers=headers, data=json.dumps({"state": "closed"}))
+	else:
+		raise ValueError("Unknown action type: {type}".format(type=action["type"]))
+
+
+def _apply_to_mirror(action, r):
+	"""
+	Applies an executed action to the mirror if the bots read from one, so they see it before the next sync.
+	"""
+
+	from .util import project, _issue_url, COMMENT_FIELDS
+
+	if mirror.active() is None:
+		return
+
+	try:
+		if action["type"] == COMMENT:
+			created = project(r.json(), COMMENT_FIELDS)
+			created.setdefault("issue_url", _issue_url(action["url"]))
+			mirror.active().apply_comment(created)
+		elif action["type"] == LABELS:
+			mirror.active().apply_issue_change(action["issue"], labels=action["labels"])
+		elif action["type"] == CLOSE:
+			mirror.active().apply_issue_change(action["issue"], state="closed")
+	except:
+		logger.exception("Could not apply %s on #%d to the mirror, it will only show up after the next sync" % (action["type"], action["issue"]))
+
+
+def _rate_limited(r):
+	return r.status_code == 429 or (r.status_code == 403 and ("Retry-After" in r.headers or r.headers.get("X-RateLimit-Remaining") == "0"))
+
+
+def _comment_exists(action, headers):
+	from .util import iter_comments
+
+	# allow for some clock skew between us and the API
+	since = dateutil.parser.parse(action["attempted"]) - datetime.timedelta(minutes=5)
+	try:
+		return any(map(lambda x: x["body"] == action["body"], iter_comments(headers, action["url"], since=since, live=True)))
+	except LeaseLost:
+		raise
+	except:
+		logger.exception("Could not check whether comment on #%d exists" % action["issue"])
+		return False
+
+
+##~~ dead letters
+
+
+def replay(filename, headers, dryrun=False):
+	"""
+	Replays the actions that failed during earlier runs. Label changes are applied to the issue's current labels, so
+	changes made to them in the meantime are kept. Actions that fail again stay in the file.
+
+	:param filename: the dead letter file
+	:param headers:  headers to use for requests against API
+	:param dryrun:   whether to only log what would be replayed
+	"""
+
+	from .util import api_get
+
+	actions = _load_dead_letters(filename)
+	if not actions:
+		return
+
+	logger.info("Replaying %d failed action(s) from earlier runs" % len(actions))
+	if dryrun:
+		for action in actions:
+			logger.info("... would replay %s on #%d" % (action["type"], action["issue"]))
+		return
+
+	for action in actions:
+		if action["type"] == LABELS:
+			try:
+				current = map(lambda x: x["name"], api_get(action["url"], headers=headers).json()["labels"])
+				action["labels"] = filter(lambda x: not x in action["removed"], current) + filter(lambda x: not x in current, action["added"])
+			except LeaseLost:
+				raise
+			except:
+				logger.exception("Could not fetch current labels of #%d, using those planned originally" % action["issue"])
+
+	with phase("writes"):
+		try:
+			failed = execute(actions, headers)
+		except LeaseLost:
+			# only keep what wasn't replayed yet, the instance that took over replays that
+			_save_dead_letters(filename, filter(lambda x: not x.get("executed"), actions))
+			raise
+	_save_dead_letters(filename, failed)
+
+
+def dead_letter(filename, actions):
+	"""
+	Adds the actions to the dead letter file, to be replayed by :func:`replay` during the next run.
+
+	:param filename: the dead letter file
+	:param actions:  the actions that failed
+	"""
+
+	if not actions:
+		return
+	_save_dead_letters(filename, _load_dead_letters(filename) + actions)
+	logger.warn("Saved %d failed action(s) to %s, they will be retried during the next run" % (len(actions), filename))
+
+
+def _load_dead_letters(filename):
+	if not os.path.isfile(filename):
+		return []
+
+	try:
+		with open(filename, "r") as f:
+			return json.load(f)
+	except:
+		logger.exception("Could not read failed actions from %s" % filename)
+		return []
+
+
+def _save_dead_letters(filename, actions):
+	if not actions:
+		if os.path.isfile(filename):
+			os.remove(filename)
+		return
+
+	tmpfilename = filename + ".tmp"
+	with open(tmpfilename, "w") as f:
+		json.dump(actions, f, indent=2)
+	os.rename(tmpfilename, filename)
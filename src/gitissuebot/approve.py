@@ -5,39 +5,88 @@ __author__ = "Gina Häußge <osd@foosel.net>"
 __license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
 __copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
 
-import requests
-import json
 import dateutil.parser, dateutil.tz
+import collections
 import time
 import datetime
 import sys
 
-from .util import get_issues, load_config, update_config, get_bot_id, convert_to_internal, no_pullrequests, setup_logging, print_version
+from .util import get_issues, load_config, update_config, get_bot_id, convert_to_internal, no_pullrequests, print_version, \
+    auth_headers, set_labels, iter_comments, get_last_comment_by, get_repo_comments, ScanStats, COMMENTS_PER_PAGE, \
+    build_search_query, search_issues, SearchNotPossible, build_query_url, ISSUES_URL, ISSUE_FIELDS, get_issue, \
+    SEARCH_INDEX_LAG, add_common_arguments, merge_common_arguments, apply_common_defaults, run_bot
+from .checkpoint import Checkpoint
+from .deadlines import DeadlineIndex
+from . import profiling, budget, actions, mirror, sharding, logs, tracing
+from .profiling import phase
+from .leases import LeaseLost
 
 
 import logging
 logger = logging.getLogger(__name__)
 
 
+# priorities of the issues for runs with a limited budget, see issue_priority
+PRIORITY_OVERDUE = 0
+PRIORITY_NEW = 1
+PRIORITY_REVALIDATION = 2
+
+# number of issues whose actions a checkpointed run executes together, before recording them as processed
+CHECKPOINT_BATCH = 5 * actions.WRITE_WORKERS
+
+
 class OldPhrase(Exception):
 	pass
 
 
 ##~~ some helpers
 
+
+# the config values matched against every issue, lowercased and as sets where applicable
+Matching = collections.namedtuple("Matching", "ignored_labels, ignored_titles, whitelisted_authors, phrase, past_phrases")
+
+# prepared matching values by the config values they were prepared from
+_matching = dict()
+
+
+def matching(config):
+	"""
+	Prepares the config values matched against every issue. Configs validated by :func:`validate_config` carry them
+	already, for others they are prepared on the fly - only once per distinct set of values.
+
+	:param config: config to use
+	:return: the :class:`Matching` for the config
+	"""
+
+	if "matching" in config:
+		return config["matching"]
+
+	values = (config["ignored_labels"], config["ignored_titles"], config["whitelisted_authors"], config["phrase"], config["past_phrases"])
+	key = repr(values)
+	if not key in _matching:
+		ignored_labels, ignored_titles, whitelisted_authors, phrase, past_phrases = values
+		_matching[key] = Matching(ignored_labels=frozenset(ignored_labels),
+		                          ignored_titles=tuple(map(lambda x: x.lower(), ignored_titles)),
+		                          whitelisted_authors=frozenset(whitelisted_authors),
+		                          phrase=phrase.lower(),
+		                          past_phrases=tuple(map(lambda x: x.lower(), past_phrases)))
+	return _matching[key]
+
+
 def has_whitelisted_author(issue, config):
-	if issue["author"] in config["whitelisted_authors"]:
-		logger.info("... issue reported by whitelisted author, assuming it's valid")
+	if issue["author"] in matching(config).whitelisted_authors:
+		logger.info("... issue reported by whitelisted author, assuming it's valid", extra=dict(decision="whitelisted"))
 		return True
 
 
 def has_ignored_labels(issue, config):
-	return len(set(config["ignored_labels"]).intersection(set(issue["labels"]))) > 0
+	return not matching(config).ignored_labels.isdisjoint(issue["labels"])
 
 
 def has_ignored_title(issue, config):
-	for ignored_title in config["ignored_titles"]:
-		if ignored_title.lower() in issue["title"].lower():
+	title = issue["title"].lower()
+	for ignored_title in matching(config).ignored_titles:
+		if ignored_title in title:
 			return True
 
 	return False
@@ -47,14 +96,21 @@ def ignore_for_labeling(issue, config):
 	return has_ignored_title(issue, config) or has_ignored_labels(issue, config)
 
 
-def validator(issue, headers, config):
+def validator(issue, headers, config, since=None, stats=None, comment_index=None):
 	"""
 	Validates the given issue. Checks the issue's body and all comments on the issue made by the issue's author
 	for the trigger phrase.
 
+	Comments are fetched page by page and the scan stops at the first comment by the author containing the phrase.
+
 	:param issue: the issue to validate
 	:param headers: headers to use for requests against API
 	:param config: config to use
+	:param since: if set only comments created or updated after this datetime will be scanned, use this for issues
+	              whose older comments have already been scanned without success
+	:param stats: optional :class:`~gitissuebot.util.ScanStats` to track fetched and saved pages and bytes in
+	:param comment_index: optional :class:`~gitissuebot.util.CommentIndex` to take the comments from instead of
+	              fetching them, only used if it covers the scanned time frame
 	:return: true if issue validates, false otherwise
 	"""
 
@@ -63,20 +119,33 @@ def validator(issue, headers, config):
 	if has_ignored_labels(issue, config) or has_ignored_title(issue, config) or has_whitelisted_author(issue, config):
 		return True
 
+	prepared = matching(config)
 	lower_body = issue["body"].lower()
-	if config["phrase"].lower() in lower_body:
+	if prepared.phrase in lower_body:
 		return True
-	elif len(config["past_phrases"]) > 0:
-		for phrase in config["past_phrases"]:
-			if phrase.lower() in lower_body:
+	elif len(prepared.past_phrases) > 0:
+		for phrase in prepared.past_phrases:
+			if phrase in lower_body:
 				raise OldPhrase()
 
 	if issue["comments"] > 0:
-		r = requests.get(issue["comments_url"], headers=headers)
-		comments = r.json()
-		for comment in comments:
-			if comment["user"]["id"] == author_id and config["phrase"].lower() in comment["body"].lower():
-				return True
+		phrase = prepared.phrase
+		scanned = 0
+		if comment_index is not None and comment_index.covers(since if since is not None else issue["created"]):
+			comments = comment_index.comments_for(issue["url"], since=since)
+		else:
+			comments = iter_comments(headers, issue["comments_url"], since=since, stats=stats)
+
+		try:
+			for comment in comments:
+				scanned += 1
+				if comment["user"]["id"] == author_id and phrase in comment["body"].lower():
+					return True
+		finally:
+			if stats is not None:
+				skipped = max(0, issue["comments"] - scanned)
+				stats.skipped_entries += skipped
+				stats.skipped_pages += skipped // COMMENTS_PER_PAGE
 
 	return False
 
@@ -98,18 +167,16 @@ def add_reminder(issue, headers, config, dryrun):
 	personalized_reminder = config["reminder"].format(author=issue["author"], until=until.strftime("%Y-%m-%d %H:%M"))
 
 	# post a comment
-	logger.debug("-> Adding a reminder comment via POST %s" % issue["comments_url"])
-	if not dryrun:
-		requests.post(issue["comments_url"], headers=headers, data=json.dumps({"body": personalized_reminder}))
+	logger.debug("-> Adding a reminder comment via POST %s", issue["comments_url"])
+	actions.comment(issue, personalized_reminder, headers, dryrun=dryrun)
 
 	# label the issue if configured
 	if "label" in config and config["label"]:
 		current_labels = list(issue["labels"])
 		current_labels.append(config["label"])
 
-		logger.debug("-> Marking issues as invalid via PATCH %s, labels=%r" % (issue["url"], current_labels))
-		if not dryrun:
-			requests.patch(issue["url"], headers=headers, data=json.dumps({"labels": current_labels}))
+		logger.debug("-> Marking issues as invalid via PATCH %s, labels=%r", issue["url"], current_labels)
+		set_labels(issue, current_labels, headers, dryrun=dryrun)
 
 
 def add_oldphrasehint(issue, headers, config, dryrun):
@@ -125,9 +192,8 @@ def add_oldphrasehint(issue, headers, config, dryrun):
 	personalized_hint = config["newphrase"].format(author=issue["author"])
 
 	# post a comment
-	logger.debug("-> Adding a old phrase hint comment via POST %s" % issue["comments_url"])
-	if not dryrun:
-		requests.post(issue["comments_url"], headers=headers, data=json.dumps({"body": personalized_hint}))
+	logger.debug("-> Adding a old phrase hint comment via POST %s", issue["comments_url"])
+	actions.comment(issue, personalized_hint, headers, dryrun=dryrun)
 
 
 def mark_issue_valid(issue, headers, config, dryrun):
@@ -156,9 +222,8 @@ def mark_issue_valid(issue, headers, config, dryrun):
 	if oklabel and not oklabel in current_labels and not (has_ignored_labels(issue, config) or has_ignored_title(issue, config)):
 		current_labels.append(oklabel)
 
-	logger.debug("-> Marking issue valid via PATCH %s, labels=%r" % (issue["url"], current_labels))
-	if not dryrun:
-		requests.patch(issue["url"], headers=headers, data=json.dumps({"labels": current_labels}))
+	logger.debug("-> Marking issue valid via PATCH %s, labels=%r", issue["url"], current_labels)
+	set_labels(issue, current_labels, headers, dryrun=dryrun)
 
 
 def close_issue(issue, headers, config, dryrun):
@@ -198,112 +263,479 @@ def directly_close_issue(issue, headers, config, dryrun):
 
 def _close(issue, headers, body, dryrun):
 	if body is not None:
-		logger.debug("-> Adding a closing comment via POST %s" % issue["comments_url"])
-		if not dryrun:
-			requests.post(issue["comments_url"], headers=headers, data=json.dumps({"body": body}))
+		logger.debug("-> Adding a closing comment via POST %s", issue["comments_url"])
+		actions.comment(issue, body, headers, dryrun=dryrun)
 
 	# close the issue
-	logger.debug("-> Closing issue via PATCH %s, state=closed" % issue["url"])
-	if not dryrun:
-		requests.patch(issue["url"], headers=headers, data=json.dumps({"state": "closed"}))
+	logger.debug("-> Closing issue via PATCH %s, state=closed", issue["url"])
+	actions.close(issue, headers, dryrun=dryrun)
 
 
-def check_issues(config, file=None, dryrun=False):
-	if dryrun:
-		logger.info("THIS IS A DRYRUN")
+def get_new_issues(config, run):
+	"""
+	Retrieves all issues created since the last run. If ``search`` is configured, issues that are already labeled or
+	carry an ignored label are excluded by the search API, otherwise or if the search isn't possible all new issues
+	are listed.
 
-	# prepare headers
-	headers = {"Authorization": "token %s" % config["token"]}
+	:param config: config to use
+	:param run: the run state as created by :func:`prepare_run`
+	:return: the new issues
+	"""
+
+	if config["search"]:
+		excluded_labels = list(config["ignored_labels"])
+		for key in ("label", "oklabel"):
+			if key in config and config[key]:
+				excluded_labels.append(config[key])
+
+		# titles are still checked by the validator, the search's tokenization can't match ignored titles exactly
+		# the search index lags behind, so reach back a bit to find issues created right before the last search
+		query = build_search_query(config["repo"], created_after=run["new_since"], excluded_labels=excluded_labels)
+		try:
+			logger.info(u"Searching all issues matching %s" % query)
+			return search_issues(config["token"], query, issue_filter=no_pullrequests)
+		except SearchNotPossible as e:
+			logger.warn("... can't use search (%s), falling back to listing" % e)
+
+	logger.info("Fetching all issues created since %s" % config["since"].isoformat())
+	return get_issues(config["token"], config["repo"], issue_filter=no_pullrequests, created_after=config["since"])
+
+
+def prepare_run(config, headers):
+	"""
+	Prepares the state shared by all issues processed in a run.
+
+	:param config: config to use
+	:param headers: headers to use for requests against API
+	:return: the run state to pass to :func:`process_issue`
+	"""
 
 	# calculate grace period cutoff date, if grace period and label are configured
+	deadlines = None
 	if config["grace_period"] >= 0 and "label" in config and config["label"]:
 		grace_period_cutoff = datetime.datetime.utcnow().replace(tzinfo=dateutil.tz.tzutc()) - (datetime.timedelta(config["grace_period"] + 1))
 		bot_user_id = get_bot_id(headers)
-		since = min(config["since"], grace_period_cutoff)
+		if config["deadlines"]:
+			deadlines = DeadlineIndex(config["deadlines"])
+
+		if deadlines is not None and deadlines.existed:
+			# issues due for closing are looked up by their deadline, only issues with new activity need to be listed
+			since = config["since"]
+		else:
+			since = min(config["since"], grace_period_cutoff)
 	else:
 		grace_period_cutoff = None
 		bot_user_id = None
 		since = config["since"]
 
-	close_directly = config["close_directly"]
+	# issues created since then count as new, searches reach back further as the search index lags behind - issues
+	# from that window the last run already handled are recognized by the bot's comment on them
+	new_since = config["since"] - SEARCH_INDEX_LAG if config["search"] else config["since"]
 
-	# retrieve issues to process
-	logger.info("Fetching all issues since %s" % since.isoformat())
-	issues = get_issues(config["token"], config["repo"], issue_filter=no_pullrequests, since=since)
-	logger.info("Found %d issues to process..." % len(issues))
+	if bot_user_id is None and (config["past_phrases"] or new_since < config["since"]):
+		# we'll need to look for old phrase hints or reminders made by the bot
+		bot_user_id = get_bot_id(headers)
 
-	# process each issue
-	for issue in issues:
-		internal = convert_to_internal(issue)
+	return dict(grace_period_cutoff=grace_period_cutoff,
+	            bot_user_id=bot_user_id,
+	            since=since,
+	            new_since=new_since,
+	            comment_index=None,
+	            comment_stats=ScanStats(),
+	            bot_comments=dict(),
+	            deadlines=deadlines)
 
-		logger.info(u"Processing \"%s\" by %s (created %s, last updated %s)" % (internal["title"], internal["author"], internal["created_str"], internal["updated_str"]))
 
-		try:
-			try:
-				valid = validator(internal, headers, config)
-			except OldPhrase:
-				# check if there was any comment made by the bot
-				r = requests.get(internal["comments_url"], headers=headers)
-				comments = r.json()
-				bot_comment = None
-				for comment in comments:
-					if comment["user"]["id"] == bot_user_id:
-						bot_comment = comment
-						break
-				if bot_comment is None:
-					# no comment yet, make one
-					add_oldphrasehint(internal, headers, config, dryrun)
-				valid = True
-
-			if "label" in config and config["label"] and config["label"] in internal["labels"]:
-				# issue is currently labeled as incomplete, let's see if the information has been added or if it's still missing
-				if valid:
-					# issue is now valid => remove the label marking it as lacking information, add the oklabel if configured
-					logger.info("... author updated ticket with information, marking valid")
-					mark_issue_valid(internal, headers, config, dryrun)
-
-				elif grace_period_cutoff is not None:
-					# issue is invalid, let's see if the grace period for this issue has been exceeded and we can close it
-
-					# find the last comment made by the bot
-					r = requests.get(internal["comments_url"], headers=headers)
-					comments = r.json()
-					bot_comment = None
-					for comment in comments:
-						if comment["user"]["id"] == bot_user_id:
-							bot_comment = comment
-
-					if bot_comment is not None:
-						# we found the last comment by our bot, let's check if the grace period is over
-						comment_creation_datetime = dateutil.parser.parse(bot_comment["created_at"])
-
-						if grace_period_cutoff > comment_creation_datetime:
-							# grace period is over, let's post a comment and close the issue
-							logger.info("... information still missing after grace period, closing the issue")
-							close_issue(internal, headers, config, dryrun)
-
-			elif internal["created"] >= config["since"]:
-				# issue was created since last run
-				if valid:
-					# ...and is valid => add oklabel if configured
-					logger.info("... author submitted a valid ticket")
-					mark_issue_valid(internal, headers, config, dryrun)
+def get_due_issues(config, headers, run, known=None):
+	"""
+	Retrieves the issues whose close deadline has passed according to the run's deadline index. Issues that were
+	closed or unlabeled in the meantime are dropped from the index.
+
+	:param config: config to use
+	:param headers: headers to use for requests against API
+	:param run: the run state
+	:param known: numbers of issues that are already to be processed anyway, they aren't fetched again
+	:return: the due issues, unconverted
+	"""
+
+	deadlines = run["deadlines"]
+	if deadlines is None or not deadlines.existed:
+		# no index yet, the listing covers the whole grace period
+		return []
+
+	if known is None:
+		known = set()
+
+	due = filter(lambda x: not x in known, deadlines.due(datetime.datetime.utcnow().replace(tzinfo=dateutil.tz.tzutc())))
+	logger.info("Fetching %d issues due for closing" % len(due))
+
+	issues = []
+	with phase("listing"):
+		for number in due:
+			issue = get_issue(headers, "{url}/{number}".format(url=ISSUES_URL.format(repo=config["repo"]), number=number))
+			if issue is None or issue["state"] != "open" or not config["label"] in map(lambda x: x["name"], issue["labels"]):
+				deadlines.remove(number)
+				continue
+			issues.append(issue)
+	return issues
+
+
+def schedule_closing(issue, config, run, reminded):
+	"""
+	Records when the (converted) issue is due for closing, given the time its author was reminded.
+	"""
+
+	if run["deadlines"] is not None:
+		run["deadlines"].schedule(issue["number"], reminded + datetime.timedelta(config["grace_period"] + 1))
+
+
+def forget_closing(issue, run):
+	if run["deadlines"] is not None:
+		run["deadlines"].remove(issue["number"])
+
+
+def save_deadlines(run, complete=True):
+	"""
+	Saves the run's deadline index, if any. An index built from scratch during the run is only saved once the run
+	got through all issues, the ones it didn't get to might only have been listed because there was no index yet and
+	would never be looked at again.
+
+	:param run: the run state
+	:param complete: whether the run processed all issues
+	"""
+
+	deadlines = run["deadlines"]
+	if deadlines is None:
+		return
+
+	if not deadlines.existed and not complete:
+		logger.info("Not saving the deadlines yet, the next run looks through the whole grace period again")
+		return
+
+	deadlines.save()
+	logger.info("%d issues are waiting for their grace period to end" % len(deadlines))
+
+
+def last_bot_comment(issue, headers, run):
+	"""
+	Retrieves the bot's last comment on the issue, looked up at most once per run.
+
+	:param issue: the issue for which to retrieve the bot's last comment
+	:param headers: headers to use for requests against API
+	:param run: the run state
+	:return: the comment or None if the bot never commented on the issue
+	"""
+
+	bot_comments = run["bot_comments"]
+	if not issue["id"] in bot_comments and run["comment_index"] is not None:
+		bot_comments[issue["id"]] = run["comment_index"].last_comment_by(issue["url"], run["bot_user_id"])
+	if bot_comments.get(issue["id"]) is None:
+		# not looked up yet or last comment predates the comment stream
+		bot_comments[issue["id"]] = get_last_comment_by(headers, issue["comments_url"], run["bot_user_id"],
+		                                                comment_count=issue["comments"], stats=run["comment_stats"])
+	return bot_comments[issue["id"]]
+
+
+def handled_by_last_run(issue, headers, run):
+	"""
+	Checks whether the bot already commented on an issue, for issues created right before the last run that a search
+	might return again. The search results' labels and comment counts lag behind as well, so the comments are
+	looked up directly.
+
+	:param issue: the issue to check
+	:param headers: headers to use for requests against API
+	:param run: the run state
+	:return: True if the bot commented on the issue
+	"""
+
+	bot_comment = get_last_comment_by(headers, issue["comments_url"], run["bot_user_id"], stats=run["comment_stats"])
+	if bot_comment is not None:
+		run["bot_comments"][issue["id"]] = bot_comment
+	return bot_comment is not None
+
+
+def process_issue(issue, headers, config, run, dryrun=False):
+	"""
+	Validates a single (converted) issue and reminds, marks or closes it accordingly.
+
+	:param issue: the issue to process
+	:param headers: headers to use for requests against API
+	:param config: config to use
+	:param run: the run state as created by :func:`prepare_run`
+	:param dryrun: whether to only simulate the writing API calls
+	"""
+
+	try:
+		# issues already labeled as incomplete had their older comments scanned during the last run
+		already_scanned = "label" in config and config["label"] and config["label"] in issue["labels"]
+		with phase("validation"), tracing.span("approve.validator", issue=issue["number"]) as span:
+			valid = validator(issue, headers, config, since=config["since"] if already_scanned else None, stats=run["comment_stats"], comment_index=run["comment_index"])
+			span.set("valid", valid)
+	except OldPhrase:
+		# check if there was any comment made by the bot
+		bot_comment = last_bot_comment(issue, headers, run)
+		if bot_comment is None:
+			# no comment yet, make one
+			add_oldphrasehint(issue, headers, config, dryrun)
+		valid = True
+
+	if "label" in config and config["label"] and config["label"] in issue["labels"]:
+		# issue is currently labeled as incomplete, let's see if the information has been added or if it's still missing
+		if valid:
+			# issue is now valid => remove the label marking it as lacking information, add the oklabel if configured
+			logger.info("... author updated ticket with information, marking valid", extra=dict(decision="valid"))
+			mark_issue_valid(issue, headers, config, dryrun)
+			forget_closing(issue, run)
+
+		elif run["grace_period_cutoff"] is not None:
+			# issue is invalid, let's see if the grace period for this issue has been exceeded and we can close it
+
+			# find the last comment made by the bot
+			bot_comment = last_bot_comment(issue, headers, run)
+			if bot_comment is not None:
+				# we found the last comment by our bot, let's check if the grace period is over
+				comment_creation_datetime = dateutil.parser.parse(bot_comment["created_at"])
+
+				if run["grace_period_cutoff"] > comment_creation_datetime:
+					# grace period is over, let's post a comment and close the issue
+					logger.info("... information still missing after grace period, closing the issue", extra=dict(decision="closed"))
+					close_issue(issue, headers, config, dryrun)
+					forget_closing(issue, run)
 				else:
-					# ...and is invalid
-					if close_directly:
-						# we close tickets directly => add a comment and close the ticket
-						logger.info("... information is missing, closing the ticket")
-						directly_close_issue(internal, headers, config, dryrun)
-					else:
-						# we don't close tickets directly => add a friendly comment and label the issue correspondingly
-						logger.info("... reminding author of information to include")
-						add_reminder(internal, headers, config, dryrun)
-		except:
-			logger.exception("Exception while processing issues")
+					schedule_closing(issue, config, run, comment_creation_datetime)
+
+	elif issue["created"] >= run["new_since"]:
+		# issue was created since last run
+		if issue["created"] < config["since"] and handled_by_last_run(issue, headers, run):
+			logger.info("... already handled by the last run, skipping", extra=dict(decision="skipped"))
+		elif valid:
+			# ...and is valid => add oklabel if configured
+			logger.info("... author submitted a valid ticket", extra=dict(decision="valid"))
+			mark_issue_valid(issue, headers, config, dryrun)
+		else:
+			# ...and is invalid
+			if config["close_directly"]:
+				# we close tickets directly => add a comment and close the ticket
+				logger.info("... information is missing, closing the ticket", extra=dict(decision="closed"))
+				directly_close_issue(issue, headers, config, dryrun)
+			else:
+				# we don't close tickets directly => add a friendly comment and label the issue correspondingly
+				logger.info("... reminding author of information to include", extra=dict(decision="reminded"))
+				add_reminder(issue, headers, config, dryrun)
+				if run["grace_period_cutoff"] is not None:
+					schedule_closing(issue, config, run, datetime.datetime.utcnow().replace(tzinfo=dateutil.tz.tzutc()))
+
+
+def issue_priority(issue, config, run):
+	"""
+	Determines the priority of a (converted) issue for runs with a limited budget, lower is more urgent: first issues
+	whose grace period is probably over (labeled as incomplete and untouched since the grace period cutoff), then
+	issues created since the last run, then the re-validation of all other labeled issues.
+
+	:param issue: the issue to prioritize
+	:param config: config to use
+	:param run: the run state
+	:return: tuple to sort by
+	"""
+
+	if "label" in config and config["label"] and config["label"] in issue["labels"]:
+		if run["grace_period_cutoff"] is not None and issue["updated"] < run["grace_period_cutoff"]:
+			return PRIORITY_OVERDUE, issue["updated"]
+		return PRIORITY_REVALIDATION, issue["updated"]
+	return PRIORITY_NEW, issue["created"]
+
+
+def issue_deferral(config, run):
+	"""
+	Deferred new issues and re-validations rewind the next run's ``since`` to their creation or last update, but
+	never to before this run's ``since``. Overdue issues don't rewind it at all, they were last updated before the
+	grace period cutoff, so rewinding far enough to list them again would re-process everything since. They are
+	picked up again from the deadline index, if one is configured.
+
+	:return: function describing an issue deferred to the next run, see :func:`gitissuebot.budget.within_budget`
+	"""
+
+	categories = {PRIORITY_OVERDUE: "overdue closing", PRIORITY_NEW: "new issue", PRIORITY_REVALIDATION: "re-validation"}
+
+	def deferral(issue):
+		priority, since = issue_priority(issue, config, run)
+		if priority == PRIORITY_OVERDUE:
+			since = None
+		else:
+			since = max(since, config["since"])
+		return categories[priority], u"#%d \"%s\"" % (issue["number"], issue["title"]), since
+	return deferral
+
+
+def iter_checkpointed_issues(config, headers, since, checkpoint, run=None):
+	"""
+	Iterates over the issues to process like :func:`check_issues` does, but page by page and resuming from and
+	updating the ``checkpoint``. New issues are always listed, the search isn't used.
+
+	:param config: config to use
+	:param headers: headers to use for requests against API
+	:param since: since to use for the labeled issues
+	:param checkpoint: the :class:`~gitissuebot.checkpoint.Checkpoint` to use
+	:param run: the run state, if given the issues due for closing are yielded as well
+	:return: generator over the (converted) issues still to process
+	"""
+
+	yielded = set()
+
+	issues_url = ISSUES_URL.format(repo=config["repo"])
+
+	if "label" in config and config["label"]:
+		logger.info("Fetching all issues labeled \"%s\" since %s" % (config["label"], since.isoformat()))
+		url = build_query_url(issues_url, since=since, labels=[config["label"]])
+		for issue in checkpoint.iterate("labeled", headers, url, entry_filter=no_pullrequests, fields=ISSUE_FIELDS):
+			with phase("conversion"):
+				internal = convert_to_internal(issue)
+			yielded.add(issue["number"])
+			yield internal
+
+	logger.info("Fetching all issues created since %s" % config["since"].isoformat())
+	url = build_query_url(issues_url, sort="created", direction="desc")
+	created_before_since = lambda x: dateutil.parser.parse(x["created_at"]) < config["since"]
+	for issue in checkpoint.iterate("new", headers, url, entry_filter=no_pullrequests, stop=created_before_since, fields=ISSUE_FIELDS):
+		with phase("conversion"):
+			internal = convert_to_internal(issue)
+		yielded.add(issue["number"])
+		yield internal
+
+	if run is not None:
+		# due issues stay in the deadline index until processed, so they don't need to be checkpointed
+		for issue in get_due_issues(config, headers, run, known=yielded):
+			if checkpoint.is_processed(issue["id"]):
+				continue
+			with phase("conversion"):
+				internal = convert_to_internal(issue)
+			yield internal
+
+
+def check_issues(config, file=None, dryrun=False):
+	"""
+	Does one pass over the repository's issues.
+
+	:return: the ``since`` to continue from in the next pass
+	"""
+
+	# anything created or updated from now on is left to the next run - or from the last sync on, if reading from
+	# the mirror
+	started = mirror.current_as_of(datetime.datetime.utcnow().replace(tzinfo=dateutil.tz.tzutc()))
+
+	if dryrun:
+		logger.info("THIS IS A DRYRUN")
+
+	# prepare headers
+	headers = auth_headers(config["token"], repo=config["repo"])
+
+	# retry what failed during earlier runs
+	if config["dead_letters"] is not None:
+		actions.replay(config["dead_letters"], headers, dryrun=dryrun)
+
+	run = prepare_run(config, headers)
+	since = run["since"]
+
+	# retrieve issues to process: those marked as incomplete which were updated since the last run or might have
+	# exceeded their grace period, plus those created since the last run
+	# (reading from the mirror is cheap enough to not need resuming)
+	checkpoint = None
+	if config["checkpoint"] and mirror.active() is None:
+		checkpoint = Checkpoint(config["checkpoint"], config["since"])
+		issues = iter_checkpointed_issues(config, headers, since, checkpoint, run=run)
+
+	else:
+		issues = []
+		if "label" in config and config["label"]:
+			logger.info("Fetching all issues labeled \"%s\" since %s" % (config["label"], since.isoformat()))
+			issues += get_issues(config["token"], config["repo"], issue_filter=no_pullrequests, since=since, labels=[config["label"]])
+
+		known = set(map(lambda x: x["id"], issues))
+		issues += filter(lambda x: not x["id"] in known, get_new_issues(config, run))
+
+		known = set(map(lambda x: x["number"], issues))
+		issues += get_due_issues(config, headers, run, known=known)
+		logger.info("Found %d issues to process..." % len(issues))
+
+		with phase("conversion"):
+			issues = map(convert_to_internal, issues)
+		if budget.enabled():
+			# process the most urgent issues first, in case we run out of budget
+			issues = sorted(issues, key=lambda x: issue_priority(x, config, run))
+
+	# leave the issues other workers are responsible for to them
+	def not_owned(issue):
+		forget_closing(issue, run)
+		if checkpoint is not None:
+			checkpoint.mark_processed(issue["id"])
+	issues = sharding.owned(issues, skipped=not_owned)
+
+	# fetch all recent comments in one go if configured
+	if config["comment_stream"]:
+		logger.info("Fetching all comments since %s" % since.isoformat())
+		run["comment_index"] = get_repo_comments(config["token"], config["repo"], since)
+		logger.info("Found %d comments on %d issues" % (run["comment_index"].count, len(run["comment_index"].by_issue)))
+
+	# a checkpointed run executes the actions in batches, the checkpoint must only contain issues whose actions went
+	# through or are already saved to the dead letters for the next run to retry
+	batch = []
+	def flush_batch():
+		failed = set(map(lambda x: x["issue"], actions.flush(headers, dryrun=dryrun, dead_letters=config["dead_letters"])))
+		for issue in batch:
+			if not issue["number"] in failed or config["dead_letters"] is not None:
+				checkpoint.mark_processed(issue["id"])
+		checkpoint.save()
+		del batch[:]
+
+	# plan the actions for each issue, as long as the budget allows - a checkpointed listing is left to the checkpoint
+	actions.start()
+	for issue in budget.within_budget(issues, deferral=issue_deferral(config, run) if checkpoint is None else None):
+		with logs.entry(issue["number"]), tracing.span("issue", number=issue["number"]):
+			logger.info(u"Processing \"%s\" by %s (created %s, last updated %s)", issue["title"], issue["author"], issue["created_str"], issue["updated_str"])
+
+			try:
+				process_issue(issue, headers, config, run, dryrun=dryrun)
+				if checkpoint is not None:
+					batch.append(issue)
+			except LeaseLost:
+				raise
+			except:
+				logger.exception("Exception while processing issues")
+
+		if len(batch) >= CHECKPOINT_BATCH:
+			flush_batch()
+	if batch:
+		flush_batch()
+
+	logger.info("Comment scan: %s" % run["comment_stats"])
+
+	# execute the plan
+	actions.flush(headers, dryrun=dryrun)
+	actions.finish(dump=config["plan"], dead_letters=config["dead_letters"])
+
+	if not dryrun:
+		save_deadlines(run, complete=not budget.deferred() and (checkpoint is None or checkpoint.complete))
+
+	if checkpoint is not None and not checkpoint.complete:
+		# keep since as it is, so the next run resumes from the checkpoint and retries what failed or was deferred
+		logger.info("Some issues could not be processed, the next run will resume from the checkpoint")
+		checkpoint.save()
+		return config["since"]
+
+	# the next run starts where this one started - or rather where the first attempt started, if it was resumed
+	if checkpoint is not None:
+		since = checkpoint.started
+	else:
+		since = budget.deferred_since(started)
 
 	if file is not None and not dryrun:
-		# we are using a config file, so we save the current date and time for the next run
-		update_config(file)
+		# we are using a config file, so we save it for the next run
+		update_config(file, since=since)
+
+	if checkpoint is not None:
+		checkpoint.clear()
+
+	return since
 
 
 ##~~ config handling
@@ -322,6 +754,8 @@ def validate_config(config):
 	if not "token" in config or not config["token"]:
 		logger.error("Token must be defined")
 		sys.exit(-1)
+	if isinstance(config["token"], basestring) and "," in config["token"]:
+		config["token"] = filter(lambda x: len(x) > 0, map(str.strip, str(config["token"]).split(",")))
 	if not "repo" in config or not config["repo"]:
 		logger.error("Repo must be defined")
 		sys.exit(-1)
@@ -344,12 +778,8 @@ def validate_config(config):
 		config["ignored_labels"] = ()
 	if not "ignored_titles" in config:
 		config["ignored_titles"] = ()
-	if not "dryrun" in config:
-		config["dryrun"] = False
 	if not "phrase" in config or not config["phrase"]:
 		config["phrase"] = "I love cookies"
-	if not "debug" in config or config["debug"] is None:
-		config["debug"] = False
 
 	if not "past_phrases" in config or not config["past_phrases"]:
 		config["past_phrases"] = []
@@ -360,11 +790,24 @@ def validate_config(config):
 
 	if not "whitelisted_authors" in config or not config["whitelisted_authors"]:
 		config["whitelisted_authors"] = []
+	if not "comment_stream" in config or config["comment_stream"] is None:
+		config["comment_stream"] = False
+	if not "search" in config or config["search"] is None:
+		config["search"] = False
+	if not "checkpoint" in config or not config["checkpoint"]:
+		config["checkpoint"] = None
+	if not "deadlines" in config or not config["deadlines"]:
+		config["deadlines"] = None
+	apply_common_defaults(config, "approve")
 
 	# sanitizing
 	if config["since"].tzinfo is None:
 		config["since"] = config["since"].replace(tzinfo=dateutil.tz.tzutc())
 
+	# prepare what's matched against every issue once
+	config.pop("matching", None)
+	config["matching"] = matching(config)
+
 
 ##~~ CLI
 
@@ -379,6 +822,10 @@ def main(args=None):
 	if args.version:
 		print_version()
 
+	# enable profiling if requested
+	if args.profile:
+		profiling.enable(args.profile)
+
 	# merge config (if given) and CLI parameters
 	config = load_config(args.config)
 	if args.token is not None:
@@ -403,26 +850,27 @@ def main(args=None):
 		config["past_phrases"] = filter(lambda x: x is not None and len(x) > 0, map(str.strip, args.past_phrases.split(",")))
 	if args.reminder is not None:
 		config["reminder"] = args.reminder
+	if args.checkpoint is not None:
+		config["checkpoint"] = args.checkpoint
 	if args.closing is not None:
 		config["closing"] = args.closing
 	if args.closingnow is not None:
 		config["closingnow"] = args.closingnow
 	config["close_directly"] = config["close_directly"] if "close_directly" in config and config["close_directly"] else False or args.close_directly
-	config["dryrun"] = config["dryrun"] if "dryrun" in config and config["dryrun"] else False or args.dryrun
-	config["debug"] = config["debug"] if "debug" in config and config["debug"] else False or args.debug
+	config["comment_stream"] = config["comment_stream"] if "comment_stream" in config and config["comment_stream"] else False or args.comment_stream
+	config["search"] = config["search"] if "search" in config and config["search"] else False or args.search
+	if args.deadlines is not None:
+		config["deadlines"] = args.deadlines
+	elif args.config is not None and not config.get("deadlines"):
+		config["deadlines"] = args.config + ".deadlines.json"
+	merge_common_arguments(config, args)
 
 	# validate the config
-	validate_config(config)
-
-	# setup logger
-	setup_logging(debug=config["debug"])
+	with phase("config"):
+		validate_config(config)
 
 	# check existing issues
-	try:
-		check_issues(config, file=args.config, dryrun=config["dryrun"])
-	except:
-		logger.exception("Error during execution")
-		sys.exit(-1)
+	run_bot("approve", config, args, check_issues)
 
 def argparser(parser=None):
 	if parser is None:
@@ -433,7 +881,7 @@ def argparser(parser=None):
 	parser.add_argument("-c", "--config", action="store", dest="config",
 	                    help="The config file to use")
 	parser.add_argument("-t", "--token", action="store", dest="token",
-	                    help="The token to use, must be defined either on CLI or via config")
+	                    help="The token to use, must be defined either on CLI or via config. Multiple comma-separated tokens may be given to spread the requests over")
 	parser.add_argument("-r", "--repo", action="store", dest="repo",
 	                    help="The github repository to use, must be defined either on CLI or via config")
 	parser.add_argument("--reminder", action="store", dest="reminder",
@@ -462,12 +910,15 @@ def argparser(parser=None):
 	                    help="Text of comment when closing an issue after the grace period, defaults to not set and thus no comment being posted upon closing.")
 	parser.add_argument("--closingnow", action="store", dest="closingnow",
 	                    help="Text of comment when closing an issue directly, defaults to not set and thus no comment being posted upon closing.")
-	parser.add_argument("--dry-run", action="store_true", dest="dryrun",
-	                    help="Just print what would be done without actually doing it")
-	parser.add_argument("-v", "--version", action="store_true", dest="version",
-	                    help="Print the version and exit")
-	parser.add_argument("--debug", action="store_true", dest="debug",
-	                    help="Enable debug logging")
+	parser.add_argument("--comment-stream", action="store_true", dest="comment_stream",
+	                    help="Fetch all recent comments of the repository in one go instead of fetching them per issue, saves requests on busy repositories")
+	parser.add_argument("--search", action="store_true", dest="search",
+	                    help="Use the search API to only fetch new issues that are neither labeled yet nor carry an ignored label, falls back to listing if the search isn't possible")
+	parser.add_argument("--checkpoint", action="store", dest="checkpoint",
+	                    help="State file to write the progress of the run to, allows resuming an aborted run from where it left off. Defaults to not set")
+	parser.add_argument("--deadlines", action="store", dest="deadlines",
+	                    help="File to keep the close deadlines of reminded issues in, so that only issues with new activity or a passed deadline need to be fetched. Defaults to <config>.deadlines.json if a config file is used, otherwise the whole grace period is listed on every run")
+	add_common_arguments(parser)
 
 	return parser
 
@@ -5,13 +5,16 @@ __author__ = "Gina Häußge <osd@foosel.net>"
 __license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
 __copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
 
-import requests
-import json
 import sys
 import datetime
-import dateutil.parser
+import dateutil.parser, dateutil.tz
 
-from .util import get_issues, load_config, update_config, no_pullrequests, convert_to_internal, setup_logging, print_version
+from .util import get_issues, load_config, update_config, no_pullrequests, convert_to_internal, print_version, \
+    auth_headers, set_labels, \
+    add_common_arguments, merge_common_arguments, apply_common_defaults, run_bot
+from . import profiling, budget, actions, mirror, sharding, logs, tracing
+from .profiling import phase
+from .leases import LeaseLost
 
 import logging
 logger = logging.getLogger(__name__)
@@ -24,47 +27,119 @@ def apply_label(label, issue, headers, dryrun=False):
 	current_labels = list(issue["labels"])
 	current_labels.append(label)
 
-	logger.debug("-> Adding a label via PATCH %s, labels=%r" % (issue["url"], current_labels))
-	if not dryrun:
-		requests.patch(issue["url"], headers=headers, data=json.dumps({"labels": current_labels}))
+	logger.debug("-> Adding a label via PATCH %s, labels=%r", issue["url"], current_labels)
+	set_labels(issue, current_labels, headers, dryrun=dryrun)
+
+
+def prepare_mappings(config):
+	"""
+	Prepares the configured tag-label-mappings for matching, lowercasing the tags if case is to be ignored.
+
+	:param config: config to use
+	:return: the mappings to pass to :func:`process_issue`
+	"""
+
+	mappings = config["mappings"]
+	if config["ignore_case"]:
+		mappings = map(lambda data: dict(tag=data["tag"].lower(), label=data["label"]), mappings)
+	return mappings
+
+
+def process_issue(issue, headers, config, mappings, dryrun=False):
+	"""
+	Applies the labels of all mappings whose tag is contained in the title of the (converted) issue.
+
+	:param issue: the issue to process
+	:param headers: headers to use for requests against API
+	:param config: config to use
+	:param mappings: mappings as prepared by :func:`prepare_mappings`
+	:param dryrun: whether to only simulate the writing API calls
+	"""
+
+	with phase("validation"), tracing.span("autolabel.match", issue=issue["number"]) as span:
+		matched = []
+		for mapping in mappings:
+			tag = mapping["tag"]
+			label = mapping["label"]
+			title = issue["title"].lower() if config["ignore_case"] else issue["title"]
+
+			if tag in title and not label in issue["labels"]:
+				matched.append(label)
+		span.set("labels", ",".join(matched))
+
+	for label in matched:
+		logger.info("... applying label %s", label, extra=dict(decision="labeled"))
+		apply_label(label, issue, headers, dryrun=dryrun)
 
 
 def process_issues(config, file=None, dryrun=False):
+	"""
+	Does one pass over the repository's issues.
+
+	:return: the ``since`` to continue from in the next pass
+	"""
+
+	# anything created or updated from now on is left to the next run - or from the last sync on, if reading from
+	# the mirror
+	started = mirror.current_as_of(datetime.datetime.utcnow().replace(tzinfo=dateutil.tz.tzutc()))
+
 	if dryrun:
 		logger.info("THIS IS A DRYRUN")
 
 	# prepare headers
-	headers = {"Authorization": "token %s" % config["token"]}
+	headers = auth_headers(config["token"], repo=config["repo"])
 
-	mappings = config["mappings"]
-	if config["ignore_case"]:
-		mappings = map(lambda data: dict(tag=data["tag"].lower(), label=data["label"]), mappings)
+	# retry what failed during earlier runs
+	if config["dead_letters"] is not None:
+		actions.replay(config["dead_letters"], headers, dryrun=dryrun)
+
+	mappings = prepare_mappings(config)
 
 	since = config["since"]
 
 	# retrieve issues to process
 	logger.info("Fetching all issues")
 	issues = get_issues(config["token"], config["repo"], since=since, issue_filter=no_pullrequests, converter=convert_to_internal)
+	issues = filter(sharding.owns, issues)
 	logger.info("Found %d issues to process..." % len(issues))
 
-	for issue in issues:
-		logger.info(u"Processing \"%s\" by %s (created %s, last updated %s)" % (issue["title"], issue["author"], issue["created_str"], issue["updated_str"]))
+	if budget.enabled():
+		# new issues first, they are the ones most likely to still need labeling
+		if since.tzinfo is None:
+			since = since.replace(tzinfo=dateutil.tz.tzutc())
+		issues = sorted(issues, key=lambda x: (x["created"] < since, x["updated"]))
+
+	actions.start()
+	for issue in budget.within_budget(issues, deferral=issue_deferral):
+		with logs.entry(issue["number"]), tracing.span("issue", number=issue["number"]):
+			logger.info(u"Processing \"%s\" by %s (created %s, last updated %s)", issue["title"], issue["author"], issue["created_str"], issue["updated_str"])
+
+			try:
+				process_issue(issue, headers, config, mappings, dryrun=dryrun)
+			except LeaseLost:
+				raise
+			except:
+				logger.exception("Exception while processing issue")
+
+	# execute the plan
+	actions.flush(headers, dryrun=dryrun)
+	actions.finish(dump=config["plan"], dead_letters=config["dead_letters"])
+
+	# the next run starts where this one started - or at the last update of the oldest issue we didn't get to
+	since = budget.deferred_since(started)
+	if file is not None and not dryrun:
+		# we are using a config file, so we save it for the next run
+		update_config(file, since=since)
 
-		try:
-			for mapping in mappings:
-				tag = mapping["tag"]
-				label = mapping["label"]
-				title = issue["title"].lower() if config["ignore_case"] else issue["title"]
+	return since
 
-				if tag in title and not label in issue["labels"]:
-					logger.info("... applying label {label}".format(label=label))
-					apply_label(label, issue, headers, dryrun=dryrun)
-		except:
-			logger.exception("Exception while processing issue")
 
-	if file is not None and not dryrun:
-		# we are using a config file, so we save the current date and time for the next run
-		update_config(file)
+def issue_deferral(issue):
+	"""
+	Describes an issue deferred to the next run, see :func:`gitissuebot.budget.within_budget`.
+	"""
+
+	return "issue", u"#%d \"%s\"" % (issue["number"], issue["title"]), issue["updated"]
 
 ##~~ config handling
 
@@ -82,6 +157,8 @@ def validate_config(config):
 	if not "token" in config or not config["token"]:
 		logger.error("Token must be defined")
 		sys.exit(-1)
+	if isinstance(config["token"], basestring) and "," in config["token"]:
+		config["token"] = filter(lambda x: len(x) > 0, map(str.strip, str(config["token"]).split(",")))
 	if not "repo" in config or not config["repo"]:
 		logger.error("Repo must be defined")
 		sys.exit(-1)
@@ -93,8 +170,7 @@ def validate_config(config):
 		config["since"] = datetime.datetime.utcnow()
 	if not "ignore_case" in config or config["ignore_case"] is None:
 		config["ignore_case"] = False
-	if not "debug" in config or config["debug"] is None:
-		config["debug"] = False
+	apply_common_defaults(config, "autolabel")
 
 
 ##~~ CLI
@@ -110,6 +186,10 @@ def main(args=None):
 	if args.version:
 		print_version()
 
+	# enable profiling if requested
+	if args.profile:
+		profiling.enable(args.profile)
+
 	# merge config (if given) and CLI parameters
 	config = load_config(args.config)
 	if args.token is not None:
@@ -121,21 +201,14 @@ def main(args=None):
 	if args.mappings is not None:
 		config["mappings"] = args.mappings
 	config["ignore_case"] = config["ignore_case"] if "ignore_case" in config and config["ignore_case"] else False or args.ignore_case
-	config["dryrun"] = config["dryrun"] if "dryrun" in config and config["dryrun"] else False or args.dryrun
-	config["debug"] = config["debug"] if "debug" in config and config["debug"] else False or args.debug
+	merge_common_arguments(config, args)
 
 	# validate the config
-	validate_config(config)
-
-	# setup logger
-	setup_logging(debug=config["debug"])
+	with phase("config"):
+		validate_config(config)
 
 	# process existing issues
-	try:
-		process_issues(config, file=args.config, dryrun=config["dryrun"])
-	except:
-		logger.exception("Error during execution")
-		sys.exit(-1)
+	run_bot("autolabel", config, args, process_issues)
 
 def argparser(parser=None):
 	if parser is None:
@@ -153,7 +226,7 @@ def argparser(parser=None):
 	parser.add_argument("-c", "--config", action="store", dest="config",
 	                    help="The config file to use")
 	parser.add_argument("-t", "--token", action="store", dest="token",
-	                    help="The token to use, must be defined either on CLI or via config")
+	                    help="The token to use, must be defined either on CLI or via config. Multiple comma-separated tokens may be given to spread the requests over")
 	parser.add_argument("-r", "--repo", action="store", dest="repo",
 	                    help="The github repository to use, must be defined either on CLI or via config")
 	parser.add_argument("-s", "--since", action="store", dest="since", type=dateutil.parser.parse,
@@ -162,12 +235,7 @@ def argparser(parser=None):
 	                    help="Tag-label-mappings to use. Expected format is '<tag>=<label>'")
 	parser.add_argument("-i", "--ignore-case", action="store_true", dest="ignore_case",
 	                    help="Ignore case when matching the title snippets")
-	parser.add_argument("--dry-run", action="store_true", dest="dryrun",
-	                    help="Just print what would be done without actually doing it")
-	parser.add_argument("-v", "--version", action="store_true", dest="version",
-	                    help="Print the version and exit")
-	parser.add_argument("--debug", action="store_true", dest="debug",
-	                    help="Enable debug logging")
+	add_common_arguments(parser)
 
 	return parser
 
@@ -0,0 +1,535 @@
+# coding=utf-8
+from __future__ import print_function, absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
+
+import collections
+import datetime
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+import dateutil.parser, dateutil.tz
+
+from .util import setup_logging, print_version
+from . import cassette
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# history file format version
+HISTORY_VERSION = 1
+
+SCENARIOS = ("approve", "autolabel", "prcheck")
+SIZES = (100, 1000, 5000)
+
+# per run metrics, lower is better for all of them
+METRICS = ("wall_time", "requests_per_issue", "peak_rss")
+
+# allowed relative increase per metric before it counts as a regression
+TOLERANCES = {"wall_time": 0.2, "requests_per_issue": 0.0, "peak_rss": 0.1, "import_time": 0.2}
+
+# increases up to these absolute values are considered noise, regardless of the tolerance
+NOISE = {"wall_time": 0.05, "requests_per_issue": 0.0, "peak_rss": 2.0, "import_time": 0.02}
+
+# growth of the wall time per issue between the smallest and largest size above which scaling is reported as
+# non-linear
+SCALING_FACTOR = 2.0
+
+# synthetic repository
+REPO = "benchmark/repo"
+BOT_ID = 1
+LABEL = "incomplete_issue"
+PHRASE = "I love cookies"
+AGE = datetime.timedelta(days=60)
+
+
+##~~ synthetic repository
+
+
+class SyntheticApi(object):
+	"""
+	Answers the bots' requests from a generated repository of ``size`` issues, about a fourth of them PRs, created
+	over the last ``AGE``. Every fifth issue carries ``LABEL`` and has been reminded by the bot, every tenth has since
+	been commented on by its author, every seventh is a request. Writes are accepted but not applied.
+
+	:param size:    number of issues
+	:param latency: seconds to wait before answering each request
+	"""
+
+	def __init__(self, size, latency=0.0):
+		self.size = size
+		self.latency = latency
+		self.requests = 0
+		self._lock = threading.Lock()
+
+		self.now = datetime.datetime.utcnow().replace(microsecond=0, tzinfo=dateutil.tz.tzutc())
+		self.issues = []
+		self.prs = []
+		self.comments = dict()
+
+		base = "https://api.github.com/repos/{repo}".format(repo=REPO)
+		for number in range(1, size + 1):
+			created = self.now - AGE * (size - number + 1) // size
+			pr = number % 4 == 0
+			user = {"login": "user{}".format(number % 50), "id": 100 + number % 50, "type": "User"}
+
+			issue = {"id": 10000 + number, "number": number, "state": "open",
+			         "title": ("[Request] " if number % 7 == 0 else "") + "Something is broken #{}".format(number),
+			         "body": PHRASE if number % 3 == 0 else "It doesn't work", "user": user,
+			         "labels": [{"name": LABEL, "color": "ff0000"}] if number % 5 == 0 and not pr else [],
+			         "created_at": _iso(created), "updated_at": _iso(created + datetime.timedelta(hours=1)),
+			         "url": "{base}/issues/{number}".format(base=base, number=number),
+			         "comments_url": "{base}/issues/{number}/comments".format(base=base, number=number),
+			         "html_url": "https://github.com/{repo}/issues/{number}".format(repo=REPO, number=number),
+			         "locked": False, "assignee": None, "milestone": None}
+
+			comments = []
+			if number % 5 == 0 and not pr:
+				comments.append(self._comment(issue, 1, {"login": "gitissuebot", "id": BOT_ID}, "Please add the missing information", created))
+			if number % 10 == 0 and not pr:
+				comments.append(self._comment(issue, 2, user, "Done, " + PHRASE, created + datetime.timedelta(hours=1)))
+			issue["comments"] = len(comments)
+			self.comments[number] = comments
+
+			if pr:
+				issue["pull_request"] = {"url": "{base}/pulls/{number}".format(base=base, number=number)}
+				self.prs.append({"id": 20000 + number, "number": number, "state": "open", "title": issue["title"],
+				                 "body": issue["body"], "user": user, "created_at": issue["created_at"],
+				                 "updated_at": issue["updated_at"],
+				                 "url": "{base}/pulls/{number}".format(base=base, number=number),
+				                 "issue_url": issue["url"], "comments_url": issue["comments_url"],
+				                 "diff_url": "https://github.com/{repo}/pull/{number}.diff".format(repo=REPO, number=number),
+				                 "head": {"ref": "feature/{}".format(number), "repo": {"full_name": "contributor/repo"}},
+				                 "base": {"ref": "master" if number % 8 == 0 else "devel", "repo": {"full_name": REPO}}})
+			self.issues.append(issue)
+
+	def _comment(self, issue, index, user, body, created):
+		return {"id": issue["number"] * 10 + index, "user": user, "body": body, "issue_url": issue["url"],
+		        "created_at": _iso(created), "updated_at": _iso(created)}
+
+	def request(self, method, url, headers=None, **kwargs):
+		with self._lock:
+			self.requests += 1
+		if self.latency > 0:
+			time.sleep(self.latency)
+
+		parsed = urlparse.urlparse(url)
+		query = dict(urlparse.parse_qsl(parsed.query))
+		path = parsed.path
+
+		if method.upper() == "POST":
+			return self._respond(url, 201, {"id": 1})
+		if method.upper() == "PATCH":
+			return self._respond(url, 200, {"id": 1})
+
+		if path == "/user":
+			return self._respond(url, 200, {"login": "gitissuebot", "id": BOT_ID})
+
+		m = re.match(r"^/repos/[^/]+/[^/]+/issues/(\d+)(/comments)?$", path)
+		if m:
+			number = int(m.group(1))
+			if not 0 < number <= self.size:
+				return self._respond(url, 404, {"message": "Not Found"})
+			if m.group(2):
+				return self._page(url, query, _since(self.comments[number], query))
+			return self._respond(url, 200, self.issues[number - 1])
+
+		if re.match(r"^/repos/[^/]+/[^/]+/issues/comments$", path):
+			comments = sorted(sum(self.comments.values(), []), key=lambda x: (x["created_at"], x["id"]))
+			return self._page(url, query, _since(comments, query))
+
+		if re.match(r"^/repos/[^/]+/[^/]+/issues$", path):
+			issues = _since(_state(self.issues, query), query)
+			if "labels" in query:
+				labels = set(query["labels"].split(","))
+				issues = filter(lambda x: labels.issubset(set(map(lambda l: l["name"], x["labels"]))), issues)
+			if "creator" in query:
+				issues = filter(lambda x: x["user"]["login"] == query["creator"], issues)
+			return self._page(url, query, _sort(issues, query))
+
+		if re.match(r"^/repos/[^/]+/[^/]+/pulls$", path):
+			return self._page(url, query, _sort(_state(self.prs, query), query))
+
+		return self._respond(url, 404, {"message": "Not Found"})
+
+	def _page(self, url, query, entries):
+		per_page = min(int(query.get("per_page", 30)), 100)
+		page = int(query.get("page", 1))
+		last = max(1, (len(entries) + per_page - 1) // per_page)
+
+		def page_url(n):
+			params = dict(query)
+			params["page"] = str(n)
+			return url.split("?")[0] + "?" + urllib.urlencode(sorted(params.items()))
+
+		links = []
+		if page < last:
+			links += [(page_url(page + 1), "next"), (page_url(last), "last")]
+		if page > 1:
+			links += [(page_url(1), "first"), (page_url(page - 1), "prev")]
+
+		headers = dict()
+		if links:
+			headers["Link"] = ", ".join(map(lambda x: "<{url}>; rel=\"{rel}\"".format(url=x[0], rel=x[1]), links))
+		return self._respond(url, 200, entries[(page - 1) * per_page:page * per_page], headers=headers)
+
+	def _respond(self, url, status, body, headers=None):
+		headers = dict(headers or dict())
+		headers.update({"Content-Type": "application/json; charset=utf-8", "X-RateLimit-Limit": "5000",
+		                "X-RateLimit-Remaining": "5000", "X-RateLimit-Reset": str(int(time.time()) + 3600)})
+		return cassette.response(dict(url=url, status=status, headers=headers, response=json.dumps(body)))
+
+	def finish(self):
+		logger.debug("Answered %d requests from a synthetic repository of %d issues" % (self.requests, self.size))
+
+
+def _iso(d):
+	return d.astimezone(dateutil.tz.tzutc()).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _since(entries, query):
+	if not "since" in query:
+		return entries
+	since = _iso(dateutil.parser.parse(query["since"]))
+	return filter(lambda x: x["updated_at"] >= since, entries)
+
+
+def _state(entries, query):
+	if query.get("state", "open") in ("open", "all"):
+		return entries
+	return filter(lambda x: x["state"] == query["state"], entries)
+
+
+def _sort(entries, query):
+	key = "updated_at" if query.get("sort") == "updated" else "created_at"
+	return sorted(entries, key=lambda x: (x[key], x["number"]), reverse=query.get("direction", "desc") == "desc")
+
+
+def scenario_config(scenario, now):
+	"""
+	:return: the config to run the bot of ``scenario`` with against a :class:`SyntheticApi` created at ``now``
+	"""
+
+	config = dict(token="benchmark", repo=REPO, since=now - datetime.timedelta(days=7))
+	if scenario == "approve":
+		config.update(label=LABEL, phrase=PHRASE, reminder="Hi @{author}, please add the missing information until {until}",
+		              closing="Closing", ignored_titles=["[Request]"])
+	elif scenario == "autolabel":
+		config.update(mappings=[dict(tag="[Request]", label="request")])
+	elif scenario == "prcheck":
+		config.update(targets=["devel"], label="needs_retarget", reminder="Hi @{author}, {problems}",
+		              problems=dict(invalid_target="Please target one of {targets} instead of {target_branch}"))
+	else:
+		raise ValueError("Unknown scenario: {scenario}".format(scenario=scenario))
+	return config
+
+
+##~~ running
+
+
+def run_scenario(scenario, size, latency=0.0):
+	"""
+	Runs the bot of ``scenario`` against a synthetic repository of ``size`` issues, in this process.
+
+	:return: dict of the measured metrics
+	"""
+
+	import yaml
+	from . import approve, autolabel, prcheck
+	bot = dict(approve=approve, autolabel=autolabel, prcheck=prcheck)[scenario]
+
+	api = SyntheticApi(size, latency=latency)
+	directory = tempfile.mkdtemp()
+	try:
+		config_file = os.path.join(directory, "config.yaml")
+		with open(config_file, "w") as f:
+			yaml.safe_dump(scenario_config(scenario, api.now), f, default_flow_style=False)
+
+		args = bot.argparser().parse_args(["-c", config_file])
+		cassette.serve(api)
+		start = time.time()
+		bot.main(args)
+		wall_time = time.time() - start
+	finally:
+		shutil.rmtree(directory)
+
+	return dict(wall_time=wall_time, requests=api.requests, requests_per_issue=float(api.requests) / size,
+	            peak_rss=_peak_rss())
+
+
+def _peak_rss():
+	"""
+	:return: the peak resident set size of the process in MB, None if it can't be determined
+	"""
+
+	try:
+		import resource
+	except ImportError:
+		return None
+
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return rss / (1024.0 * 1024.0) if sys.platform == "darwin" else rss / 1024.0
+
+
+def _child_env():
+	# make sure the children import the same gitissuebot as we do
+	env = dict(os.environ)
+	source = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	env["PYTHONPATH"] = os.pathsep.join(filter(None, [source, env.get("PYTHONPATH")]))
+	return env
+
+
+def _run_child(scenario, size, latency, debug=False):
+	handle, result_file = tempfile.mkstemp(suffix=".json")
+	os.close(handle)
+	try:
+		with open(os.devnull, "w") as devnull:
+			subprocess.check_call([sys.executable, "-m", "gitissuebot.benchmark", "--run-scenario", scenario, str(size),
+			                       "--latency", str(latency), "--result", result_file],
+			                      env=_child_env(), stdout=None if debug else devnull)
+		with open(result_file, "r") as f:
+			return json.load(f)
+	finally:
+		os.remove(result_file)
+
+
+def measure_import_time(repeat=5):
+	"""
+	:return: the fastest of ``repeat`` measurements of the time a fresh interpreter needs to import gitissuebot
+	"""
+
+	code = "import time; start = time.time(); import gitissuebot; print(time.time() - start)"
+	return min(float(subprocess.check_output([sys.executable, "-c", code], env=_child_env())) for _ in range(repeat))
+
+
+def benchmark(scenarios=SCENARIOS, sizes=SIZES, repeat=3, latency=0.0, debug=False):
+	"""
+	Runs each scenario at each size ``repeat`` times, each in a fresh process.
+
+	:return: dict of the fastest run's metrics per ``<scenario>/<size>``
+	"""
+
+	results = collections.OrderedDict()
+	for scenario in scenarios:
+		for size in sizes:
+			runs = [_run_child(scenario, size, latency, debug=debug) for _ in range(repeat)]
+			result = min(runs, key=lambda x: x["wall_time"])
+			results["{scenario}/{size}".format(scenario=scenario, size=size)] = result
+			logger.info("%-16s %8.3fs, %6d requests (%.3f per issue), peak RSS %s" % ("{}/{}".format(scenario, size), result["wall_time"], result["requests"], result["requests_per_issue"], "{:.1f}MB".format(result["peak_rss"]) if result["peak_rss"] is not None else "n/a"))
+	return results
+
+
+def report_scaling(results):
+	"""
+	Logs how the wall time per issue develops with the size of the repository for each scenario.
+	"""
+
+	by_scenario = collections.OrderedDict()
+	for key, result in results.items():
+		scenario, size = key.rsplit("/", 1)
+		by_scenario.setdefault(scenario, []).append((int(size), result["wall_time"]))
+
+	for scenario, timings in by_scenario.items():
+		timings.sort()
+		per_issue = map(lambda x: x[1] / x[0], timings)
+		logger.info("Scaling of %s: %s" % (scenario, ", ".join(map(lambda x: "{:.3f}ms/issue at {}".format(x[1] * 1000, x[0][0]), zip(timings, per_issue)))))
+		if len(timings) < 2:
+			continue
+
+		# times below the noise floor can't be told apart, so the smallest size's time per issue is compared as if it
+		# had taken at least that long - a tiny run finishing in next to no time doesn't make the others look slow
+		baseline = max(timings[0][1], NOISE["wall_time"]) / timings[0][0]
+		if per_issue[-1] > SCALING_FACTOR * baseline:
+			logger.warn("%s scales non-linearly: %.1fx the time per issue at %d issues than at %d" % (scenario, per_issue[-1] / baseline, timings[-1][0], timings[0][0]))
+
+
+##~~ history
+
+
+def load_history(path):
+	if not os.path.isfile(path):
+		return dict(version=HISTORY_VERSION, runs=[])
+
+	with open(path, "r") as f:
+		history = json.load(f)
+	if history.get("version") != HISTORY_VERSION:
+		raise ValueError("{path} is not a benchmark history of version {version}".format(path=path, version=HISTORY_VERSION))
+	return history
+
+
+def save_history(path, history):
+	tmpfilename = path + ".tmp"
+	with open(tmpfilename, "w") as f:
+		json.dump(history, f, indent=2)
+	os.rename(tmpfilename, path)
+
+
+def find_baseline(history, name=None):
+	"""
+	:param name: name of the run to compare against, None for the most recent run without regressions
+	:return: the baseline run, None if there is none
+	"""
+
+	for run in reversed(history["runs"]):
+		if (name is None and not run["regressions"]) or (name is not None and run["name"] == name):
+			return run
+	return None
+
+
+def compare(run, baseline, tolerances=None):
+	"""
+	Compares the metrics of ``run`` to those of ``baseline``.
+
+	:param tolerances: allowed relative increase per metric, defaults to ``TOLERANCES``
+	:return: list of the regressions found
+	"""
+
+	if tolerances is None:
+		tolerances = TOLERANCES
+
+	regressions = []
+
+	def check(key, metric, current, previous):
+		if current is None or previous is None:
+			return
+
+		change = "{:+.1f}%".format((current - previous) * 100.0 / previous) if previous else "n/a"
+		if current > previous * (1 + tolerances.get(metric, TOLERANCES[metric])) and current - previous > NOISE[metric]:
+			regressions.append("{key} {metric}".format(key=key, metric=metric))
+			logger.warn("%-16s %-18s %10.3f -> %10.3f (%s) REGRESSION" % (key, metric, previous, current, change))
+		else:
+			logger.info("%-16s %-18s %10.3f -> %10.3f (%s)" % (key, metric, previous, current, change))
+
+	check("import", "import_time", run["import_time"], baseline["import_time"])
+	for key, result in run["results"].items():
+		if not key in baseline["results"]:
+			continue
+		for metric in METRICS:
+			check(key, metric, result[metric], baseline["results"][key][metric])
+
+	return regressions
+
+
+##~~ CLI
+
+
+def main(args=None):
+	if args is None:
+		# parse CLI arguments
+		parser = argparser()
+		args = parser.parse_args()
+
+	# if only version is to be printed, do so and exit
+	if args.version:
+		print_version()
+
+	# run a single scenario in this process, on behalf of the benchmark running in the parent process
+	if args.run_scenario:
+		scenario, size = args.run_scenario
+		result = run_scenario(scenario, int(size), latency=args.latency)
+		with open(args.result, "w") as f:
+			json.dump(result, f)
+		return
+
+	setup_logging(debug=args.debug)
+
+	scenarios = filter(lambda x: len(x) > 0, map(str.strip, args.scenarios.split(",")))
+	for scenario in scenarios:
+		if not scenario in SCENARIOS:
+			logger.error("Unknown scenario %s, must be one of %s" % (scenario, ", ".join(SCENARIOS)))
+			sys.exit(-1)
+	sizes = map(int, filter(lambda x: len(x) > 0, map(str.strip, args.sizes.split(","))))
+
+	tolerances = dict(TOLERANCES)
+	for tolerance in args.tolerances or []:
+		metric, _, value = tolerance.partition("=")
+		if not metric in TOLERANCES:
+			logger.error("Unknown metric %s, must be one of %s" % (metric, ", ".join(sorted(TOLERANCES))))
+			sys.exit(-1)
+		tolerances[metric] = float(value)
+
+	try:
+		history = load_history(args.history)
+	except ValueError as e:
+		logger.error(str(e))
+		sys.exit(-1)
+
+	baseline = find_baseline(history, name=args.baseline)
+	if args.baseline is not None and baseline is None:
+		logger.error("There is no run named %s in %s" % (args.baseline, args.history))
+		sys.exit(-1)
+
+	from gitissuebot import __version__
+	run = dict(name=args.name or __version__, version=__version__, python=platform.python_version(),
+	           timestamp=datetime.datetime.utcnow().isoformat() + "Z", latency=args.latency, repeat=args.repeat)
+
+	run["import_time"] = measure_import_time()
+	logger.info("Import of gitissuebot takes %.3fs" % run["import_time"])
+	run["results"] = benchmark(scenarios=scenarios, sizes=sizes, repeat=args.repeat, latency=args.latency, debug=args.debug)
+	report_scaling(run["results"])
+
+	regressions = []
+	if baseline is not None:
+		logger.info("Comparing to %s from %s" % (baseline["name"], baseline["timestamp"]))
+		if baseline["latency"] != run["latency"]:
+			logger.warn("%s was run with a latency of %ss instead of %ss, timings aren't comparable" % (baseline["name"], baseline["latency"], run["latency"]))
+		regressions = compare(run, baseline, tolerances=tolerances)
+	run["regressions"] = regressions
+
+	if not args.dryrun:
+		history["runs"].append(run)
+		save_history(args.history, history)
+		logger.info("Added run %s to %s" % (run["name"], args.history))
+
+	if regressions:
+		logger.error("%d regression(s) compared to %s: %s" % (len(regressions), baseline["name"], ", ".join(regressions)))
+		sys.exit(1)
+
+def argparser(parser=None):
+	import argparse
+	if parser is None:
+		parser = argparse.ArgumentParser(prog="gitissuebot-benchmark")
+
+	# prepare CLI argument parser
+	parser.add_argument("-s", "--scenarios", action="store", dest="scenarios", default=",".join(SCENARIOS),
+	                    help="Comma-separated list of the scenarios to run, defaults to all of " + ", ".join(SCENARIOS))
+	parser.add_argument("--sizes", action="store", dest="sizes", default=",".join(map(str, SIZES)),
+	                    help="Comma-separated list of the numbers of issues of the synthetic repositories to run the scenarios against, defaults to " + ",".join(map(str, SIZES)))
+	parser.add_argument("--repeat", action="store", dest="repeat", type=int, default=3,
+	                    help="Number of times to run each scenario, the fastest run counts. Defaults to 3")
+	parser.add_argument("--latency", action="store", dest="latency", type=float, default=0.0,
+	                    help="Seconds to wait before answering each request, to simulate the API's latency. Defaults to 0")
+	parser.add_argument("--history", action="store", dest="history", default="benchmarks.json",
+	                    help="File to keep the results of all runs in, defaults to benchmarks.json")
+	parser.add_argument("-n", "--name", action="store", dest="name",
+	                    help="Name of the run in the history, defaults to the version")
+	parser.add_argument("-b", "--baseline", action="store", dest="baseline",
+	                    help="Name of the run to compare against, defaults to the most recent run without regressions")
+	parser.add_argument("--tolerance", action="append", dest="tolerances", metavar="METRIC=FRACTION",
+	                    help="Allowed relative increase of a metric before it counts as a regression, may be given multiple times. Defaults to " + ", ".join(map(lambda x: "{}={}".format(*x), sorted(TOLERANCES.items()))))
+	parser.add_argument("--dry-run", action="store_true", dest="dryrun",
+	                    help="Only compare, don't add the run to the history")
+	parser.add_argument("-v", "--version", action="store_true", dest="version",
+	                    help="Print the version and exit")
+	parser.add_argument("--debug", action="store_true", dest="debug",
+	                    help="Enable debug logging and show the output of the scenarios")
+
+	parser.add_argument("--run-scenario", action="store", dest="run_scenario", nargs=2, help=argparse.SUPPRESS)
+	parser.add_argument("--result", action="store", dest="result", help=argparse.SUPPRESS)
+
+	return parser
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,138 @@
+# coding=utf-8
+from __future__ import print_function, absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
+
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# the currently active budget, None if the run is not limited
+_budget = None
+
+
+class Budget(object):
+	"""
+	Runtime and request budget of a run.
+
+	The budget is only checked between the processing of two entries, so a run may overshoot it by the time and
+	requests needed for a single entry.
+
+	:param max_runtime:  maximum runtime of the run in seconds, None for no limit
+	:param max_requests: maximum number of API requests of the run, None for no limit
+	"""
+
+	def __init__(self, max_runtime=None, max_requests=None):
+		self.max_runtime = max_runtime
+		self.max_requests = max_requests
+
+		self.started = time.time()
+		self.requests = 0
+		self.reason = None
+		self.deferred = []
+
+	def exhausted(self):
+		"""
+		:return: the reason why the budget is exhausted, None if it isn't
+		"""
+
+		if self.reason is None:
+			if self.max_runtime is not None and time.time() - self.started >= self.max_runtime:
+				self.reason = "runtime of {max_runtime}s exceeded".format(max_runtime=self.max_runtime)
+			elif self.max_requests is not None and self.requests >= self.max_requests:
+				self.reason = "{max_requests} requests exceeded".format(max_requests=self.max_requests)
+		return self.reason
+
+	def defer(self, category, description, since=None):
+		self.deferred.append(dict(category=category, description=description, since=since))
+
+
+def enable(max_runtime=None, max_requests=None):
+	"""
+	Limits the rest of the run to the given budget. Does nothing if neither limit is given.
+
+	:param max_runtime:  maximum runtime of the run in seconds
+	:param max_requests: maximum number of API requests of the run
+	"""
+
+	global _budget
+	if max_runtime is None and max_requests is None:
+		_budget = None
+	else:
+		_budget = Budget(max_runtime=max_runtime, max_requests=max_requests)
+
+
+def enabled():
+	return _budget is not None
+
+
+def count_request():
+	"""
+	Counts an API request against the budget, to be called for every request.
+	"""
+
+	if _budget is not None:
+		_budget.requests += 1
+
+
+def within_budget(entries, deferral=None):
+	"""
+	Iterates over the entries until the budget is exhausted and defers the remaining ones to the next run.
+
+	:param entries:  the entries to iterate over, ideally ordered by priority
+	:param deferral: function returning a tuple of category, description and the ``since`` needed by the next run to
+	                 pick the entry up again for each deferred entry. If None, the remaining entries are not enumerated
+	                 (e.g. to not fetch any more pages of a lazy listing) and a single placeholder is deferred instead
+	:return: generator over the entries within budget
+	"""
+
+	entries = iter(entries)
+	for entry in entries:
+		if _budget is not None and _budget.exhausted():
+			if deferral is None:
+				_budget.defer("listing", "remainder of the listing")
+			else:
+				for deferred in [entry] + list(entries):
+					_budget.defer(*deferral(deferred))
+			return
+		yield entry
+
+
+def deferred():
+	"""
+	:return: whether entries were deferred to the next run
+	"""
+
+	return _budget is not None and len(_budget.deferred) > 0
+
+
+def deferred_since(since):
+	"""
+	:param since: the ``since`` to save for the next run if nothing was deferred
+	:return: the ``since`` to save for the next run so that it picks up all deferred entries again
+	"""
+
+	if _budget is None:
+		return since
+	return min([since] + [x["since"] for x in _budget.deferred if x["since"] is not None])
+
+
+def report():
+	"""
+	Logs the requests and runtime used and the entries deferred to the next run, if the run is limited.
+	"""
+
+	if _budget is None:
+		return
+
+	logger.info("Budget: %d requests, %.1fs runtime used" % (_budget.requests, time.time() - _budget.started))
+	if not _budget.deferred:
+		return
+
+	logger.info("Budget exhausted (%s), deferred %d entries to the next run:" % (_budget.reason, len(_budget.deferred)))
+	for deferred in _budget.deferred:
+		logger.info(u"... %s: %s" % (deferred["category"], deferred["description"]))
@@ -0,0 +1,239 @@
+# coding=utf-8
+from __future__ import print_function, absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
+
+import collections
+import datetime
+import gzip
+import io
+import json
+import re
+import threading
+import time
+import urllib
+import requests
+import requests.structures
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# cassette format version
+VERSION = 1
+
+# response headers worth keeping, everything else is dropped to keep cassettes small
+RECORDED_HEADERS = ("Content-Type", "ETag", "Link", "Retry-After", "X-RateLimit-Limit", "X-RateLimit-Remaining",
+                    "X-RateLimit-Reset")
+
+# timestamps in URLs depend on when the run happened, e.g. approve's grace period cutoff
+TIMESTAMP_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(\.\d+)?(Z|[+-]\d{2}:?\d{2})?")
+
+# replacement for tokens found anywhere in a recorded interaction
+SCRUBBED = "<scrubbed>"
+
+
+# the cassette requests go to, None if they go to the API
+_cassette = None
+
+
+class Recorder(object):
+	"""
+	Performs requests against the API, recording each request and its response and latency.
+
+	Request headers aren't recorded and the tokens of the requests are scrubbed from everything that is.
+
+	:param path: the cassette file to write
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.interactions = []
+		self._secrets = set()
+		self._lock = threading.Lock()
+
+	def request(self, method, url, headers=None, **kwargs):
+		kwargs.pop("stream", None)
+
+		start = time.time()
+		r = requests.request(method, url, headers=headers, **kwargs)
+		latency = time.time() - start
+
+		secrets = _tokens(headers)
+		interaction = dict(method=method.upper(), url=url, body=kwargs.get("data"), status=r.status_code,
+		                   headers=dict((key, r.headers[key]) for key in RECORDED_HEADERS if key in r.headers),
+		                   response=r.content.decode("utf-8"), latency=round(latency, 4))
+		with self._lock:
+			self._secrets.update(secrets)
+			self.interactions.append(interaction)
+
+		return response(interaction)
+
+	def finish(self):
+		with self._lock:
+			interactions = map(lambda x: self._scrub(x), self.interactions)
+
+		with gzip.open(self.path, "wb") as f:
+			f.write(json.dumps(dict(version=VERSION, recorded=datetime.datetime.utcnow().isoformat() + "Z")) + "\n")
+			for interaction in interactions:
+				f.write(json.dumps(interaction, separators=(",", ":")) + "\n")
+
+		logger.info("Recorded %d requests (%.2fs total latency) to %s" % (len(interactions), sum(map(lambda x: x["latency"], interactions)), self.path))
+
+	def _scrub(self, value):
+		if isinstance(value, dict):
+			return dict((key, self._scrub(v)) for key, v in value.items())
+		if isinstance(value, basestring):
+			for secret in self._secrets:
+				value = value.replace(secret, SCRUBBED)
+		return value
+
+
+class Player(object):
+	"""
+	Answers requests from a cassette recorded by :class:`Recorder`, waiting for the recorded latency first.
+
+	Requests are matched by method and URL, with timestamps in the URL ignored. Repeated requests are answered in
+	the order they were recorded, the last recorded response is reused once they are exhausted. A write whose body
+	differs from the recorded one means the run decided differently than the recorded one and is logged.
+
+	:param path:          the cassette file to read
+	:param latency_scale: factor to apply to the recorded latencies, 0 to not wait at all
+	"""
+
+	def __init__(self, path, latency_scale=1.0):
+		self.path = path
+		self.latency_scale = latency_scale
+
+		self.requests = 0
+		self.waited = 0.0
+		self.missing = []
+		self.different = []
+
+		self._queues = collections.OrderedDict()
+		self._last = dict()
+		self._lock = threading.Lock()
+
+		with gzip.open(path, "rb") as f:
+			header = json.loads(f.readline())
+			if header.get("version") != VERSION:
+				raise ValueError("{path} is not a cassette of version {version}".format(path=path, version=VERSION))
+			for line in f:
+				interaction = json.loads(line)
+				self._queues.setdefault(_key(interaction["method"], interaction["url"]), collections.deque()).append(interaction)
+		self.recorded = header.get("recorded")
+
+	def request(self, method, url, headers=None, **kwargs):
+		key = _key(method, url)
+		with self._lock:
+			self.requests += 1
+			queue = self._queues.get(key)
+			if queue:
+				interaction = queue.popleft()
+				self._last[key] = interaction
+			else:
+				interaction = self._last.get(key)
+
+			if interaction is None:
+				self.missing.append("{method} {url}".format(method=method.upper(), url=url))
+			elif interaction["body"] != kwargs.get("data"):
+				self.different.append("{method} {url}".format(method=method.upper(), url=url))
+
+		if interaction is None:
+			logger.warn("%s %s is not in the cassette" % (method.upper(), url))
+			return response(dict(url=url, status=404, headers=dict(), response=json.dumps(dict(message="Not in cassette"))))
+
+		wait = interaction["latency"] * self.latency_scale
+		if wait > 0:
+			time.sleep(wait)
+		with self._lock:
+			self.waited += wait
+		return response(interaction)
+
+	def finish(self):
+		unused = sum(map(len, self._queues.values()))
+		logger.info("Replayed %d requests from %s recorded %s (%.2fs latency), %d not in cassette, %d recorded ones not replayed, %d writes differing" % (self.requests, self.path, self.recorded, self.waited, len(self.missing), unused, len(self.different)))
+
+		for request in self.different:
+			logger.warn("... %s differs from the recording" % request)
+		for queue in self._queues.values():
+			for interaction in queue:
+				if interaction["method"] != "GET":
+					logger.warn("... %s %s was recorded but not replayed" % (interaction["method"], interaction["url"]))
+
+
+def _key(method, url):
+	return method.upper(), TIMESTAMP_PATTERN.sub("<timestamp>", urllib.unquote(url))
+
+
+def _tokens(headers):
+	if not headers or not "Authorization" in headers:
+		return []
+	return filter(lambda x: len(x) > 0, headers["Authorization"].split(" ")[1:])
+
+
+def response(interaction):
+	"""
+	Builds a :class:`requests.Response` from a recorded ``interaction``, which needs at least its ``url``, ``status``,
+	``headers`` and ``response`` body.
+	"""
+
+	content = interaction["response"].encode("utf-8")
+
+	r = requests.Response()
+	r.status_code = interaction["status"]
+	r.url = interaction["url"]
+	r.encoding = "utf-8"
+	r.headers = requests.structures.CaseInsensitiveDict(interaction["headers"])
+	r.headers["Content-Length"] = str(len(content))
+	r._content = content
+	r.raw = io.BytesIO(content)
+	return r
+
+
+def record(path):
+	"""
+	Records all requests of the run and their responses to the cassette at ``path``.
+	"""
+
+	global _cassette
+	_cassette = Recorder(path)
+	logger.info("Recording requests to %s" % path)
+
+
+def replay(path, latency_scale=1.0):
+	"""
+	Answers all requests of the run from the cassette at ``path`` instead of the API.
+	"""
+
+	global _cassette
+	_cassette = Player(path, latency_scale=latency_scale)
+
+
+def serve(source):
+	"""
+	Answers all requests of the run via ``source``, which must provide ``request`` and ``finish`` like
+	:class:`Player`. Used for benchmarking against synthetic repositories.
+	"""
+
+	global _cassette
+	_cassette = source
+
+
+def active():
+	"""
+	:return: the cassette requests go to, None if they go to the API
+	"""
+
+	return _cassette
+
+
+def finish():
+	"""
+	Writes the recorded cassette or logs how the replay went.
+	"""
+
+	if _cassette is not None:
+		_cassette.finish()
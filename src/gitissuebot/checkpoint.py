@@ -0,0 +1,163 @@
+# coding=utf-8
+from __future__ import print_function, absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
+
+import datetime
+import json
+import os
+import dateutil.parser, dateutil.tz
+
+from .util import iter_pages
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Number of processed entries after which the checkpoint is saved even if the current page isn't done yet
+SAVE_INTERVAL = 25
+
+
+class Checkpoint(object):
+	"""
+	Progress of a run, persisted to a state file so that a crashed or aborted run can be resumed.
+
+	Tracks per listing the ids of the entries it contained when first listed and whether the listing is done, plus
+	the ids of all entries already processed. A checkpoint is only resumed if it was written for the same ``since``.
+
+	:param path:  the state file
+	:param since: the ``since`` the run is working with
+	"""
+
+	def __init__(self, path, since):
+		self.path = path
+		self.since = since
+		self.started = datetime.datetime.utcnow().replace(tzinfo=dateutil.tz.tzutc())
+		self.listings = dict()
+		self.processed = set()
+		self._unsaved = 0
+
+		# ids of the entries still to process per listing that was iterated completely
+		self._remaining = dict()
+
+		self._load()
+
+	def _load(self):
+		if not os.path.isfile(self.path):
+			return
+
+		try:
+			with open(self.path, "r") as f:
+				state = json.load(f)
+		except:
+			logger.exception("Could not read checkpoint from %s, starting from scratch" % self.path)
+			return
+
+		if dateutil.parser.parse(state["since"]) != self.since:
+			logger.info("Checkpoint in %s was written for a different since, starting from scratch" % self.path)
+			return
+
+		self.started = dateutil.parser.parse(state["started"])
+		self.listings = state["listings"]
+		self.processed = set(state["processed"])
+		logger.info("Resuming run started %s from checkpoint, %d entries already processed" % (self.started.isoformat(), len(self.processed)))
+
+	def save(self):
+		state = dict(since=self.since.isoformat(),
+		             started=self.started.isoformat(),
+		             listings=self.listings,
+		             processed=sorted(self.processed))
+
+		tmpfilename = self.path + ".tmp"
+		with open(tmpfilename, "w") as f:
+			json.dump(state, f)
+		os.rename(tmpfilename, self.path)
+		self._unsaved = 0
+
+	def clear(self):
+		"""
+		Removes the state file, to be called once the run completed successfully.
+		"""
+
+		if os.path.isfile(self.path):
+			os.remove(self.path)
+
+	def is_processed(self, entry_id):
+		return entry_id in self.processed
+
+	def mark_processed(self, entry_id):
+		self.processed.add(entry_id)
+		for name, remaining in self._remaining.items():
+			remaining.discard(entry_id)
+			if not remaining:
+				# the last entry of an iterated listing was processed after the iteration ended
+				self.listings[name]["done"] = True
+				del self._remaining[name]
+		self._unsaved += 1
+		if self._unsaved >= SAVE_INTERVAL:
+			self.save()
+
+	@property
+	def complete(self):
+		"""Whether all listings were iterated and all their entries processed."""
+		return all(map(lambda listing: listing["done"], self.listings.values()))
+
+	def iterate(self, name, headers, url, entry_filter=None, stop=None, fields=None):
+		"""
+		Iterates over the entries of the listing ``url``, resuming from the checkpoint if possible.
+
+		The listing is read completely before the first entry is yielded and its entry ids are saved to the
+		checkpoint, so that issues dropping out of the listing while the run labels or closes them can't shift
+		unprocessed entries onto pages already done. A resumed listing is read again and restricted to the saved
+		ids, entries which dropped out of it in the meantime no longer need processing.
+
+		Entries already processed are skipped, the caller has to mark entries as processed via
+		:meth:`mark_processed` once it is done with them. That may also happen after the iteration ended, e.g. once a
+		batch of writes went through, the listing is done once all its entries are marked.
+
+		:param name:         name of the listing in the checkpoint
+		:param headers:      headers to use for requests against API
+		:param url:          URL of the listing's first page
+		:param entry_filter: filter to apply, defaults to no filter
+		:param stop:         optional predicate, the listing is considered complete at the first entry matching it
+		:param fields:       fields to project the entries onto, see :data:`gitissuebot.util.ISSUE_FIELDS`
+		:return: generator over the entries still to process
+		"""
+
+		listing = self.listings.setdefault(name, dict(done=False))
+		if listing["done"]:
+			return
+
+		entries = []
+		for page, _ in iter_pages(headers, url, fields=fields):
+			stopped = False
+			for entry in page:
+				if stop is not None and stop(entry):
+					stopped = True
+					break
+				if entry_filter is not None and not entry_filter(entry):
+					continue
+				entries.append(entry)
+			if stopped:
+				break
+
+		if "ids" in listing:
+			snapshot = set(listing["ids"])
+			entries = filter(lambda x: x["id"] in snapshot, entries)
+		else:
+			listing["ids"] = map(lambda x: x["id"], entries)
+			self.save()
+
+		for entry in entries:
+			if self.is_processed(entry["id"]):
+				continue
+			yield entry
+
+		remaining = set(entry["id"] for entry in entries if not self.is_processed(entry["id"]))
+		if remaining:
+			self._remaining[name] = remaining
+		else:
+			listing["done"] = True
+		self.save()
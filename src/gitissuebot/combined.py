@@ -0,0 +1,296 @@
+# coding=utf-8
+from __future__ import print_function, absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
+
+import sys
+import datetime
+import dateutil.parser, dateutil.tz
+
+from . import approve, autolabel, prcheck
+from .util import get_issues, get_prs, get_repo_comments, load_config, update_config, convert_to_internal, convert_to_internal_pr, \
+    no_pullrequests, print_version, auth_headers, get_issue, defer_label_writes, flush_labels, \
+    add_common_arguments, merge_common_arguments, apply_common_defaults, run_bot
+from . import profiling, budget, actions, mirror, sharding, logs, tracing
+from .profiling import phase
+from .leases import LeaseLost
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# config sections holding the configuration of the individual bots
+SECTIONS = ("approve", "autolabel", "prcheck")
+
+
+##~~ process issues and PRs
+
+
+def run_all(config, file=None, dryrun=False):
+	"""
+	Runs all configured bots over a single listing of the repository's issues and PRs.
+
+	Issues are passed to autolabel and approve, PRs to prcheck. Label changes by several bots on the same item are
+	merged into a single write.
+
+	:param config: the combined config, the bot configs are expected in ``config["bots"]``
+	:param file: the config file to update with the date of this run
+	:param dryrun: whether to only simulate the writing API calls
+	:return: the ``since`` to continue from in the next pass
+	"""
+
+	# anything created or updated from now on is left to the next run - or from the last sync on, if reading from
+	# the mirror
+	started = mirror.current_as_of(datetime.datetime.utcnow().replace(tzinfo=dateutil.tz.tzutc()))
+
+	if dryrun:
+		logger.info("THIS IS A DRYRUN")
+
+	bots = config["bots"]
+	for bot_config in bots.values():
+		# a follow-up pass moves on the shared since
+		bot_config["since"] = config["since"]
+
+	# prepare headers
+	headers = auth_headers(config["token"], repo=config["repo"])
+
+	# retry what failed during earlier runs
+	if config["dead_letters"] is not None:
+		actions.replay(config["dead_letters"], headers, dryrun=dryrun)
+
+	since = config["since"]
+	approve_run = None
+	if "approve" in bots:
+		approve_run = approve.prepare_run(bots["approve"], headers)
+		since = min(since, approve_run["since"])
+
+	# retrieve all issues and PRs to process in one go
+	logger.info("Fetching all issues and PRs since %s" % since.isoformat())
+	entries = get_issues(config["token"], config["repo"], since=since)
+
+	if approve_run is not None:
+		known = set(map(lambda x: x["number"], entries))
+		entries += approve.get_due_issues(bots["approve"], headers, approve_run, known=known)
+
+	issues = []
+	pr_labels = dict()
+	with phase("conversion"):
+		for entry in entries:
+			if no_pullrequests(entry):
+				issues.append(convert_to_internal(entry))
+			else:
+				pr_labels[entry["number"]] = map(lambda x: x["name"], entry["labels"])
+
+	# leave the issues other workers are responsible for to them
+	if approve_run is not None:
+		issues = list(sharding.owned(issues, skipped=lambda x: approve.forget_closing(x, approve_run)))
+	else:
+		issues = filter(sharding.owns, issues)
+	logger.info("Found %d issues and %d PRs to process..." % (len(issues), len(pr_labels)))
+
+	if approve_run is not None and bots["approve"]["comment_stream"]:
+		logger.info("Fetching all comments since %s" % since.isoformat())
+		approve_run["comment_index"] = get_repo_comments(config["token"], config["repo"], since)
+
+	mappings = autolabel.prepare_mappings(bots["autolabel"]) if "autolabel" in bots else None
+
+	if approve_run is not None:
+		deferral = approve.issue_deferral(bots["approve"], approve_run)
+		if budget.enabled():
+			issues = sorted(issues, key=lambda x: approve.issue_priority(x, bots["approve"], approve_run))
+	else:
+		deferral = autolabel.issue_deferral
+		if budget.enabled():
+			issues = sorted(issues, key=lambda x: (x["created"] < since, x["updated"]))
+
+	actions.start()
+	for issue in budget.within_budget(issues, deferral=deferral):
+		with logs.entry(issue["number"]), tracing.span("issue", number=issue["number"]):
+			logger.info(u"Processing \"%s\" by %s (created %s, last updated %s)", issue["title"], issue["author"], issue["created_str"], issue["updated_str"])
+
+			defer_label_writes(issue)
+			try:
+				# autolabel first, so that approve already sees the labels derived from the title
+				if mappings is not None and issue["updated"] >= bots["autolabel"]["since"]:
+					autolabel.process_issue(issue, headers, bots["autolabel"], mappings, dryrun=dryrun)
+
+				if approve_run is not None:
+					approve_config = bots["approve"]
+					labeled = "label" in approve_config and approve_config["label"] and approve_config["label"] in issue["labels"]
+					if labeled or issue["created"] >= approve_config["since"]:
+						approve.process_issue(issue, headers, approve_config, approve_run, dryrun=dryrun)
+			except LeaseLost:
+				raise
+			except:
+				logger.exception("Exception while processing issue")
+			finally:
+				flush_labels(issue, headers, dryrun=dryrun)
+
+	if approve_run is not None:
+		logger.info("Comment scan: %s" % approve_run["comment_stats"])
+
+	if "prcheck" in bots:
+		prcheck_config = bots["prcheck"]
+
+		logger.info("Fetching all PRs created since %s" % prcheck_config["since"].isoformat())
+		prs = get_prs(config["token"], config["repo"], converter=convert_to_internal_pr, created_after=prcheck_config["since"])
+		prs = filter(sharding.owns, prs)
+		logger.info("Found %d PRs to process..." % len(prs))
+
+		if budget.enabled():
+			prs = sorted(prs, key=lambda x: x["created"])
+
+		for pr in budget.within_budget(prs, deferral=prcheck.pr_deferral):
+			with logs.entry(pr["number"]), tracing.span("pr", number=pr["number"]):
+				logger.info(u"Processing \"%s\" by %s (created %s, last updated %s)", pr["title"], pr["author"], pr["created_str"], pr["updated_str"])
+
+				try:
+					if pr["number"] in pr_labels:
+						pr["labels"] = pr_labels[pr["number"]]
+					else:
+						# not part of the issue listing, look it up
+						pr["labels"] = convert_to_internal(get_issue(headers, pr["issue_url"]))["labels"]
+
+					defer_label_writes(pr)
+					prcheck.process_pr(pr, headers, prcheck_config, dryrun=dryrun)
+				except LeaseLost:
+					raise
+				except:
+					logger.exception("Exception while processing PR")
+				finally:
+					flush_labels(pr, headers, dryrun=dryrun)
+
+	# execute the plan
+	actions.flush(headers, dryrun=dryrun)
+	actions.finish(dump=config["plan"], dead_letters=config["dead_letters"])
+
+	if approve_run is not None and not dryrun:
+		approve.save_deadlines(approve_run, complete=not budget.deferred())
+
+	# the next run starts where this one started - or at the date needed to pick up everything we didn't get to again
+	since = budget.deferred_since(started)
+	if file is not None and not dryrun:
+		# we are using a config file, so we save it for the next run
+		update_config(file, since=since)
+
+	return since
+
+
+##~~ config handling
+
+
+def validate_config(config):
+	"""
+	Makes sure the given config is valid, splitting it into the configs of the individual bots (which will be
+	validated by the bots' own ``validate_config``) and exiting the application if mandatory parameters are not given.
+
+	Each bot is configured by a section named like it, all other top level values are shared by all bots.
+
+	:param config: the config to validate
+	"""
+
+	# check for mandatory values
+	if not "token" in config or not config["token"]:
+		logger.error("Token must be defined")
+		sys.exit(-1)
+	if not "repo" in config or not config["repo"]:
+		logger.error("Repo must be defined")
+		sys.exit(-1)
+	if isinstance(config["token"], basestring) and "," in config["token"]:
+		config["token"] = filter(lambda x: len(x) > 0, map(str.strip, str(config["token"]).split(",")))
+	if not any(map(lambda section: section in config and config[section], SECTIONS)):
+		logger.error("At least one of {sections} must be configured".format(sections=", ".join(SECTIONS)))
+		sys.exit(-1)
+
+	if not "since" in config or not config["since"]:
+		config["since"] = datetime.datetime.utcnow()
+	apply_common_defaults(config, "combined", bots=[section for section in SECTIONS if section in config and config[section]])
+
+	# sanitizing
+	if config["since"].tzinfo is None:
+		config["since"] = config["since"].replace(tzinfo=dateutil.tz.tzutc())
+
+	shared = dict((key, value) for key, value in config.items() if not key in SECTIONS)
+
+	bots = dict()
+	for name, module in (("approve", approve), ("autolabel", autolabel), ("prcheck", prcheck)):
+		if not name in config or not config[name]:
+			continue
+
+		bot_config = dict(shared)
+		bot_config.update(config[name])
+		bot_config["since"] = config["since"]
+		module.validate_config(bot_config)
+		bots[name] = bot_config
+
+	if "approve" in bots:
+		# the shared listing covers everything approve would list itself, so its own ways of listing don't apply
+		approve_config = bots["approve"]
+		if approve_config["search"]:
+			logger.warn("The search isn't used in a combined run, which lists all issues and PRs updated since the last run anyway, ignoring it")
+			approve_config["search"] = False
+		if approve_config["checkpoint"]:
+			logger.warn("Checkpoints aren't supported in a combined run, the shared listing isn't checkpointed, ignoring {checkpoint}".format(checkpoint=approve_config["checkpoint"]))
+			approve_config["checkpoint"] = None
+
+	config["bots"] = bots
+
+
+##~~ CLI
+
+
+def main(args=None):
+	if args is None:
+		# parse CLI arguments
+		parser = argparser()
+		args = parser.parse_args()
+
+	# if only version is to be printed, do so and exit
+	if args.version:
+		print_version()
+
+	# enable profiling if requested
+	if args.profile:
+		profiling.enable(args.profile)
+
+	# merge config (if given) and CLI parameters
+	config = load_config(args.config)
+	if args.token is not None:
+		config["token"] = args.token
+	if args.repo is not None:
+		config["repo"] = args.repo
+	if args.since is not None:
+		config["since"] = args.since
+	if args.config is not None and not config.get("deadlines"):
+		config["deadlines"] = args.config + ".deadlines.json"
+	merge_common_arguments(config, args)
+
+	# validate the config
+	with phase("config"):
+		validate_config(config)
+
+	# process existing issues and PRs
+	run_bot("combined", config, args, run_all, bots=sorted(config["bots"].keys()))
+
+def argparser(parser=None):
+	if parser is None:
+		import argparse
+		parser = argparse.ArgumentParser(prog="gitissuebot-combined")
+
+	# prepare CLI argument parser
+	parser.add_argument("-c", "--config", action="store", dest="config",
+	                    help="The config file to use, must contain a section for each bot to run")
+	parser.add_argument("-t", "--token", action="store", dest="token",
+	                    help="The token to use, must be defined either on CLI or via config. Multiple comma-separated tokens may be given to spread the requests over")
+	parser.add_argument("-r", "--repo", action="store", dest="repo",
+	                    help="The github repository to use, must be defined either on CLI or via config")
+	parser.add_argument("-s", "--since", action="store", dest="since", type=dateutil.parser.parse,
+	                    help="Only process issues and PRs created or updated after this ISO8601 date time, defaults to now")
+	add_common_arguments(parser)
+
+	return parser
+
+if __name__ == "__main__":
+	main()
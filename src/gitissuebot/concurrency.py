@@ -0,0 +1,145 @@
+# coding=utf-8
+from __future__ import print_function, absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
+
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# factor by which the limit is cut when the API signals we are too fast
+DECREASE_FACTOR = 0.5
+
+# latency above this multiple of the average latency is considered a spike
+LATENCY_SPIKE_FACTOR = 3.0
+
+# latencies below this number of seconds are never considered a spike
+LATENCY_SPIKE_MIN = 1.0
+
+# weight of a new latency sample in the average latency
+LATENCY_SMOOTHING = 0.2
+
+# maximum number of seconds to pause all requests if the API asks us to back off
+MAX_PAUSE = 60
+
+
+class AdaptiveLimit(object):
+	"""
+	Limits the number of concurrent requests, adjusting the limit to what the API tolerates (AIMD).
+
+	The limit is increased additively by one per limit's worth of healthy responses and cut multiplicatively on
+	responses signaling that we are too fast (429, secondary rate limit 403s), errors or latency spikes. Cuts happen
+	at most once per average latency, so a burst of requests that were all in flight at the same time only counts once.
+
+	:param name:    name of the limit for reporting
+	:param initial: initial limit
+	:param maximum: maximum limit
+	:param minimum: minimum limit
+	"""
+
+	def __init__(self, name, initial, maximum, minimum=1):
+		self.name = name
+		self.minimum = minimum
+		self.maximum = maximum
+		self.limit = float(initial)
+
+		self.in_flight = 0
+		self.latency = None
+		self.paused_until = 0
+
+		self.requests = 0
+		self.increases = 0
+		self.decreases = 0
+		self.peak = int(self.limit)
+
+		self._last_decrease = 0
+		self._condition = threading.Condition()
+
+	def acquire(self):
+		with self._condition:
+			while True:
+				pause = self.paused_until - time.time()
+				if pause > 0:
+					self._condition.wait(pause)
+				elif self.in_flight >= int(self.limit):
+					self._condition.wait()
+				else:
+					break
+			self.in_flight += 1
+			self.requests += 1
+
+	def release(self, response=None, latency=None):
+		"""
+		Releases a slot and adjusts the limit based on the outcome of the request.
+
+		:param response: the response, None if the request failed without one
+		:param latency:  the request's latency in seconds
+		"""
+
+		with self._condition:
+			self.in_flight -= 1
+
+			if response is None or _throttled(response) or response.status_code >= 500:
+				self._decrease()
+				if response is not None and "Retry-After" in response.headers:
+					self.paused_until = time.time() + min(int(response.headers["Retry-After"]), MAX_PAUSE)
+			elif latency is not None and self.latency is not None and latency > max(LATENCY_SPIKE_FACTOR * self.latency, LATENCY_SPIKE_MIN):
+				self._decrease()
+			else:
+				if self.limit < self.maximum:
+					self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+					self.increases += 1
+					self.peak = max(self.peak, int(self.limit))
+				if latency is not None:
+					self.latency = latency if self.latency is None else (1 - LATENCY_SMOOTHING) * self.latency + LATENCY_SMOOTHING * latency
+
+			self._condition.notify_all()
+
+	def _decrease(self):
+		now = time.time()
+		if now - self._last_decrease < (self.latency or 0):
+			return
+
+		self.limit = max(self.minimum, self.limit * DECREASE_FACTOR)
+		self.decreases += 1
+		self._last_decrease = now
+		logger.debug("Cut %s concurrency to %d" % (self.name, int(self.limit)))
+
+	def __str__(self):
+		return "{name}: limit {limit} (peak {peak}, max {maximum}), {requests} requests, {increases} increases, {decreases} decreases, avg latency {latency}".format(
+			name=self.name, limit=int(self.limit), peak=self.peak, maximum=self.maximum, requests=self.requests,
+			increases=self.increases, decreases=self.decreases,
+			latency="{:.3f}s".format(self.latency) if self.latency is not None else "n/a")
+
+
+def _throttled(response):
+	if response.status_code == 429:
+		return True
+	if response.status_code == 403:
+		# secondary rate limits come with a Retry-After or at least say so, the primary limit isn't about concurrency
+		return "Retry-After" in response.headers or "secondary rate limit" in response.text
+	return False
+
+
+# writes are penalized more quickly by the secondary rate limits, so they get their own, smaller limit
+reads = AdaptiveLimit("reads", initial=4, maximum=8)
+writes = AdaptiveLimit("writes", initial=1, maximum=4)
+
+
+def limit_for(write=False):
+	return writes if write else reads
+
+
+def report():
+	"""
+	Logs the state of the concurrency controllers.
+	"""
+
+	for limit in (reads, writes):
+		if limit.requests:
+			logger.info("Concurrency %s" % limit)
@@ -0,0 +1,89 @@
+# coding=utf-8
+from __future__ import print_function, absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
+
+import heapq
+import json
+import os
+import dateutil.parser
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class DeadlineIndex(object):
+	"""
+	Close deadlines of issues, persisted to a file so that a run only needs to look at the issues that are due.
+
+	Deadlines are kept in a min-heap ordered by deadline. Rescheduling or removing an issue doesn't touch the heap,
+	outdated heap entries are skipped when they come up instead.
+
+	:param path: the index file
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.deadlines = dict()
+		self._heap = []
+
+		self.existed = self._load()
+
+	def _load(self):
+		if not os.path.isfile(self.path):
+			return False
+
+		try:
+			with open(self.path, "r") as f:
+				state = json.load(f)
+		except:
+			logger.exception("Could not read deadlines from %s, starting from scratch" % self.path)
+			return False
+
+		for number, deadline in state.items():
+			self.schedule(int(number), dateutil.parser.parse(deadline))
+		return True
+
+	def save(self):
+		state = dict((str(number), deadline.isoformat()) for number, deadline in self.deadlines.items())
+
+		tmpfilename = self.path + ".tmp"
+		with open(tmpfilename, "w") as f:
+			json.dump(state, f, indent=2, sort_keys=True)
+		os.rename(tmpfilename, self.path)
+
+	def schedule(self, number, deadline):
+		"""
+		Sets the close deadline of issue ``number``, replacing any earlier one.
+		"""
+
+		if self.deadlines.get(number) == deadline:
+			return
+		self.deadlines[number] = deadline
+		heapq.heappush(self._heap, (deadline, number))
+
+	def remove(self, number):
+		self.deadlines.pop(number, None)
+
+	def due(self, now):
+		"""
+		:param now: the current datetime
+		:return: the numbers of all issues whose deadline has passed, they stay in the index until removed or
+		         rescheduled
+		"""
+
+		result = []
+		while self._heap and self._heap[0][0] <= now:
+			deadline, number = heapq.heappop(self._heap)
+			if self.deadlines.get(number) == deadline:
+				result.append(number)
+
+		# keep the due ones around in case they aren't removed or rescheduled
+		for number in result:
+			heapq.heappush(self._heap, (self.deadlines[number], number))
+		return result
+
+	def __len__(self):
+		return len(self.deadlines)
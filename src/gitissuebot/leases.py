@@ -0,0 +1,268 @@
+# coding=utf-8
+from __future__ import print_function, absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
+
+import contextlib
+import socket
+import sqlite3
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# seconds a lease is valid without being renewed, the leader renews it every third of that
+LEASE_TTL = 30
+
+# seconds between checks of a standby instance whether the leader's lease lapsed
+STANDBY_POLL = 1
+
+SCHEMA = """
+create table if not exists leases (
+	name text primary key,
+	holder text,
+	generation integer not null default 0,
+	acquired real,
+	renewed real,
+	expires real,
+	released real,
+	handovers integer not null default 0,
+	failovers integer not null default 0,
+	last_failover real
+);
+"""
+
+
+# the leases held by this instance, empty if not coordinating
+_leases = []
+
+
+class LeaseLost(Exception):
+	pass
+
+
+class Lease(object):
+	"""
+	An expiring lease on ``name`` in a SQLite database shared by all instances, only the instance holding it is
+	active. The holder keeps renewing it in the background while it's running and releases it when done.
+
+	Every acquisition increments the lease's generation, and a renewal only succeeds for the generation it was
+	acquired with, so an instance that was too slow to renew can't take the lease back from its successor.
+
+	:param path:   the SQLite database file
+	:param name:   name of the lease, e.g. the bot and repository
+	:param holder: id of this instance
+	:param ttl:    seconds the lease is valid without being renewed
+	"""
+
+	def __init__(self, path, name, holder, ttl=LEASE_TTL):
+		self.path = path
+		self.name = name
+		self.holder = holder
+		self.ttl = ttl
+		self.generation = None
+		self.expires = None
+		self.lost = False
+
+		self._stop = threading.Event()
+		self._thread = None
+
+		with self._connect() as connection:
+			connection.executescript(SCHEMA)
+
+	def _connect(self):
+		connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+		connection.row_factory = sqlite3.Row
+		return contextlib.closing(connection)
+
+	def state(self):
+		with self._connect() as connection:
+			return connection.execute("select * from leases where name = ?", [self.name]).fetchone()
+
+	def try_acquire(self):
+		"""
+		Acquires the lease if nobody else holds it.
+
+		:return: True if the lease was acquired, False if another instance holds it
+		"""
+
+		return _try_acquire_all([self])
+
+	def _acquire(self, connection, now):
+		row = connection.execute("select * from leases where name = ?", [self.name]).fetchone()
+		if row is None:
+			connection.execute("insert into leases (name) values (?)", [self.name])
+			row = connection.execute("select * from leases where name = ?", [self.name]).fetchone()
+		elif row["holder"] is not None and row["holder"] != self.holder and row["released"] is None and row["expires"] > now:
+			return False
+
+		handovers = row["handovers"]
+		failovers = row["failovers"]
+		last_failover = row["last_failover"]
+		if row["holder"] is not None and row["holder"] != self.holder:
+			handovers += 1
+			if row["released"] is None:
+				# the previous holder didn't release the lease, it died or hung
+				failovers += 1
+				last_failover = now - row["renewed"]
+				logger.warn("Took over lease %s from %s, which stopped renewing it %.1fs ago" % (self.name, row["holder"], last_failover))
+
+		self.generation = row["generation"] + 1
+		self.expires = now + self.ttl
+		connection.execute("update leases set holder = ?, generation = ?, acquired = ?, renewed = ?, expires = ?, released = null, handovers = ?, failovers = ?, last_failover = ? where name = ?",
+		                   [self.holder, self.generation, now, now, now + self.ttl, handovers, failovers, last_failover, self.name])
+		return True
+
+	def renew(self):
+		now = time.time()
+		with self._connect() as connection:
+			cursor = connection.execute("update leases set renewed = ?, expires = ? where name = ? and holder = ? and generation = ? and released is null",
+			                            [now, now + self.ttl, self.name, self.holder, self.generation])
+			if cursor.rowcount != 1:
+				raise LeaseLost("Lost lease {name}".format(name=self.name))
+		self.expires = now + self.ttl
+
+	def release(self):
+		self._stop.set()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+
+		now = time.time()
+		with self._connect() as connection:
+			cursor = connection.execute("update leases set released = ?, expires = ? where name = ? and holder = ? and generation = ?",
+			                            [now, now, self.name, self.holder, self.generation])
+			return cursor.rowcount == 1
+
+	def keep_renewed(self):
+		"""
+		Renews the lease in the background until it's released, marking it as lost if that fails.
+		"""
+
+		def renew():
+			while not self._stop.wait(self.ttl / 3.0):
+				try:
+					self.renew()
+				except Exception as e:
+					logger.error("Could not renew lease %s: %s" % (self.name, e))
+					self.lost = True
+					return
+
+		self._thread = threading.Thread(target=renew, name="lease-renewal")
+		self._thread.daemon = True
+		self._thread.start()
+
+	def check(self):
+		"""
+		:raise LeaseLost: if the lease was lost or lapsed, another instance might be active already
+		"""
+
+		if self.lost or time.time() >= self.expires:
+			raise LeaseLost("Lost lease {name}, another instance might be active".format(name=self.name))
+
+	def metrics(self):
+		row = self.state()
+		return dict(holder=row["holder"], generation=row["generation"], handovers=row["handovers"],
+		            failovers=row["failovers"], last_failover=row["last_failover"])
+
+
+def acquire(path, names, holder=None, ttl=LEASE_TTL, standby=False):
+	"""
+	Makes this instance the active one for ``names``, if no other instance is for any of them.
+
+	:param path:    the SQLite database file shared by all instances
+	:param names:   name of the lease, e.g. the bot and repository, or a list of names to acquire all of at once, e.g.
+	                one per bot of a combined run
+	:param holder:  id of this instance, defaults to the host name
+	:param ttl:     seconds the leases are valid without being renewed
+	:param standby: whether to wait for the active instances' leases to lapse and take over then, instead of giving up
+	                right away. If the active instances finish their runs and release all the leases meanwhile, there's
+	                nothing left to do for this one
+	:return: True if this instance is the active one now
+	"""
+
+	global _leases
+
+	if holder is None:
+		holder = socket.gethostname()
+	if isinstance(names, basestring):
+		names = [names]
+
+	leases = [Lease(path, name, holder, ttl=ttl) for name in sorted(set(names))]
+	description = ", ".join(lease.name for lease in leases)
+	started = time.time()
+	while True:
+		states = [lease.state() for lease in leases]
+		if all(state is not None and state["holder"] != holder and state["released"] is not None and state["released"] >= started for state in states):
+			logger.info("%s finished its run for %s while standing by, nothing to do" % (", ".join(sorted(set(state["holder"] for state in states))), description))
+			return False
+
+		if _try_acquire_all(leases):
+			break
+
+		active = ", ".join(sorted(set(state["holder"] for state in [lease.state() for lease in leases] if state is not None and state["holder"] != holder and state["released"] is None)))
+		if not standby:
+			logger.info("%s is active for %s, nothing to do" % (active, description))
+			return False
+		logger.debug("Standing by while %s is active for %s" % (active, description))
+		time.sleep(STANDBY_POLL)
+
+	for lease in leases:
+		lease.keep_renewed()
+	_leases = leases
+
+	for lease in leases:
+		metrics = lease.metrics()
+		logger.info("Active for %s (lease generation %d, %d handovers, %d failovers%s)" % (lease.name, metrics["generation"], metrics["handovers"], metrics["failovers"], ", last one took {:.1f}s".format(metrics["last_failover"]) if metrics["last_failover"] is not None else ""))
+	return True
+
+
+def _try_acquire_all(leases):
+	"""
+	Acquires either all of ``leases`` or none of them, in one transaction.
+
+	:return: True if the leases were acquired, False if another instance holds any of them
+	"""
+
+	now = time.time()
+	with leases[0]._connect() as connection:
+		connection.execute("begin immediate")
+		try:
+			acquired = all(lease._acquire(connection, now) for lease in leases)
+		except:
+			connection.execute("rollback")
+			raise
+		connection.execute("commit" if acquired else "rollback")
+	return acquired
+
+
+def check():
+	"""
+	Makes sure this instance is still the active one, called before every request so that a run which lost a lease
+	stops before it writes anything another instance might be writing as well.
+
+	:raise LeaseLost: if this instance lost one of its leases
+	"""
+
+	for lease in _leases:
+		lease.check()
+
+
+def release():
+	"""
+	Releases the leases held by this instance, if any.
+	"""
+
+	global _leases
+
+	for lease in _leases:
+		try:
+			if lease.release():
+				logger.info("Released lease %s" % lease.name)
+		except:
+			logger.exception("Could not release lease %s" % lease.name)
+	_leases = []
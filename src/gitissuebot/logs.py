@@ -0,0 +1,194 @@
+# coding=utf-8
+from __future__ import print_function, absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
+
+import contextlib
+import datetime
+import json
+import logging
+import threading
+import time
+
+try:
+	import queue
+except ImportError:
+	# Python 2
+	import Queue as queue
+
+
+# records waiting to be written before further ones are dropped instead of blocking the run
+QUEUE_SIZE = 10000
+
+# fields of the records that are written to structured log lines if set
+FIELDS = ("repo", "issue", "decision", "duration", "requests")
+
+
+# whether structured logging is enabled
+_enabled = False
+
+# the repository of the run, added to every record
+_repo = None
+
+# only the info lines of every n-th issue or PR are logged
+_sample = 1
+
+# number of issues or PRs processed so far, for sampling
+_entries = 0
+
+# the issue or PR the current thread is processing
+_context = threading.local()
+
+
+class QueueHandler(logging.Handler):
+	"""
+	Hands records over to a background thread that passes them on to ``target``, so a slow log sink doesn't stall the
+	run. If the queue is full, records are dropped rather than waited for.
+
+	Messages are only formatted on the background thread, so the arguments of log calls must not be changed after
+	the call. Tracebacks are formatted right away though, since they refer to the stack at the time of the call.
+
+	:param target:  the handler to pass the records on to
+	:param maxsize: maximum number of records waiting to be written
+	"""
+
+	def __init__(self, target, maxsize=QUEUE_SIZE):
+		logging.Handler.__init__(self)
+		self.target = target
+		self.queue = queue.Queue(maxsize=maxsize)
+		self.dropped = 0
+
+		self._thread = threading.Thread(target=self._run, name="log-writer")
+		self._thread.daemon = True
+		self._thread.start()
+
+	def emit(self, record):
+		if record.exc_info:
+			record.exc_text = logging.Formatter().formatException(record.exc_info)
+			record.exc_info = None
+
+		try:
+			self.queue.put_nowait(record)
+		except queue.Full:
+			self.dropped += 1
+
+	def _run(self):
+		while True:
+			record = self.queue.get()
+			if record is None:
+				break
+			try:
+				self.target.handle(record)
+			except:
+				self.target.handleError(record)
+
+	def close(self):
+		if self._thread is not None:
+			self.queue.put(None)
+			self._thread.join()
+			self._thread = None
+
+			if self.dropped:
+				self.target.handle(logging.makeLogRecord(dict(name=__name__, levelno=logging.WARN, levelname="WARNING",
+				                                              msg="Dropped %d log records, the log couldn't keep up",
+				                                              args=(self.dropped,))))
+			self.target.flush()
+			self.target.close()
+		logging.Handler.close(self)
+
+
+class JsonFormatter(logging.Formatter):
+	"""
+	Formats records as one JSON object per line, with the fields in :data:`FIELDS` added where set.
+	"""
+
+	def format(self, record):
+		data = dict(time=datetime.datetime.utcfromtimestamp(record.created).isoformat() + "Z", level=record.levelname,
+		            logger=record.name, message=record.getMessage())
+		for field in FIELDS:
+			value = getattr(record, field, None)
+			if value is not None:
+				data[field] = value
+		if record.exc_text:
+			data["exception"] = record.exc_text
+		return json.dumps(data, sort_keys=True)
+
+
+class ContextFilter(logging.Filter):
+	"""
+	Adds the repository and the issue or PR being processed to the records, and drops the info lines of issues and
+	PRs that weren't sampled.
+	"""
+
+	def filter(self, record):
+		record.repo = _repo
+
+		entry = getattr(_context, "entry", None)
+		if entry is None:
+			return True
+
+		if getattr(record, "issue", None) is None:
+			record.issue = entry["number"]
+		record.duration = round(time.time() - entry["started"], 3)
+		record.requests = entry["requests"]
+		return entry["sampled"] or record.levelno > logging.INFO
+
+
+def handler(stream, repo=None, sample=None):
+	"""
+	Creates the handler for structured logging to ``stream`` and enables tracking of the issues and PRs being
+	processed for it.
+
+	:param stream: the stream to write to
+	:param repo:   the repository of the run
+	:param sample: only log the info lines of every n-th issue or PR, warnings and errors are always logged
+	:return: the handler
+	"""
+
+	global _enabled, _repo, _sample
+
+	_enabled = True
+	_repo = repo
+	_sample = sample if sample else 1
+
+	target = logging.StreamHandler(stream=stream)
+	target.setFormatter(JsonFormatter())
+
+	result = QueueHandler(target)
+	result.addFilter(ContextFilter())
+	return result
+
+
+@contextlib.contextmanager
+def entry(number):
+	"""
+	Marks the issue or PR ``number`` as being processed by the current thread, for adding it along with the time and
+	requests spent on it so far to all records logged meanwhile. Does nothing unless structured logging is enabled.
+	"""
+
+	global _entries
+
+	if not _enabled:
+		yield
+		return
+
+	sampled = _entries % _sample == 0
+	_entries += 1
+
+	_context.entry = dict(number=number, started=time.time(), requests=0, sampled=sampled)
+	try:
+		yield
+	finally:
+		_context.entry = None
+
+
+def count_request():
+	"""
+	Counts an API request against the issue or PR the current thread is processing, to be called for every request.
+	"""
+
+	entry = getattr(_context, "entry", None)
+	if entry is not None:
+		entry["requests"] += 1
@@ -0,0 +1,278 @@
+# coding=utf-8
+from __future__ import print_function, absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
+
+import json
+import sqlite3
+import threading
+import dateutil.parser, dateutil.tz
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# the mirror the bots read from, None if they read from the API
+_mirror = None
+
+SCHEMA = """
+create table if not exists issues (
+	number integer primary key,
+	id integer not null,
+	state text not null,
+	created_at text not null,
+	updated_at text not null,
+	data text not null
+);
+create index if not exists issues_updated on issues (updated_at);
+create index if not exists issues_created on issues (created_at);
+
+create table if not exists prs (
+	number integer primary key,
+	id integer not null,
+	state text not null,
+	created_at text not null,
+	updated_at text not null,
+	data text not null
+);
+
+create table if not exists comments (
+	id integer primary key,
+	issue_url text not null,
+	created_at text not null,
+	updated_at text not null,
+	data text not null
+);
+create index if not exists comments_issue on comments (issue_url, created_at);
+create index if not exists comments_updated on comments (updated_at);
+
+create table if not exists applied_comments (
+	id integer primary key,
+	issue_url text not null,
+	created_at text not null,
+	updated_at text not null,
+	data text not null
+);
+
+create table if not exists meta (
+	key text primary key,
+	value text
+);
+"""
+
+
+class Mirror(object):
+	"""
+	Local copy of a repository's issues (including their labels), PRs and comments, stored in SQLite.
+
+	Entries are stored as returned by the API (projected onto the fields the bots use), with the columns needed for
+	querying them extracted. Timestamps are kept in the API's ISO 8601 UTC format, so they compare correctly as
+	strings.
+
+	The bots' own writes are applied to the mirror as well, so that they see them before the next sync. That keeps
+	the entries' ``updated_at`` as synced and the bots' comments apart from the synced ones, so the next sync still
+	picks up everything changed since the last one.
+
+	:param path: the SQLite database file
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self._connection = sqlite3.connect(path, check_same_thread=False)
+		self._lock = threading.RLock()
+		with self._lock:
+			self._connection.executescript(SCHEMA)
+
+	@property
+	def repo(self):
+		return self.get_meta("repo")
+
+	@property
+	def synced(self):
+		"""
+		The start of the last sync, None if the mirror was never synced. Anything created or updated later might not
+		be mirrored yet.
+		"""
+
+		synced = self.get_meta("synced")
+		return dateutil.parser.parse(synced) if synced else None
+
+	##~~ reading
+
+	def issues(self, since=None, labels=None, creator=None, created_after=None, state="open"):
+		"""
+		Retrieves issues (and PRs, as the API's issue listing does), see :func:`gitissuebot.util.get_issues`.
+		"""
+
+		query = "select data from issues where state = ?"
+		params = [state]
+		if since is not None:
+			query += " and updated_at >= ?"
+			params.append(_to_iso(since))
+		if created_after is not None:
+			query += " and created_at >= ? order by created_at desc"
+			params.append(_to_iso(created_after))
+		else:
+			query += " order by created_at desc"
+
+		entries = self._select(query, params)
+		if labels:
+			entries = filter(lambda x: set(labels).issubset(set(map(lambda l: l["name"], x["labels"]))), entries)
+		if creator is not None:
+			entries = filter(lambda x: x["user"] is not None and x["user"]["login"] == creator, entries)
+		return entries
+
+	def issue(self, number):
+		entries = self._select("select data from issues where number = ?", [number])
+		return entries[0] if entries else None
+
+	def prs(self, created_after=None, state="open"):
+		"""
+		Retrieves PRs, see :func:`gitissuebot.util.get_prs`.
+		"""
+
+		if created_after is not None:
+			return self._select("select data from prs where state = ? and created_at >= ? order by created_at desc",
+			                    [state, _to_iso(created_after)])
+		return self._select("select data from prs where state = ? order by created_at desc", [state])
+
+	def comments(self, issue_url, since=None):
+		"""
+		Retrieves the comments on an issue or PR in order of creation, optionally only those created or updated since
+		``since``.
+		"""
+
+		query = "select data from ({comments}) where issue_url = ?".format(comments=ALL_COMMENTS)
+		params = [issue_url]
+		if since is not None:
+			query += " and updated_at >= ?"
+			params.append(_to_iso(since))
+		return self._select(query + " order by created_at, id", params)
+
+	def repo_comments(self, since):
+		return self._select("select data from ({comments}) where updated_at >= ? order by created_at, id".format(comments=ALL_COMMENTS),
+		                    [_to_iso(since)])
+
+	def latest(self, table):
+		"""
+		:return: the ``updated_at`` of the most recently updated entry in ``table``, None if it's empty
+		"""
+
+		with self._lock:
+			return self._connection.execute("select max(updated_at) from {table}".format(table=table)).fetchone()[0]
+
+	def get_meta(self, key):
+		with self._lock:
+			row = self._connection.execute("select value from meta where key = ?", [key]).fetchone()
+		return row[0] if row else None
+
+	def _select(self, query, params):
+		with self._lock:
+			return map(lambda row: json.loads(row[0]), self._connection.execute(query, params).fetchall())
+
+	##~~ writing
+
+	def store_issue(self, issue):
+		self._store("issues", issue["number"], issue["id"], issue["state"], issue["created_at"], issue["updated_at"], issue)
+
+	def store_pr(self, pr):
+		self._store("prs", pr["number"], pr["id"], pr["state"], pr["created_at"], pr["updated_at"], pr)
+
+	def store_comment(self, comment):
+		with self._lock:
+			self._connection.execute("insert or replace into comments (id, issue_url, created_at, updated_at, data) values (?, ?, ?, ?, ?)",
+			                         [comment["id"], comment["issue_url"], comment["created_at"], comment["updated_at"], json.dumps(comment)])
+			self._connection.execute("delete from applied_comments where id = ?", [comment["id"]])
+
+	def apply_comment(self, comment):
+		"""
+		Adds a comment the bot just created, until the next sync stores it for good.
+		"""
+
+		with self._lock:
+			self._connection.execute("insert or replace into applied_comments (id, issue_url, created_at, updated_at, data) values (?, ?, ?, ?, ?)",
+			                         [comment["id"], comment["issue_url"], comment["created_at"], comment["updated_at"], json.dumps(comment)])
+			self._connection.commit()
+
+	def apply_issue_change(self, number, labels=None, state=None):
+		"""
+		Applies a change the bot just made to the labels or state of an issue or PR, until the next sync stores the
+		updated entry.
+		"""
+
+		with self._lock:
+			# PRs carry their labels only in the issues table
+			for table in ("issues", "prs"):
+				row = self._connection.execute("select data from {table} where number = ?".format(table=table), [number]).fetchone()
+				if row is None:
+					continue
+
+				entry = json.loads(row[0])
+				if labels is not None and table == "issues":
+					entry["labels"] = map(lambda x: dict(name=x), labels)
+				if state is not None:
+					entry["state"] = state
+				self._connection.execute("update {table} set state = ?, data = ? where number = ?".format(table=table),
+				                         [entry["state"], json.dumps(entry), number])
+			self._connection.commit()
+
+	def set_meta(self, key, value):
+		with self._lock:
+			self._connection.execute("insert or replace into meta (key, value) values (?, ?)", [key, value])
+
+	def commit(self):
+		with self._lock:
+			self._connection.commit()
+
+	def _store(self, table, number, entry_id, state, created_at, updated_at, entry):
+		with self._lock:
+			self._connection.execute("insert or replace into {table} (number, id, state, created_at, updated_at, data) values (?, ?, ?, ?, ?, ?)".format(table=table),
+			                         [number, entry_id, state, created_at, updated_at, json.dumps(entry)])
+
+
+# the synced comments plus those the bots created since
+ALL_COMMENTS = "select * from comments union all select * from applied_comments where id not in (select id from comments)"
+
+
+def _to_iso(d):
+	if d.tzinfo is None:
+		d = d.replace(tzinfo=dateutil.tz.tzutc())
+	return d.astimezone(dateutil.tz.tzutc()).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def enable(path, repo):
+	"""
+	Makes all reads of the bots go to the mirror at ``path`` instead of the API.
+
+	:param path: the mirror's database file, as written by ``gitissuebot sync``
+	:param repo: the repository the bots work on, must match the mirrored one
+	"""
+
+	global _mirror
+	mirror = Mirror(path)
+	if mirror.repo != repo:
+		raise ValueError("{path} mirrors {mirrored} instead of {repo}, run gitissuebot sync first".format(path=path, mirrored=mirror.repo, repo=repo))
+	logger.info("Reading from mirror %s, last synced %s" % (path, mirror.get_meta("synced")))
+	_mirror = mirror
+
+
+def active():
+	"""
+	:return: the mirror to read from, None if reading from the API
+	"""
+
+	return _mirror
+
+
+def current_as_of(now):
+	"""
+	:param now: the current date and time
+	:return: the date and time the data read by the bots is current as of, the start of the last sync if they read
+	         from the mirror and ``now`` otherwise
+	"""
+
+	if _mirror is None or _mirror.synced is None:
+		return now
+	return min(now, _mirror.synced)
@@ -5,14 +5,18 @@ __author__ = "Gina Häußge <osd@foosel.net>"
 __license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
 __copyright__ = "Copyright (C) 2016 Gina Häußge - Released under terms of the AGPLv3 License"
 
-import requests
-import json
 import sys
+import collections
 import datetime
-import dateutil.parser
+import dateutil.parser, dateutil.tz
 import re
 
-from .util import get_prs, load_config, update_config, convert_to_internal_pr, convert_to_internal, setup_logging, print_version
+from .util import get_prs, load_config, update_config, convert_to_internal_pr, convert_to_internal, print_version, \
+    auth_headers, get_issue, set_labels, \
+    add_common_arguments, merge_common_arguments, apply_common_defaults, run_bot
+from . import profiling, budget, actions, mirror, sharding, logs, tracing
+from .profiling import phase
+from .leases import LeaseLost
 
 import logging
 logger = logging.getLogger(__name__)
@@ -20,23 +24,51 @@ logger = logging.getLogger(__name__)
 
 ##~~ helpers
 
+
+# the config values matched against every PR, the branches as sets (lowercased if case is ignored) and the title
+# regex compiled
+Matching = collections.namedtuple("Matching", "targets, blacklisted_targets, sources, blacklisted_sources, title_regex")
+
+# prepared matching values by the config values they were prepared from
+_matching = dict()
+
+
+def matching(config):
+	"""
+	Prepares the config values matched against every PR. Configs validated by :func:`validate_config` carry them
+	already, for others they are prepared on the fly - only once per distinct set of values.
+
+	:param config: config to use
+	:return: the :class:`Matching` for the config
+	"""
+
+	if "matching" in config:
+		return config["matching"]
+
+	branch_keys = ("targets", "blacklisted_targets", "sources", "blacklisted_sources")
+	title_regex = config["title_regex"] if "title_regex" in config and config["title_regex"] else ".*"
+	ignore_case = "ignore_case" in config and config["ignore_case"]
+	values = tuple(map(lambda key: config[key], branch_keys)) + (title_regex, ignore_case)
+	key = repr(values)
+	if not key in _matching:
+		branch_sets = dict()
+		for name, branches in zip(branch_keys, values):
+			if ignore_case:
+				branches = map(lambda x: x.lower(), branches)
+			branch_sets[name] = frozenset(branches)
+		_matching[key] = Matching(title_regex=re.compile(title_regex), **branch_sets)
+	return _matching[key]
+
+
 def valid(pr, config):
-	targets = config["targets"]
-	blacklisted_targets = config["blacklisted_targets"]
-	sources = config["sources"]
-	blacklisted_sources = config["blacklisted_sources"]
-	if config["ignore_case"]:
-		targets = map(lambda x: x.lower(), targets)
-		blacklisted_targets = map(lambda x: x.lower(), blacklisted_targets)
-		sources = map(lambda x: x.lower(), sources)
-		blacklisted_sources = map(lambda x: x.lower(), blacklisted_sources)
-
-	not_in_targets = len(targets) > 0 and all(map(lambda target: target != pr["target_branch"], targets))
-	in_blacklisted_targets = len(blacklisted_targets) > 0 and any(map(lambda target: target == pr["target_branch"], blacklisted_targets))
-	not_in_sources = len(sources) > 0 and all(map(lambda source: source != pr["source_branch"], sources))
-	in_blacklisted_sources = len(blacklisted_sources) > 0 and any(map(lambda source: source == pr["source_branch"], blacklisted_sources))
+	prepared = matching(config)
+
+	not_in_targets = len(prepared.targets) > 0 and not pr["target_branch"] in prepared.targets
+	in_blacklisted_targets = pr["target_branch"] in prepared.blacklisted_targets
+	not_in_sources = len(prepared.sources) > 0 and not pr["source_branch"] in prepared.sources
+	in_blacklisted_sources = pr["source_branch"] in prepared.blacklisted_sources
 	empty_body = pr["body"] is None or pr["body"].strip() == ""
-	invalid_title = pr["title"] is None or not config["title_compiled_regex"].match(pr["title"])
+	invalid_title = pr["title"] is None or not prepared.title_regex.match(pr["title"])
 	problems = []
 
 	if not_in_targets:
@@ -54,9 +86,10 @@ def valid(pr, config):
 
 	return problems
 
-def add_reminder(pr, config, problems, dryrun=False):
+def add_reminder(pr, config, problems, dryrun=False, headers=None):
 	# prepare headers
-	headers = {"Authorization": "token %s" % config["token"]}
+	if headers is None:
+		headers = auth_headers(config["token"], repo=config["repo"])
 
 	texts = config["problems"]
 	problem_texts = []
@@ -84,33 +117,73 @@ def add_reminder(pr, config, problems, dryrun=False):
 	                                                  problems="\n".join(problem_texts))
 
 	# post a comment
-	logger.debug("-> Adding a reminder comment via POST %s" % pr["comments_url"])
-	if not dryrun:
-		requests.post(pr["comments_url"], headers=headers, data=json.dumps({"body": personalized_reminder}))
+	logger.debug("-> Adding a reminder comment via POST %s", pr["comments_url"])
+	actions.comment(pr, personalized_reminder, headers, dryrun=dryrun)
 
 	# label the issue if configured
 	if "label" in config and config["label"]:
 		try:
-			r = requests.get(pr["issue_url"], headers=headers)
-			issue = convert_to_internal(r.json())
-			current_labels = list(issue["labels"])
+			if not "labels" in pr:
+				issue = convert_to_internal(get_issue(headers, pr["issue_url"]))
+				pr["labels"] = issue["labels"]
+			current_labels = list(pr["labels"])
 			current_labels.append(config["label"])
 
-			logger.debug("-> Labeling PR via PATCH %s, labels=%r" % (pr["issue_url"], current_labels))
-			if not dryrun:
-				requests.patch(pr["issue_url"], headers=headers, data=json.dumps({"labels": current_labels}))
+			logger.debug("-> Labeling PR via PATCH %s, labels=%r", pr["issue_url"], current_labels)
+			set_labels(pr, current_labels, headers, dryrun=dryrun)
+		except LeaseLost:
+			raise
 		except:
 			logger.exception("Error while labeling PR #{}".format(pr["id"]))
 
 
 ##~~ process issues
 
+def process_pr(pr, headers, config, dryrun=False):
+	"""
+	Checks a single (converted) PR, which must carry its ``labels``, and reminds its author of any problems.
+
+	:param pr: the PR to process
+	:param headers: headers to use for requests against API
+	:param config: config to use
+	:param dryrun: whether to only simulate the writing API calls
+	"""
+
+	if config["since"] > pr["created"]:
+		logger.info("... too old, skipping", extra=dict(decision="skipped"))
+		return
+	if "label" in config and config["label"] and config["label"] in pr["labels"]:
+		logger.info("... already labeled, skipping", extra=dict(decision="skipped"))
+		return
+
+	with phase("validation"), tracing.span("prcheck.valid", pr=pr["number"]) as span:
+		problems = valid(pr, config)
+		span.set("problems", ",".join(problems))
+	if problems:
+		logger.info("... reminding author of information to include: %s", problems, extra=dict(decision="reminded"))
+		add_reminder(pr, config, problems, dryrun=dryrun, headers=headers)
+
+
 def process_prs(config, file=None, dryrun=False):
-	headers = {"Authorization": "token %s" % config["token"]}
+	"""
+	Does one pass over the repository's PRs.
+
+	:return: the ``since`` to continue from in the next pass
+	"""
+
+	# anything created or updated from now on is left to the next run - or from the last sync on, if reading from
+	# the mirror
+	started = mirror.current_as_of(datetime.datetime.utcnow().replace(tzinfo=dateutil.tz.tzutc()))
+
+	headers = auth_headers(config["token"], repo=config["repo"])
 
 	if dryrun:
 		logger.info("THIS IS A DRYRUN")
 
+	# retry what failed during earlier runs
+	if config["dead_letters"] is not None:
+		actions.replay(config["dead_letters"], headers, dryrun=dryrun)
+
 	# retrieve issues to process
 	logger.info("Fetching all PRs")
 
@@ -126,36 +199,49 @@ def process_prs(config, file=None, dryrun=False):
 			return None
 
 		try:
-			r = requests.get(pr["issue_url"], headers=headers)
-			issue = convert_to_internal(r.json())
+			issue = convert_to_internal(get_issue(headers, pr["issue_url"]))
 			pr["labels"] = issue["labels"]
+		except LeaseLost:
+			raise
 		except:
 			logger.exception("Error while retrieving labels for PR #{}".format(pr["id"]))
 			pr["labels"] = []
 
 		return pr
 
-	prs = get_prs(config["token"], config["repo"], converter=convert_pr)
+	prs = get_prs(config["token"], config["repo"], pr_filter=sharding.owns, converter=convert_pr, created_after=config["since"])
 	logger.info("Found %d PRs to process..." % len(prs))
 
-	for pr in prs:
-		logger.info(u"Processing \"%s\" by %s (created %s, last updated %s)" % (pr["title"], pr["author"], pr["created_str"], pr["updated_str"]))
+	if budget.enabled():
+		# oldest first, so that whatever we run out of budget for is newer than everything processed
+		prs = sorted(prs, key=lambda x: x["created"])
 
-		if config["since"] > pr["created"]:
-			logger.info("... too old, skipping")
-			continue
-		if "label" in config and config["label"] and config["label"] in pr["labels"]:
-			logger.info("... already labeled, skipping")
-			continue
+	actions.start()
+	for pr in budget.within_budget(prs, deferral=pr_deferral):
+		with logs.entry(pr["number"]), tracing.span("pr", number=pr["number"]):
+			logger.info(u"Processing \"%s\" by %s (created %s, last updated %s)", pr["title"], pr["author"], pr["created_str"], pr["updated_str"])
+			process_pr(pr, headers, config, dryrun=dryrun)
 
-		problems = valid(pr, config)
-		if problems:
-			logger.info("... reminding author of information to include: %s", str(problems))
-			add_reminder(pr, config, problems, dryrun=dryrun)
+	# execute the plan
+	actions.flush(headers, dryrun=dryrun)
+	actions.finish(dump=config["plan"], dead_letters=config["dead_letters"])
 
+	# the next run starts where this one started - or at the creation date of the oldest PR we didn't get to
+	since = budget.deferred_since(started)
 	if file is not None and not dryrun:
-		# we are using a config file, so we save the current date and time for the next run
-		update_config(file)
+		# we are using a config file, so we save it for the next run
+		update_config(file, since=since)
+
+	return since
+
+
+def pr_deferral(pr):
+	"""
+	Describes a PR deferred to the next run, see :func:`gitissuebot.budget.within_budget`.
+	"""
+
+	return "new PR", u"#%d \"%s\"" % (pr["number"], pr["title"]), pr["created"]
+
 
 ##~~ config handling
 
@@ -173,6 +259,8 @@ def validate_config(config):
 	if not "token" in config or not config["token"]:
 		logger.error("Token must be defined")
 		sys.exit(-1)
+	if isinstance(config["token"], basestring) and "," in config["token"]:
+		config["token"] = filter(lambda x: len(x) > 0, map(str.strip, str(config["token"]).split(",")))
 	if not "repo" in config or not config["repo"]:
 		logger.error("Repo must be defined")
 		sys.exit(-1)
@@ -189,8 +277,11 @@ def validate_config(config):
 		config["since"] = datetime.datetime.utcnow()
 	if not "ignore_case" in config or config["ignore_case"] is None:
 		config["ignore_case"] = False
-	if not "debug" in config or config["debug"] is None:
-		config["debug"] = False
+	apply_common_defaults(config, "prcheck")
+
+	# prepare what's matched against every PR once
+	config.pop("matching", None)
+	config["matching"] = matching(config)
 
 
 ##~~ CLI
@@ -206,6 +297,10 @@ def main(args=None):
 	if args.version:
 		print_version()
 
+	# enable profiling if requested
+	if args.profile:
+		profiling.enable(args.profile)
+
 	# merge config (if given) and CLI parameters
 	config = load_config(args.config)
 	if args.token is not None:
@@ -222,23 +317,15 @@ def main(args=None):
 		config["sources"] = args.sources
 	if args.blacklisted_sources is not None:
 		config["blacklisted_sources"] = args.blacklisted_sources
-	config["title_compiled_regex"] = re.compile(config["title_regex"] if "title_regex" in config else '.*')
 	config["ignore_case"] = config["ignore_case"] if "ignore_case" in config and config["ignore_case"] else False or args.ignore_case
-	config["dryrun"] = config["dryrun"] if "dryrun" in config and config["dryrun"] else False or args.dryrun
-	config["debug"] = config["debug"] if "debug" in config and config["debug"] else False or args.debug
+	merge_common_arguments(config, args)
 
 	# validate the config
-	validate_config(config)
+	with phase("config"):
+		validate_config(config)
 
-	# setup logger
-	setup_logging(debug=config["debug"])
-
-	# process existing issues
-	try:
-		process_prs(config, file=args.config, dryrun=config["dryrun"])
-	except:
-		logger.exception("Error during execution")
-		sys.exit(-1)
+	# process existing PRs
+	run_bot("prcheck", config, args, process_prs)
 
 def argparser(parser=None):
 	if parser is None:
@@ -249,7 +336,7 @@ def argparser(parser=None):
 	parser.add_argument("-c", "--config", action="store", dest="config",
 	                    help="The config file to use")
 	parser.add_argument("-t", "--token", action="store", dest="token",
-	                    help="The token to use, must be defined either on CLI or via config")
+	                    help="The token to use, must be defined either on CLI or via config. Multiple comma-separated tokens may be given to spread the requests over")
 	parser.add_argument("-r", "--repo", action="store", dest="repo",
 	                    help="The github repository to use, must be defined either on CLI or via config")
 	parser.add_argument("-s", "--since", action="store", dest="since", type=dateutil.parser.parse,
@@ -264,12 +351,7 @@ def argparser(parser=None):
 	                    help="Source branches for PRs that must not match for the PR to be considered valid")
 	parser.add_argument("-i", "--ignore-case", action="store_true", dest="ignore_case",
 	                    help="Ignore case when matching branch names")
-	parser.add_argument("--dry-run", action="store_true", dest="dryrun",
-	                    help="Just print what would be done without actually doing it")
-	parser.add_argument("-v", "--version", action="store_true", dest="version",
-	                    help="Print the version and exit")
-	parser.add_argument("--debug", action="store_true", dest="debug",
-	                    help="Enable debug logging")
+	add_common_arguments(parser)
 
 	return parser
 
@@ -0,0 +1,207 @@
+# coding=utf-8
+from __future__ import print_function, absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
+
+import contextlib
+import cProfile
+import pstats
+import os
+import signal
+import sys
+import time
+
+try:
+	import resource
+except ImportError:
+	# not available on Windows, we'll only do cProfile then
+	resource = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# the currently active profiler, None if profiling is disabled
+_profiler = None
+
+# set by the dump signal handler, the stats are dumped on the next phase change
+_dump_requested = False
+
+
+class Profiler(object):
+	"""
+	Collects cProfile data and resource usage for named phases of a bot run.
+
+	Each phase gets its own ``cProfile.Profile`` which is enabled whenever the phase is entered, so a phase entered
+	repeatedly (e.g. once per write) accumulates into the same stats. Phases may be nested, the outer phase is paused
+	while the inner one is active.
+
+	Resource usage is taken from ``resource.getrusage`` on entering and leaving a phase: the CPU time spent and how much
+	the process' peak memory (max RSS) grew during it, which shows which phase makes the process grow.
+	"""
+
+	def __init__(self, output_dir, top=10):
+		self.output_dir = output_dir
+		self.top = top
+
+		self._profiles = dict()
+		self._calls = dict()
+		self._durations = dict()
+		self._cpu = dict()
+		self._memory = dict()
+		self._stack = []
+
+		if resource is None:
+			logger.warn("resource is not available on this platform, profiling without resource usage")
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		if not name in self._profiles:
+			self._profiles[name] = cProfile.Profile()
+			self._calls[name] = 0
+			self._durations[name] = 0.0
+			self._cpu[name] = 0.0
+			self._memory[name] = 0
+
+		if self._stack:
+			self._profiles[self._stack[-1]].disable()
+		self._stack.append(name)
+
+		usage_before = _usage()
+		start = time.time()
+		self._profiles[name].enable()
+		try:
+			yield
+		finally:
+			self._profiles[name].disable()
+			self._durations[name] += time.time() - start
+			self._calls[name] += 1
+			usage_after = _usage()
+			if usage_after is not None:
+				self._cpu[name] += usage_after[0] - usage_before[0]
+				self._memory[name] += usage_after[1] - usage_before[1]
+
+			self._stack.pop()
+			if self._stack:
+				self._profiles[self._stack[-1]].enable()
+
+	def dump(self):
+		"""
+		Writes one sortable stats file per phase (load with ``pstats.Stats``) into the output directory and logs a
+		top-N summary including each phase's resource usage.
+
+		May be called while a phase is active (e.g. on a dump signal), the phase keeps being profiled.
+		"""
+
+		# don't profile the dump itself
+		if self._stack:
+			self._profiles[self._stack[-1]].disable()
+
+		if not os.path.exists(self.output_dir):
+			os.makedirs(self.output_dir)
+
+		logger.info("Profiling summary (stats written to %s):" % self.output_dir)
+		for name in sorted(self._profiles, key=lambda x: self._durations[x], reverse=True):
+			filename = os.path.join(self.output_dir, "{name}.prof".format(name=name))
+
+			stats = pstats.Stats(self._profiles[name])
+			stats.dump_stats(filename)
+
+			if resource is not None:
+				logger.info("... %s: %d call(s), %.3fs, %.3fs CPU, max RSS grew by %d KiB" % (name, self._calls[name], self._durations[name], self._cpu[name], self._memory[name]))
+			else:
+				logger.info("... %s: %d call(s), %.3fs" % (name, self._calls[name], self._durations[name]))
+			for func, (_, ncalls, _, cumtime, _) in sorted(stats.stats.items(), key=lambda x: x[1][3], reverse=True)[:self.top]:
+				logger.info("      %8.3fs %6d %s:%d(%s)" % (cumtime, ncalls, func[0], func[1], func[2]))
+
+		if self._stack:
+			self._profiles[self._stack[-1]].enable()
+
+		usage = _usage()
+		if usage is not None:
+			logger.info("... process: %.3fs CPU, %d KiB max RSS" % usage)
+
+
+def enable(output_dir, top=10, dump_signal=getattr(signal, "SIGUSR1", None)):
+	"""
+	Enables profiling for the rest of the process' lifetime.
+
+	If ``dump_signal`` is available on the platform, receiving it dumps the stats collected so far, which allows
+	inspecting long running processes on demand. The handler only flags the request, the dump itself happens on the
+	next phase change, outside of the signal handler.
+
+	:param output_dir:  directory to write the stats files to
+	:param top:         number of entries to include per phase in the summary
+	:param dump_signal: signal on which to dump the stats, None to not register a handler
+	"""
+
+	global _profiler
+	_profiler = Profiler(output_dir, top=top)
+
+	if dump_signal is not None:
+		signal.signal(dump_signal, _request_dump)
+
+
+def _request_dump(signum, frame):
+	global _dump_requested
+	_dump_requested = True
+
+
+def _dump_if_requested():
+	global _dump_requested
+	if _dump_requested:
+		_dump_requested = False
+		_profiler.dump()
+
+
+def phase(name):
+	"""
+	Context manager marking a named phase to profile, does nothing if profiling is not enabled.
+
+	:param name: name of the phase, e.g. ``listing`` or ``writes``
+	"""
+
+	if _profiler is None:
+		return _noop()
+	return _dumping(_profiler.phase(name))
+
+
+def report():
+	"""
+	Dumps the collected stats if profiling is enabled.
+	"""
+
+	if _profiler is not None:
+		_profiler.dump()
+
+
+@contextlib.contextmanager
+def _noop():
+	yield
+
+
+@contextlib.contextmanager
+def _dumping(phase):
+	_dump_if_requested()
+	try:
+		with phase:
+			yield
+	finally:
+		_dump_if_requested()
+
+
+def _usage():
+	"""
+	:return: tuple of the CPU time in seconds and max RSS in KiB used by the process so far, None if not available
+	"""
+
+	if resource is None:
+		return None
+	usage = resource.getrusage(resource.RUSAGE_SELF)
+	maxrss = usage.ru_maxrss
+	if sys.platform == "darwin":
+		# reported in bytes instead of KiB there
+		maxrss //= 1024
+	return usage.ru_utime + usage.ru_stime, maxrss
@@ -0,0 +1,194 @@
+# coding=utf-8
+from __future__ import print_function, absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
+
+import errno
+import fcntl
+import json
+import os
+import re
+import socket
+import tempfile
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# the locks held by this run, empty if not locked
+_locks = []
+
+
+class RunLock(object):
+	"""
+	Lock file making sure only one run per bot and repository is going on at a time on this host.
+
+	A run that finds the lock taken may request a follow-up pass instead of running itself, by leaving a marker file
+	next to the lock. The run holding the lock then does one more pass before it exits, no matter how many runs
+	requested one meanwhile.
+
+	The lock file itself is never removed, since another run might be about to lock it.
+
+	:param path: the lock file
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.pending_path = path + ".pending"
+		self._file = None
+
+	def try_acquire(self):
+		"""
+		:return: True if the lock was acquired, False if another run holds it
+		"""
+
+		f = open(self.path, "a+")
+		try:
+			fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except IOError as e:
+			f.close()
+			if e.errno in (errno.EAGAIN, errno.EACCES):
+				return False
+			raise
+
+		f.seek(0)
+		f.truncate()
+		json.dump(dict(host=socket.gethostname(), pid=os.getpid(), started=time.time()), f)
+		f.flush()
+
+		self._file = f
+		return True
+
+	def holder(self):
+		try:
+			with open(self.path, "r") as f:
+				return json.load(f)
+		except:
+			return None
+
+	def release(self):
+		if self._file is None:
+			return
+		fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+		self._file.close()
+		self._file = None
+
+	def request_follow_up(self):
+		with open(self.pending_path, "w") as f:
+			f.write(str(os.getpid()))
+
+	def follow_up_requested(self):
+		return os.path.exists(self.pending_path)
+
+	def consume_follow_up(self):
+		"""
+		:return: True if a follow-up pass was requested
+		"""
+
+		try:
+			os.remove(self.pending_path)
+			return True
+		except OSError as e:
+			if e.errno == errno.ENOENT:
+				return False
+			raise
+
+
+def default_path(bot, repo):
+	"""
+	:return: path of the lock file of ``bot`` working on ``repo`` in the temporary directory
+	"""
+
+	return os.path.join(tempfile.gettempdir(), "gitissuebot-{bot}-{repo}.lock".format(bot=bot, repo=re.sub(r"[^\w.-]", "_", repo)))
+
+
+def acquire(paths, coalesce=False):
+	"""
+	Locks ``paths`` for this run, either all of them or none.
+
+	:param paths:    the lock file, or a list of lock files, e.g. one per bot of a combined run
+	:param coalesce: if another run holds one of the locks, have it do a follow-up pass instead of just exiting
+	:return: True if this run holds the locks now and should go ahead, False if it should exit
+	"""
+
+	global _locks
+
+	if isinstance(paths, basestring):
+		paths = [paths]
+
+	locks = []
+	for path in sorted(set(paths)):
+		lock = RunLock(path)
+		if not lock.try_acquire():
+			holder = lock.holder() or dict()
+			if not coalesce:
+				logger.info("Another run (pid %s on %s) is still going on, exiting" % (holder.get("pid"), holder.get("host")))
+				_release_all(locks)
+				return False
+
+			# the running one checks for the request again after releasing the lock, so if it released it before we
+			# could make the request, we get the lock now and do the pass ourselves
+			lock.request_follow_up()
+			if not lock.try_acquire():
+				logger.info("Another run (pid %s on %s) is still going on, requested a follow-up pass from it" % (holder.get("pid"), holder.get("host")))
+				_release_all(locks)
+				return False
+		locks.append(lock)
+
+	# this run covers any follow-up requested before it started
+	for lock in locks:
+		lock.consume_follow_up()
+	_locks = locks
+	return True
+
+
+def follow_up():
+	"""
+	To be called after each pass. Checks whether a follow-up pass was requested by runs started meanwhile, and
+	releases the locks if not.
+
+	:return: True if another pass should be done
+	"""
+
+	global _locks
+	if not _locks:
+		return False
+
+	# consume all requests, one pass covers them
+	if any([lock.consume_follow_up() for lock in _locks]):
+		logger.info("Another run was started meanwhile, doing a follow-up pass")
+		return True
+
+	_release_all(_locks)
+
+	# a run started between the check and the release couldn't get its lock, so the pass it requested is up to us -
+	# unless another run got one of the locks first, which then covers the request itself
+	if any(lock.follow_up_requested() for lock in _locks):
+		relocked = [lock for lock in _locks if lock.try_acquire()]
+		if len(relocked) == len(_locks):
+			for lock in _locks:
+				lock.consume_follow_up()
+			logger.info("Another run was started meanwhile, doing a follow-up pass")
+			return True
+		_release_all(relocked)
+
+	_locks = []
+	return False
+
+
+def release():
+	"""
+	Releases the locks held by this run, if any.
+	"""
+
+	global _locks
+	_release_all(_locks)
+	_locks = []
+
+
+def _release_all(locks):
+	for lock in locks:
+		lock.release()
@@ -0,0 +1,258 @@
+# coding=utf-8
+from __future__ import print_function, absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
+
+import bisect
+import hashlib
+import json
+import os
+import socket
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# seconds after which a worker that didn't run anymore is considered gone and its share moves to the others
+MEMBER_TIMEOUT = 60 * 60
+
+# points per worker on the hash ring, more points spread the keys more evenly
+VIRTUAL_NODES = 64
+
+RATE_LIMIT_URL = "https://api.github.com/rate_limit"
+
+
+# the shard of the current run and this worker's membership, None if not sharding
+_shard = None
+_membership = None
+
+
+class Membership(object):
+	"""
+	Membership of the workers sharing a directory. Every worker renews its membership file when a run starts and
+	removes it when the run ends, so its share moves to the others right away. Workers that died without removing it
+	are considered gone once they haven't renewed it within ``timeout`` seconds.
+
+	:param directory: the shared directory
+	:param worker:    id of this worker
+	:param timeout:   seconds after which a worker is considered gone
+	"""
+
+	def __init__(self, directory, worker, timeout=MEMBER_TIMEOUT):
+		self.directory = directory
+		self.worker = worker
+		self.timeout = timeout
+
+	def join(self):
+		"""
+		Renews this worker's membership.
+		"""
+
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+
+		path = self._path(self.worker)
+		tmpfilename = "{path}.{pid}.tmp".format(path=path, pid=os.getpid())
+		with open(tmpfilename, "w") as f:
+			json.dump(dict(worker=self.worker, host=socket.gethostname(), pid=os.getpid(), renewed=time.time()), f)
+		os.rename(tmpfilename, path)
+
+	def leave(self):
+		path = self._path(self.worker)
+		if os.path.isfile(path):
+			os.remove(path)
+
+	def members(self):
+		"""
+		:return: sorted list of the ids of all current workers, including this one
+		"""
+
+		now = time.time()
+		members = set([self.worker])
+		for filename in os.listdir(self.directory):
+			if not filename.endswith(".member"):
+				continue
+			try:
+				with open(os.path.join(self.directory, filename), "r") as f:
+					member = json.load(f)
+			except:
+				logger.warn("Could not read membership file %s, ignoring it" % filename)
+				continue
+			if member["renewed"] >= now - self.timeout:
+				members.add(member["worker"])
+		return sorted(members)
+
+	def _path(self, worker):
+		return os.path.join(self.directory, "{worker}.member".format(worker=hashlib.md5(worker.encode("utf-8")).hexdigest()))
+
+
+class HashRing(object):
+	"""
+	Consistent hash ring over the workers. When a worker joins or leaves, only the keys between its points and their
+	predecessors change owners, all other keys stay where they are.
+
+	:param members:       ids of the workers
+	:param virtual_nodes: points per worker on the ring
+	"""
+
+	def __init__(self, members, virtual_nodes=VIRTUAL_NODES):
+		self.members = list(members)
+		self._points = sorted((_hash("{member}#{index}".format(member=member, index=index)), member)
+		                      for member in self.members for index in range(virtual_nodes))
+		self._hashes = map(lambda x: x[0], self._points)
+
+	def owner(self, key):
+		index = bisect.bisect(self._hashes, _hash(key)) % len(self._points)
+		return self._points[index][1]
+
+
+def _hash(key):
+	return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class Shard(object):
+	"""
+	The part of a repository a worker is responsible for.
+
+	:param worker:     id of this worker
+	:param ring:       the :class:`HashRing` of all workers
+	:param repo:       the repository
+	:param range_size: number of consecutive issue numbers to assign together, 0 to assign the whole repository to
+	                   one worker
+	"""
+
+	def __init__(self, worker, ring, repo, range_size=0):
+		self.worker = worker
+		self.ring = ring
+		self.repo = repo
+		self.range_size = range_size
+
+	@property
+	def repo_owner(self):
+		return self.ring.owner(self.repo)
+
+	def owns_repo(self):
+		"""
+		:return: whether this worker has anything to do in the repository
+		"""
+
+		return self.range_size > 0 or self.repo_owner == self.worker
+
+	def owns(self, number):
+		"""
+		:return: whether this worker is responsible for the issue or PR ``number``
+		"""
+
+		if self.range_size <= 0:
+			return self.repo_owner == self.worker
+		return self.ring.owner("{repo}#{range}".format(repo=self.repo, range=number // self.range_size)) == self.worker
+
+	@property
+	def share(self):
+		return 1.0 / len(self.ring.members)
+
+
+def enable(directory, repo, worker=None, range_size=0, timeout=MEMBER_TIMEOUT):
+	"""
+	Restricts the run to this worker's share of ``repo``, as determined by consistent hashing over all workers sharing
+	``directory``.
+
+	:param directory:  the directory shared by all workers
+	:param repo:       the repository the run works on
+	:param worker:     id of this worker, defaults to the host name
+	:param range_size: number of consecutive issue numbers to assign together, 0 to assign whole repositories
+	:param timeout:    seconds after which a worker that didn't run anymore is considered gone
+	:return: the :class:`Shard`
+	"""
+
+	global _shard, _membership
+
+	if worker is None:
+		worker = socket.gethostname()
+
+	_membership = Membership(directory, worker, timeout=timeout)
+	_membership.join()
+	members = _membership.members()
+
+	_shard = Shard(worker, HashRing(members), repo, range_size=range_size)
+	logger.info("Worker %s is one of %d worker(s): %s" % (worker, len(members), ", ".join(members)))
+	return _shard
+
+
+def active():
+	return _shard
+
+
+def finish():
+	"""
+	Leaves the workers sharing the directory, if sharding, so that the others take over this worker's share with
+	their next run instead of only after the membership timed out.
+	"""
+
+	global _shard, _membership
+
+	if _membership is not None:
+		try:
+			_membership.leave()
+			logger.info("Worker %s left, its share moves to the other workers" % _membership.worker)
+		except:
+			logger.exception("Could not remove membership of worker %s" % _membership.worker)
+	_shard = None
+	_membership = None
+
+
+def owns(entry):
+	"""
+	:param entry: an issue or PR
+	:return: whether this worker is responsible for ``entry``, always True if not sharding
+	"""
+
+	return _shard is None or _shard.owns(entry["number"])
+
+
+def owned(entries, skipped=None):
+	"""
+	Lazily filters ``entries`` down to the ones this worker is responsible for.
+
+	:param entries: the issues or PRs to filter
+	:param skipped: function to call with each entry another worker is responsible for
+	:return: generator over the entries this worker is responsible for
+	"""
+
+	for entry in entries:
+		if owns(entry):
+			yield entry
+		elif skipped is not None:
+			skipped(entry)
+
+
+def request_budget(tokens):
+	"""
+	Determines this worker's share of the remaining rate limit of ``tokens``, so that the workers don't exhaust it
+	for each other. Querying the rate limit doesn't count against it.
+
+	:param tokens: the token or list of tokens
+	:return: the maximum number of requests this worker should make, None if not sharding or unknown
+	"""
+
+	from .util import api_get, auth_headers
+
+	if _shard is None:
+		return None
+	if not isinstance(tokens, (list, tuple)):
+		tokens = [tokens]
+
+	remaining = 0
+	for token in tokens:
+		try:
+			r = api_get(RATE_LIMIT_URL, headers=auth_headers(token))
+			r.raise_for_status()
+			remaining += r.json()["resources"]["core"]["remaining"]
+		except:
+			logger.exception("Could not determine the remaining rate limit, not limiting the worker's requests")
+			return None
+
+	return int(remaining * _shard.share)
@@ -0,0 +1,237 @@
+# coding=utf-8
+from __future__ import print_function, absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
+
+import sys
+import json
+import datetime
+import dateutil.parser, dateutil.tz
+import urllib
+
+from .util import load_config, setup_logging, print_version, auth_headers, api_get, build_query_url, iter_pages, \
+    json_loads, project, ISSUES_URL, PRS_URL, REPO_COMMENTS_SINCE_URL, ISSUE_FIELDS, PR_FIELDS, COMMENT_FIELDS
+from .mirror import Mirror
+from . import profiling, concurrency, tracing
+from .profiling import phase
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+LABELS_URL = "https://api.github.com/repos/{repo}/labels?per_page=100"
+
+# since to use for the first sync of the comments, the endpoint requires one
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=dateutil.tz.tzutc())
+
+
+##~~ sync
+
+
+def sync(config):
+	"""
+	Brings the mirror up to date with the repository.
+
+	Only what changed since the most recent change already mirrored is fetched, and the first page of each listing
+	is requested conditionally, so a sync without any changes costs no rate limit at all.
+
+	:param config: config to use
+	"""
+
+	mirror = Mirror(config["mirror"])
+	if mirror.repo is not None and mirror.repo != config["repo"]:
+		logger.error("%s already mirrors %s" % (config["mirror"], mirror.repo))
+		sys.exit(-1)
+	mirror.set_meta("repo", config["repo"])
+
+	headers = auth_headers(config["token"], repo=config["repo"])
+	started = datetime.datetime.utcnow().replace(tzinfo=dateutil.tz.tzutc())
+
+	with phase("listing"):
+		# issues, including PRs as far as their labels and comment counts are concerned
+		latest = mirror.latest("issues")
+		url = build_query_url(ISSUES_URL.format(repo=config["repo"]), state="all", sort="updated", direction="asc",
+		                      since=dateutil.parser.parse(latest) if latest else None)
+		count = _sync_listing(mirror, headers, "issues", url, ISSUE_FIELDS, mirror.store_issue)
+		logger.info("Synced %d issues" % count)
+
+		# PRs can't be listed by since, so we list them most recently updated first and stop at the first known one
+		latest = mirror.latest("prs")
+		url = build_query_url(PRS_URL.format(repo=config["repo"]), state="all", sort="updated", direction="desc")
+		stop = (lambda x: x["updated_at"] < latest) if latest else None
+		count = _sync_listing(mirror, headers, "prs", url, PR_FIELDS, mirror.store_pr, stop=stop)
+		logger.info("Synced %d PRs" % count)
+
+		latest = mirror.latest("comments")
+		since = dateutil.parser.parse(latest) if latest else EPOCH
+		url = REPO_COMMENTS_SINCE_URL.format(repo=config["repo"], since=urllib.quote(since.isoformat()))
+		count = _sync_listing(mirror, headers, "comments", url, COMMENT_FIELDS, mirror.store_comment)
+		logger.info("Synced %d comments" % count)
+
+		labels = []
+		count = _sync_listing(mirror, headers, "labels", LABELS_URL.format(repo=config["repo"]), {"name": None}, labels.append)
+		if count:
+			mirror.set_meta("labels", json.dumps(map(lambda x: x["name"], labels)))
+		logger.info("Synced %d labels" % count)
+
+	mirror.set_meta("synced", started.isoformat())
+	mirror.commit()
+
+
+def _sync_listing(mirror, headers, name, url, fields, store, stop=None):
+	"""
+	Stores all entries of the listing at ``url`` via ``store``, until ``stop`` matches an entry.
+
+	:return: the number of entries stored
+	"""
+
+	with tracing.span("listing", listing=name, url=url) as span:
+		# the ETag is only valid for the exact same URL, which stays the same as long as nothing changed
+		etag = None
+		previous = mirror.get_meta("etag:" + name)
+		if previous is not None:
+			previous = json.loads(previous)
+			if previous["url"] == url:
+				etag = previous["etag"]
+
+		r = api_get(url, headers=headers, etag=etag)
+		if r.status_code == 304:
+			logger.debug("%s unchanged" % name)
+			span.set("unchanged", True)
+			return 0
+		r.raise_for_status()
+
+		def pages():
+			next_url = r.links["next"]["url"] if r.links and "next" in r.links and "url" in r.links["next"] else None
+			yield project(json_loads(r.content), fields), next_url
+			if next_url:
+				for page in iter_pages(headers, next_url, fields=fields):
+					yield page
+
+		count = 0
+		for entries, _ in pages():
+			for entry in entries:
+				if stop is not None and stop(entry):
+					break
+				store(entry)
+				count += 1
+			else:
+				continue
+			break
+
+		if r.headers.get("ETag"):
+			mirror.set_meta("etag:" + name, json.dumps(dict(url=url, etag=r.headers["ETag"])))
+		span.set("entries", count)
+		return count
+
+
+##~~ config handling
+
+
+def validate_config(config):
+	"""
+	Makes sure the given config is valid, filling in default values and exiting the application if mandatory
+	parameters are not given.
+
+	:param config: the config to validate
+	"""
+
+	# check for mandatory values
+	if not "token" in config or not config["token"]:
+		logger.error("Token must be defined")
+		sys.exit(-1)
+	if isinstance(config["token"], basestring) and "," in config["token"]:
+		config["token"] = filter(lambda x: len(x) > 0, map(str.strip, str(config["token"]).split(",")))
+	if not "repo" in config or not config["repo"]:
+		logger.error("Repo must be defined")
+		sys.exit(-1)
+	if not "mirror" in config or not config["mirror"]:
+		logger.error("Mirror must be defined")
+		sys.exit(-1)
+
+	if not "debug" in config or config["debug"] is None:
+		config["debug"] = False
+	if not "trace" in config or not config["trace"]:
+		config["trace"] = None
+
+
+##~~ CLI
+
+
+def main(args=None):
+	if args is None:
+		# parse CLI arguments
+		parser = argparser()
+		args = parser.parse_args()
+
+	# if only version is to be printed, do so and exit
+	if args.version:
+		print_version()
+
+	# enable profiling if requested
+	if args.profile:
+		profiling.enable(args.profile)
+
+	# merge config (if given) and CLI parameters
+	config = load_config(args.config)
+	if args.token is not None:
+		config["token"] = args.token
+	if args.repo is not None:
+		config["repo"] = args.repo
+	if args.mirror is not None:
+		config["mirror"] = args.mirror
+	if args.trace is not None:
+		config["trace"] = args.trace
+	config["debug"] = config["debug"] if "debug" in config and config["debug"] else False or args.debug
+
+	# validate the config
+	with phase("config"):
+		validate_config(config)
+
+	# setup logger
+	setup_logging(debug=config["debug"])
+
+	# trace the sync if requested
+	if config["trace"]:
+		tracing.enable(config["trace"], "sync", repo=config["repo"])
+
+	# sync the mirror
+	try:
+		sync(config)
+	except:
+		logger.exception("Error during execution")
+		sys.exit(-1)
+	finally:
+		tracing.finish()
+		concurrency.report()
+		profiling.report()
+
+def argparser(parser=None):
+	if parser is None:
+		import argparse
+		parser = argparse.ArgumentParser(prog="gitissuebot-sync")
+
+	# prepare CLI argument parser
+	parser.add_argument("-c", "--config", action="store", dest="config",
+	                    help="The config file to use")
+	parser.add_argument("-t", "--token", action="store", dest="token",
+	                    help="The token to use, must be defined either on CLI or via config. Multiple comma-separated tokens may be given to spread the requests over")
+	parser.add_argument("-r", "--repo", action="store", dest="repo",
+	                    help="The github repository to mirror, must be defined either on CLI or via config")
+	parser.add_argument("-m", "--mirror", action="store", dest="mirror",
+	                    help="The SQLite file to keep the mirror in, must be defined either on CLI or via config")
+	parser.add_argument("-v", "--version", action="store_true", dest="version",
+	                    help="Print the version and exit")
+	parser.add_argument("--debug", action="store_true", dest="debug",
+	                    help="Enable debug logging")
+	parser.add_argument("--trace", action="store", dest="trace",
+	                    help="Trace the sync and write the spans of the listings, their pages and the API requests to the given file, in the OpenTelemetry JSON format")
+	parser.add_argument("--profile", action="store", dest="profile", nargs="?", const="profile",
+	                    help="Profile the run and write per phase cProfile stats and resource usage to the given directory, defaults to ./profile if no directory is given. Send SIGUSR1 to dump the stats collected so far")
+
+	return parser
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,248 @@
+# coding=utf-8
+from __future__ import print_function, absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
+
+import binascii
+import contextlib
+import json
+import os
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# span kinds and status codes of the OpenTelemetry protocol
+KIND_INTERNAL = 1
+KIND_CLIENT = 3
+STATUS_ERROR = 2
+
+
+# the tracer of the current run, None if not tracing
+_tracer = None
+
+# the spans the current thread is in, innermost last
+_context = threading.local()
+
+
+class Span(object):
+	"""
+	A timed operation within a trace. Spans are entered as context managers, the spans entered meanwhile on the same
+	thread become their children. An exception leaving the span marks it as failed.
+
+	:param tracer:     the :class:`Tracer` the span belongs to
+	:param name:       name of the span
+	:param parent:     the parent :class:`Span`, None for the root span
+	:param kind:       the span kind
+	:param attributes: attributes of the span
+	"""
+
+	def __init__(self, tracer, name, parent=None, kind=KIND_INTERNAL, attributes=None):
+		self.tracer = tracer
+		self.name = name
+		self.parent = parent
+		self.kind = kind
+		self.attributes = attributes if attributes is not None else dict()
+
+		self.span_id = _random_id(8)
+		self.start = None
+		self.end = None
+		self.error = None
+
+	def set(self, key, value):
+		self.attributes[key] = value
+
+	def __enter__(self):
+		self.start = time.time()
+		_stack().append(self)
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.end = time.time()
+		if exc_type is not None:
+			self.error = "{type}: {value}".format(type=exc_type.__name__, value=exc_value)
+		_stack().pop()
+		self.tracer.add(self)
+		return False
+
+	def export(self):
+		span = dict(traceId=self.tracer.trace_id, spanId=self.span_id, name=self.name, kind=self.kind,
+		            startTimeUnixNano=str(int(self.start * 1e9)), endTimeUnixNano=str(int(self.end * 1e9)),
+		            attributes=_attributes(self.attributes), status=dict())
+		if self.parent is not None:
+			span["parentSpanId"] = self.parent.span_id
+		if self.error is not None:
+			span["status"] = dict(code=STATUS_ERROR, message=self.error)
+		return span
+
+
+class _NoopSpan(object):
+	"""
+	Stands in for all spans while not tracing.
+	"""
+
+	def set(self, key, value):
+		pass
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		return False
+
+_NOOP = _NoopSpan()
+
+
+class Tracer(object):
+	"""
+	Collects the spans of a run and writes them to ``path`` in the JSON encoding of the OpenTelemetry protocol once
+	the run is done, ready to be imported by OpenTelemetry compatible tools.
+
+	All spans share a trace with a root span covering the whole run. Spans started on a thread that isn't in any
+	span, e.g. a worker thread, become children of the root span unless a parent is attached.
+
+	:param path:       the file to write the trace to
+	:param name:       name of the root span, e.g. the bot
+	:param attributes: attributes of the root span
+	"""
+
+	def __init__(self, path, name, attributes=None):
+		self.path = path
+		self.trace_id = _random_id(16)
+		self.spans = []
+		self._lock = threading.Lock()
+
+		self.root = Span(self, name, attributes=attributes)
+		self.root.start = time.time()
+
+	def add(self, span):
+		with self._lock:
+			self.spans.append(span)
+
+	def finish(self):
+		self.root.end = time.time()
+		self.add(self.root)
+
+		with self._lock:
+			spans = map(lambda x: x.export(), self.spans)
+
+		from gitissuebot import _version
+		resource = dict(attributes=_attributes({"service.name": "gitissuebot"}))
+		scope = dict(name="gitissuebot", version=_version.get_versions()["version"])
+		with open(self.path, "w") as f:
+			json.dump(dict(resourceSpans=[dict(resource=resource, scopeSpans=[dict(scope=scope, spans=spans)])]), f)
+
+		logger.info("Wrote %d spans to %s" % (len(spans), self.path))
+
+
+def _random_id(size):
+	return binascii.hexlify(os.urandom(size)).decode("ascii")
+
+
+def _attributes(attributes):
+	result = []
+	for key, value in sorted(attributes.items()):
+		if value is None:
+			continue
+		if isinstance(value, bool):
+			value = dict(boolValue=value)
+		elif isinstance(value, (int, long)):
+			value = dict(intValue=str(value))
+		elif isinstance(value, float):
+			value = dict(doubleValue=value)
+		else:
+			value = dict(stringValue=value if isinstance(value, basestring) else str(value))
+		result.append(dict(key=key, value=value))
+	return result
+
+
+def _stack():
+	stack = getattr(_context, "stack", None)
+	if stack is None:
+		stack = _context.stack = []
+	return stack
+
+
+def enable(path, name, **attributes):
+	"""
+	Traces the rest of the run to the file at ``path``.
+
+	:param path:       the file to write the trace to
+	:param name:       name of the root span, e.g. the bot
+	:param attributes: attributes of the root span
+	"""
+
+	global _tracer
+	_tracer = Tracer(path, name, attributes=attributes)
+	logger.info("Tracing the run to %s" % path)
+
+
+def span(name, kind=KIND_INTERNAL, **attributes):
+	"""
+	Creates a span as a child of the current thread's innermost span, to be used as context manager. Costs next to
+	nothing if not tracing.
+
+	:param name:       name of the span
+	:param kind:       the span kind, :data:`KIND_CLIENT` for requests to the API
+	:param attributes: attributes of the span
+	:return: the span
+	"""
+
+	if _tracer is None:
+		return _NOOP
+
+	stack = _stack()
+	return Span(_tracer, name, parent=stack[-1] if stack else _tracer.root, kind=kind, attributes=attributes)
+
+
+def current():
+	"""
+	:return: the current thread's innermost span, to pass to :func:`attach` on another thread. None if not tracing
+	"""
+
+	if _tracer is None:
+		return None
+
+	stack = _stack()
+	return stack[-1] if stack else _tracer.root
+
+
+@contextlib.contextmanager
+def attach(parent):
+	"""
+	Makes ``parent`` the parent of the spans started on the current thread meanwhile, for passing the current span
+	on to worker threads.
+
+	:param parent: span as returned by :func:`current` on the thread that handed over the work
+	"""
+
+	if parent is None:
+		yield
+		return
+
+	stack = _stack()
+	stack.append(parent)
+	try:
+		yield
+	finally:
+		stack.pop()
+
+
+def finish():
+	"""
+	Writes the trace if tracing.
+	"""
+
+	global _tracer
+	if _tracer is None:
+		return
+
+	try:
+		_tracer.finish()
+	except:
+		logger.exception("Could not write trace to %s" % _tracer.path)
+	_tracer = None
@@ -7,9 +7,27 @@ __copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the
 
 import dateutil.parser, dateutil.tz
 import datetime
+import json
 import requests
 import urllib
+import urlparse
 import sys
+import time
+
+try:
+	# C accelerated, faster than the stdlib decoder
+	import simplejson as fastjson
+except ImportError:
+	fastjson = None
+
+try:
+	import ijson
+except ImportError:
+	# no streaming decode of large pages then
+	ijson = None
+
+from .profiling import phase
+from . import profiling, budget, actions, concurrency, mirror, cassette, sharding, leases, runlock, logs, tracing
 
 import logging
 logging.basicConfig(format="%(asctime)-15s %(message)s")
@@ -18,23 +36,220 @@ logger = logging.getLogger(__name__)
 
 # Github API URLs
 USER_URL = "https://api.github.com/user"
-ISSUES_URL = "https://api.github.com/repos/{repo}/issues?state=open"
-ISSUES_SINCE_URL = "https://api.github.com/repos/{repo}/issues?state=open&since={since}"
-PRS_URL = "https://api.github.com/repos/{repo}/pulls?state=open"
+ISSUES_URL = "https://api.github.com/repos/{repo}/issues"
+PRS_URL = "https://api.github.com/repos/{repo}/pulls"
+SEARCH_ISSUES_URL = "https://api.github.com/search/issues"
+REPO_COMMENTS_SINCE_URL = "https://api.github.com/repos/{repo}/issues/comments?since={since}&sort=created&direction=asc&per_page=100"
+
+# Limits of the search API: maximum query length and maximum number of results it will return
+SEARCH_QUERY_MAX_LENGTH = 256
+SEARCH_MAX_RESULTS = 1000
+
+# Longest we'll wait for the search rate limit to reset before giving up on a search
+SEARCH_MAX_WAIT = 60
+
+# How far the search index may lag behind, searches for new issues reach back that much further to not miss any
+SEARCH_INDEX_LAG = datetime.timedelta(minutes=10)
+
+# Page size to use when scanning comment threads
+COMMENTS_PER_PAGE = 100
+
+# Pages at least this large (or of unknown size) are decoded incrementally if ijson is available
+STREAM_MIN_BYTES = 512 * 1024
+
+# Fields of the API's issue, PR and comment objects the bots actually use. Entries of list pages are projected onto
+# these right at decode time, a None value keeps a field as is, a dict projects the field's (or for lists each
+# element's) fields.
+_USER_FIELDS = {"login": None, "id": None}
+ISSUE_FIELDS = {"id": None, "number": None, "title": None, "body": None, "user": _USER_FIELDS, "labels": {"name": None},
+                "created_at": None, "updated_at": None, "comments": None, "comments_url": None, "url": None,
+                "pull_request": None, "state": None}
+PR_FIELDS = {"id": None, "number": None, "title": None, "body": None, "user": _USER_FIELDS, "created_at": None,
+             "updated_at": None, "url": None, "comments_url": None, "issue_url": None, "diff_url": None, "state": None,
+             "head": {"ref": None, "repo": {"full_name": None}}, "base": {"ref": None, "repo": {"full_name": None}}}
+COMMENT_FIELDS = {"id": None, "body": None, "user": _USER_FIELDS, "created_at": None, "updated_at": None,
+                  "issue_url": None}
+
+# Maximum number of pages to fetch concurrently once the number of pages is known, how many of them are actually in
+# flight at the same time is up to the adaptive read limit
+PAGE_FETCH_WORKERS = concurrency.reads.maximum
+
+
+##~~ authentication and requests
+
+
+# known rate limit state per token, shared by all pools: token => (remaining, reset timestamp)
+_rate_limits = dict()
+
+
+class TokenPool(object):
+	"""
+	A pool of API tokens to spread requests over.
+
+	Reads use the token with the most remaining rate limit budget, skipping exhausted tokens until their limit
+	resets. Writes always use the same token for the same repository, so comments and label changes keep being
+	attributed to the same (bot) user. Can be used wherever headers for requests against the API are expected.
+	"""
+
+	def __init__(self, tokens, repo=None):
+		import zlib
+
+		self.tokens = list(tokens)
+		if repo:
+			self.write_token = self.tokens[(zlib.crc32(repo.encode("utf-8")) & 0xffffffff) % len(self.tokens)]
+		else:
+			self.write_token = self.tokens[0]
+
+	def pick(self, write=False):
+		"""
+		Picks the token to use for the next request.
+
+		:param write: whether the request is a write, which uses the repository's write token
+		:return: the token to use
+		"""
+
+		if write:
+			return self.write_token
+
+		import time
+		now = time.time()
+
+		def budget(token):
+			remaining, reset = _rate_limits.get(token, (None, None))
+			if remaining is None or reset < now:
+				# unknown or already reset, assume it's fresh
+				return float("inf")
+			return remaining
+
+		available = filter(lambda token: budget(token) > 0, self.tokens)
+		if not available:
+			token = min(self.tokens, key=lambda token: _rate_limits[token][1])
+			logger.warn("All tokens are exhausted, using the one resetting first")
+			return token
+		return max(available, key=budget)
+
+	def update(self, token, response):
+		"""
+		Updates the known rate limit state of ``token`` from the headers of ``response``. Responses of the search API
+		are ignored, they report its own, much lower rate limit.
+		"""
+
+		if response.url and "/search/" in urlparse.urlparse(response.url).path:
+			return
+
+		remaining = response.headers.get("X-RateLimit-Remaining")
+		reset = response.headers.get("X-RateLimit-Reset")
+		if remaining is not None and reset is not None:
+			_rate_limits[token] = (int(remaining), int(reset))
+
+
+def auth_headers(token, repo=None):
+	"""
+	Creates the headers to use for requests against the API.
+
+	:param token: the token or a list of tokens to use
+	:param repo:  the repository to work on, used for choosing a stable write token if multiple tokens are given
+	:return: the headers, a :class:`TokenPool` if multiple tokens are given
+	"""
+
+	if isinstance(token, TokenPool):
+		return token
+	if isinstance(token, (list, tuple)):
+		if len(token) > 1:
+			return TokenPool(token, repo=repo)
+		token = token[0]
+	return {"Authorization": "token {token}".format(token=token)}
+
+
+def api_request(method, url, headers=None, write=None, etag=None, **kwargs):
+	"""
+	Performs a request against the API. All requests should go through here.
+
+	:param method:  the HTTP method
+	:param url:     the URL to request
+	:param headers: headers to use for requests against API, may be a :class:`TokenPool`
+	:param write:   whether to use the write token of a :class:`TokenPool`, defaults to true for anything but GET
+	:param etag:    ETag of an earlier response, makes the request conditional. A 304 response doesn't count against
+	                the rate limit
+	:return: the response
+	"""
 
+	if write is None:
+		write = method.upper() != "GET"
+
+	token = None
+	if isinstance(headers, TokenPool):
+		pool = headers
+		token = pool.pick(write=write)
+		headers = auth_headers(token)
+	if etag is not None:
+		headers = dict(headers or dict())
+		headers["If-None-Match"] = etag
+
+	leases.check()
+	budget.count_request()
+	logs.count_request()
+
+	with tracing.span("HTTP " + method.upper(), kind=tracing.KIND_CLIENT, **{"http.method": method.upper(), "http.url": url}) as span:
+		limit = concurrency.limit_for(write=write)
+		limit.acquire()
+		r = None
+		start = time.time()
+		try:
+			if cassette.active() is not None:
+				r = cassette.active().request(method, url, headers=headers, **kwargs)
+			else:
+				r = requests.request(method, url, headers=headers, **kwargs)
+		finally:
+			limit.release(r, time.time() - start)
+		span.set("http.status_code", r.status_code)
+
+	if token is not None:
+		pool.update(token, r)
+	return r
+
+
+def api_get(url, headers=None, **kwargs):
+	return api_request("GET", url, headers=headers, **kwargs)
+
+
+def api_post(url, headers=None, **kwargs):
+	return api_request("POST", url, headers=headers, **kwargs)
+
+
+def api_patch(url, headers=None, **kwargs):
+	return api_request("PATCH", url, headers=headers, **kwargs)
+
+
+##~~ logging
+
+
+def setup_logging(debug=False, structured=False, sample=None, repo=None):
+	"""
+	Sets up logging to stdout.
+
+	:param debug:      whether to enable debug logging
+	:param structured: whether to log JSON lines, written by a background thread so a slow stdout doesn't stall the
+	                   run, instead of plain text
+	:param sample:     with structured logging, only log the info lines of every n-th issue or PR
+	:param repo:       with structured logging, the repository to add to every line
+	"""
 
-def setup_logging(debug=False):
 	root = logging.getLogger()
 
 	# set proper level
 	root.setLevel(logging.DEBUG if debug else logging.INFO)
 
 	# we only want a stdout handler
-	for handler in root.handlers:
+	for handler in list(root.handlers):
 		root.removeHandler(handler)
-	console = logging.StreamHandler(stream=sys.stdout)
-	console.setFormatter(logging.Formatter(fmt="%(asctime)-15s %(message)s"))
-	root.addHandler(console)
+		handler.close()
+	if structured:
+		root.addHandler(logs.handler(sys.stdout, repo=repo, sample=sample))
+	else:
+		console = logging.StreamHandler(stream=sys.stdout)
+		console.setFormatter(logging.Formatter(fmt="%(asctime)-15s %(message)s"))
+		root.addHandler(console)
 
 	logging.getLogger("requests").setLevel(logging.WARN)
 
@@ -62,6 +277,7 @@ def convert_to_internal(issue):
 		"comments": issue["comments"],
 		"comments_url": issue["comments_url"],
 		"url": issue["url"],
+		"number": issue["number"],
 		"id": issue["id"]
 	}
 
@@ -84,21 +300,71 @@ def convert_to_internal_pr(pr):
 		"comments_url": pr["comments_url"],
 		"issue_url": pr["issue_url"],
 		"diff_url": pr["diff_url"],
+		"number": pr["number"],
 		"id": pr["id"]
 	}
 
 
+def set_labels(issue, labels, headers, dryrun=False):
+	"""
+	Sets the labels of the issue (or PR) and updates its ``labels`` accordingly.
+
+	If label writes are deferred for the issue (see :func:`defer_label_writes`), the labels are only recorded and
+	written in one go by :func:`flush_labels`, which allows merging the label changes of several bots.
+
+	:param issue:   the (converted) issue to label
+	:param labels:  the full list of labels the issue should carry
+	:param headers: headers to use for requests against API
+	:param dryrun:  whether to only simulate the writing API calls
+	"""
+
+	before = issue.pop("labels_before", issue["labels"])
+	issue["labels"] = list(labels)
+	if issue.get("defer_labels"):
+		issue["labels_before"] = before
+		issue["labels_changed"] = True
+		return
+
+	actions.set_labels(issue, before, headers, dryrun=dryrun)
+
+
+def defer_label_writes(issue):
+	"""
+	Defers all label writes for the issue until :func:`flush_labels` is called.
+	"""
+
+	issue["defer_labels"] = True
+	issue["labels_changed"] = False
+
+
+def flush_labels(issue, headers, dryrun=False):
+	"""
+	Writes the labels recorded for an issue with deferred label writes, if they were changed.
+	"""
+
+	issue["defer_labels"] = False
+	if issue.pop("labels_changed", False):
+		logger.debug("-> Writing merged labels via PATCH %s, labels=%r" % (_labels_url(issue), issue["labels"]))
+		set_labels(issue, issue["labels"], headers, dryrun=dryrun)
+
+
+def _labels_url(issue):
+	# PRs carry their labels on the corresponding issue
+	return issue.get("issue_url") or issue["url"]
+
+
 def get_bot_id(headers):
 	"""
-	Retrieves the id of the bot.
+	Retrieves the id of the bot, that is the user whose token is used for writing.
 
 	:param headers: headers to use for requests against API
 	:return: the bot's user id
 	"""
 
 	logger.debug("Retrieving bot id from URL %s" % USER_URL)
-	r = requests.get(USER_URL, headers=headers)
-	myself = r.json()
+	with phase("bot_id"):
+		r = api_get(USER_URL, headers=headers, write=True)
+		myself = r.json()
 	return myself["id"]
 
 
@@ -113,85 +379,698 @@ def no_pullrequests(issue):
 	return not "pull_request" in issue
 
 
-def get_issues(token, repo, since=None, issue_filter=None, converter=None):
+def build_query_url(url, state="open", since=None, labels=None, sort=None, direction=None, creator=None, per_page=100):
+	"""
+	Builds the URL for querying one of Github's issue or PR list endpoints, letting the server do the filtering.
+
+	:param url:       URL of the list endpoint, e.g. ``ISSUES_URL`` formatted for the repository
+	:param state:     state of the entries to return (``open``, ``closed`` or ``all``)
+	:param since:     only return entries updated after this datetime
+	:param labels:    only return entries carrying all of these labels
+	:param sort:      what to sort by (``created``, ``updated`` or ``comments``)
+	:param direction: sort direction (``asc`` or ``desc``)
+	:param creator:   only return entries created by this user
+	:param per_page:  page size, defaults to the maximum of 100
+	:return: the URL including the query
+	"""
+
+	params = [("state", state)]
+	if since is not None:
+		params.append(("since", since.isoformat()))
+	if labels:
+		params.append(("labels", ",".join(labels)))
+	if sort is not None:
+		params.append(("sort", sort))
+	if direction is not None:
+		params.append(("direction", direction))
+	if creator is not None:
+		params.append(("creator", creator))
+	if per_page is not None:
+		params.append(("per_page", str(per_page)))
+
+	return url + "?" + urllib.urlencode([(key, value.encode("utf-8") if isinstance(value, unicode) else value) for key, value in params])
+
+
+def get_issues(token, repo, since=None, issue_filter=None, converter=None, labels=None, creator=None, created_after=None):
 	"""
 	Retrieves all issues for the ``repo``, optionally filtering them by
 	``issue_filter`` (defaults to no filter if not set) and converting
 	them via ``converter`` (defaults to no converter if not
 	set).
 
-	:param token:        token to use
-	:param repo:         repository for which to retrieve the issues
-	:param issue_filter: filter to apply, defaults to no filter
-	:param converter:    converter to apply, defaults to no conversion
+	:param token:         token to use
+	:param repo:          repository for which to retrieve the issues
+	:param since:         only retrieve issues updated after this datetime
+	:param issue_filter:  filter to apply, defaults to no filter
+	:param converter:     converter to apply, defaults to no conversion
+	:param labels:        only retrieve issues carrying all of these labels
+	:param creator:       only retrieve issues created by this user
+	:param created_after: only retrieve issues created after this datetime, the issues are then fetched newest first
+	                      and the pagination stops at the first older one
 	:return: all issues not filtered out, converted via the converter
 	"""
 
-	if since is None:
-		url = ISSUES_URL.format(repo=repo)
-	else:
-		url = ISSUES_SINCE_URL.format(repo=repo, since=urllib.quote(since.isoformat()))
-	return get_from_api(token, url, entry_filter=issue_filter, converter=converter)
+	if mirror.active() is not None:
+		entries = mirror.active().issues(since=since, labels=labels, creator=creator, created_after=created_after)
+		return _filter_and_convert(entries, entry_filter=issue_filter, converter=converter)
+
+	url = ISSUES_URL.format(repo=repo)
+	if created_after is not None:
+		url = build_query_url(url, since=since, labels=labels, creator=creator, sort="created", direction="desc")
+		return _get_created_after(token, url, created_after, entry_filter=issue_filter, converter=converter, fields=ISSUE_FIELDS)
 
+	url = build_query_url(url, since=since, labels=labels, creator=creator)
+	return get_from_api(token, url, entry_filter=issue_filter, converter=converter, fields=ISSUE_FIELDS)
+
+
+def get_prs(token, repo, pr_filter=None, converter=None, created_after=None):
+	"""
+	Retrieves all open PRs for the ``repo``, see :func:`get_issues`.
+	"""
+
+	if mirror.active() is not None:
+		entries = mirror.active().prs(created_after=created_after)
+		return _filter_and_convert(entries, entry_filter=pr_filter, converter=converter)
 
-def get_prs(token, repo, pr_filter=None, converter=None):
 	url = PRS_URL.format(repo=repo)
-	return get_from_api(token, url, entry_filter=pr_filter, converter=converter)
+	if created_after is not None:
+		url = build_query_url(url, sort="created", direction="desc")
+		return _get_created_after(token, url, created_after, entry_filter=pr_filter, converter=converter, fields=PR_FIELDS)
 
+	url = build_query_url(url)
+	return get_from_api(token, url, entry_filter=pr_filter, converter=converter, fields=PR_FIELDS)
 
-def get_from_api(token, url, entry_filter=None, converter=None):
-	headers = {"Authorization": "token {token}".format(token=token)}
+
+def _get_created_after(token, url, created_after, entry_filter=None, converter=None, fields=None):
+	headers = auth_headers(token)
 
 	if entry_filter is None:
 		entry_filter = lambda x: True
 	if converter is None:
 		converter = lambda x: x
 
+	if created_after.tzinfo is None:
+		created_after = created_after.replace(tzinfo=dateutil.tz.tzutc())
+
 	raw_entries = []
-	while True:
-		logger.debug("Retrieving entries from url %s" % url)
-		r = requests.get(url, headers=headers)
+	with phase("listing"):
+		for entry in iter_from_api(headers, url, fields=fields):
+			if dateutil.parser.parse(entry["created_at"]) < created_after:
+				break
+			raw_entries.append(entry)
+
+	logger.debug("Found %d unfiltered entries created after %s" % (len(raw_entries), created_after.isoformat()))
+	with phase("conversion"):
+		entries = filter(entry_filter, raw_entries)
+		logger.debug("%d entries left after filter" % len(entries))
+
+		return filter(lambda x: x is not None, map(converter, entries))
+
+
+def _filter_and_convert(entries, entry_filter=None, converter=None):
+	if entry_filter is None:
+		entry_filter = lambda x: True
+	if converter is None:
+		converter = lambda x: x
+
+	logger.debug("Found %d unfiltered entries in mirror" % len(entries))
+	with phase("conversion"):
+		entries = filter(entry_filter, entries)
+		logger.debug("%d entries left after filter" % len(entries))
+
+		return filter(lambda x: x is not None, map(converter, entries))
+
+
+def get_issue(headers, url):
+	"""
+	Retrieves a single issue (or the issue side of a PR).
+
+	:param headers: headers to use for requests against API
+	:param url:     the issue's API URL
+	:return: the issue projected onto ``ISSUE_FIELDS``, None if it doesn't exist
+	"""
+
+	if mirror.active() is not None:
+		return mirror.active().issue(int(url.rstrip("/").rsplit("/", 1)[1]))
+
+	r = api_get(url, headers=headers)
+	if r.status_code == 404:
+		return None
+	r.raise_for_status()
+	return project(json_loads(r.content), ISSUE_FIELDS)
+
+
+class SearchNotPossible(Exception):
+	"""
+	Raised if a query can't be answered by the search API, e.g. because it's too long, matches too many results
+	or the search rate limit is exhausted. Callers should fall back to listing.
+	"""
+	pass
+
+
+def build_search_query(repo, created_after=None, excluded_labels=None):
+	"""
+	Builds an issue search query for open issues in ``repo``.
+
+	:param repo:            repository to search in
+	:param created_after:   only match issues created at or after this datetime
+	:param excluded_labels: don't match issues carrying any of these labels
+	:return: the query string
+	"""
+
+	terms = ["repo:{repo}".format(repo=repo), "is:issue", "is:open"]
+	if created_after is not None:
+		created_after = created_after.astimezone(dateutil.tz.tzutc()) if created_after.tzinfo is not None else created_after
+		terms.append("created:>={date}".format(date=created_after.strftime("%Y-%m-%dT%H:%M:%SZ")))
+	if excluded_labels:
+		for label in excluded_labels:
+			terms.append(u"-label:\"{label}\"".format(label=label))
+	return u" ".join(terms)
+
+
+def search_issues(token, query, issue_filter=None, converter=None):
+	"""
+	Retrieves all issues matching the search ``query``.
+
+	The search API has its own, much lower rate limit. If it's exhausted the search waits for its reset if that's
+	due within ``SEARCH_MAX_WAIT`` seconds.
+
+	:param token:        token to use
+	:param query:        the search query, see :func:`build_search_query`
+	:param issue_filter: filter to apply, defaults to no filter
+	:param converter:    converter to apply, defaults to no conversion
+	:return: all matching issues not filtered out, converted via the converter
+	:raises SearchNotPossible: if the query is too long, has too many results, the rate limit is exhausted or the
+	                           search fails otherwise
+	"""
+
+	if mirror.active() is not None:
+		raise SearchNotPossible("Reading from a mirror")
+	if len(query) > SEARCH_QUERY_MAX_LENGTH:
+		raise SearchNotPossible("Query is longer than {max} characters".format(max=SEARCH_QUERY_MAX_LENGTH))
+
+	headers = auth_headers(token)
+
+	if issue_filter is None:
+		issue_filter = lambda x: True
+	if converter is None:
+		converter = lambda x: x
+
+	url = SEARCH_ISSUES_URL + "?" + urllib.urlencode([("q", query.encode("utf-8")), ("per_page", "100")])
+	raw_entries = []
+	try:
+		with phase("listing"):
+			while url:
+				logger.debug("Searching issues via url %s" % url)
+				r = api_get(url, headers=headers)
+				if r.status_code in (403, 429) and r.headers.get("X-RateLimit-Remaining") == "0":
+					_wait_for_search_reset(r)
+					continue
+				r.raise_for_status()
+
+				result = json_loads(r.content)
+				if result.get("total_count", 0) > SEARCH_MAX_RESULTS:
+					raise SearchNotPossible("Query matches more than {max} results".format(max=SEARCH_MAX_RESULTS))
+				if result.get("incomplete_results"):
+					raise SearchNotPossible("Search results are incomplete")
+				logger.debug("+ %d entries" % len(result["items"]))
+				raw_entries += project(result["items"], ISSUE_FIELDS)
+
+				url = r.links["next"]["url"] if r.links and "next" in r.links and "url" in r.links["next"] else None
+				if url and r.headers.get("X-RateLimit-Remaining") == "0":
+					_wait_for_search_reset(r)
+	except (requests.exceptions.RequestException, ValueError) as e:
+		# e.g. a query the search doesn't understand or a secondary rate limit, whatever it is listing might still work
+		raise SearchNotPossible("Search failed: {error}".format(error=e))
+
+	logger.debug("Found %d unfiltered entries" % len(raw_entries))
+	with phase("conversion"):
+		entries = filter(issue_filter, raw_entries)
+		logger.debug("%d entries left after filter" % len(entries))
+
+		return filter(lambda x: x is not None, map(converter, entries))
+
+
+def _wait_for_search_reset(r):
+	import time
+
+	reset = int(r.headers.get("X-RateLimit-Reset", 0))
+	wait = reset - time.time() + 1
+	if wait > SEARCH_MAX_WAIT:
+		raise SearchNotPossible("Search rate limit exhausted for the next {wait:.0f}s".format(wait=wait))
+	if wait > 0:
+		logger.info("Search rate limit exhausted, waiting %.0fs for it to reset" % wait)
+		time.sleep(wait)
+
+
+def json_loads(data):
+	"""
+	Decodes JSON, using the fastest decoder available.
+	"""
+
+	if fastjson is not None:
+		return fastjson.loads(data)
+	return json.loads(data)
+
+
+def project(entry, fields):
+	"""
+	Reduces the decoded ``entry`` to the given ``fields``, see ``ISSUE_FIELDS`` for the format.
+	"""
+
+	if fields is None or entry is None:
+		return entry
+	if isinstance(entry, list):
+		return map(lambda x: project(x, fields), entry)
+	return dict((key, project(entry[key], sub)) for key, sub in fields.items() if key in entry)
+
+
+def fetch_page(headers, url, fields=None):
+	"""
+	Fetches a page of a paginated list endpoint, decoding and projecting its entries.
+
+	If ijson is available and ``fields`` are given, large pages are decoded incrementally while they are being
+	received, so neither the raw page nor its full decoded entries are ever held in memory as a whole.
+
+	:param headers: headers to use for requests against API
+	:param url:     URL of the page
+	:param fields:  fields to project the entries onto, None to keep them as they are
+	:return: tuple of the projected entries, the response and the size of the page in bytes
+	"""
+
+	with tracing.span("page", url=url) as span:
+		stream = ijson is not None and fields is not None
+		r = api_get(url, headers=headers, stream=stream)
 		r.raise_for_status()
 
-		retrieved_issues = r.json()
+		# only the body of a successful response is left unread, e.g. the concurrency control reads that of a 403 to
+		# tell whether it's throttled, which leaves nothing to stream
+		if stream and r.status_code == 200 and int(r.headers.get("Content-Length", STREAM_MIN_BYTES)) >= STREAM_MIN_BYTES:
+			r.raw.decode_content = True
+			reader = _CountingReader(r.raw)
+			entries = map(lambda x: project(x, fields), ijson.items(reader, "item"))
+			size = reader.count
+		else:
+			content = r.content
+			entries = project(json_loads(content), fields)
+			size = len(content)
+
+		span.set("entries", len(entries))
+		span.set("bytes", size)
+	return entries, r, size
+
+
+class _CountingReader(object):
+	def __init__(self, raw):
+		self.raw = raw
+		self.count = 0
+
+	def read(self, size=-1):
+		data = self.raw.read(size)
+		self.count += len(data)
+		return data
+
+
+def get_from_api(token, url, entry_filter=None, converter=None, workers=PAGE_FETCH_WORKERS, fields=None):
+	"""
+	Retrieves all entries from the paginated list endpoint ``url``.
+
+	The first page is fetched on its own. If the response carries a ``rel="last"`` link, the URLs of all remaining
+	pages are derived from it and fetched concurrently by up to ``workers`` threads, otherwise the ``rel="next"``
+	links are followed one by one. Either way the entries are returned in page order.
+
+	:param token:        token to use
+	:param url:          URL of the first page
+	:param entry_filter: filter to apply, defaults to no filter
+	:param converter:    converter to apply, defaults to no conversion
+	:param workers:      maximum number of pages to fetch concurrently
+	:param fields:       fields to project the entries onto right when decoding them, see ``ISSUE_FIELDS``
+	:return: all entries not filtered out, converted via the converter
+	"""
+
+	headers = auth_headers(token)
+
+	if entry_filter is None:
+		entry_filter = lambda x: True
+	if converter is None:
+		converter = lambda x: x
+
+	def fetch(page_url):
+		logger.debug("Retrieving entries from url %s" % page_url)
+		with tracing.attach(listing):
+			return fetch_page(headers, page_url, fields=fields)[:2]
+
+	raw_entries = []
+	with phase("listing"), tracing.span("listing", url=url):
+		# pages fetched by the pool belong to the listing as well
+		listing = tracing.current()
+
+		retrieved_issues, r = fetch(url)
 		logger.debug("+ %d entries" % len(retrieved_issues))
 		raw_entries += retrieved_issues
 
-		if r.links and "next" in r.links and "url" in r.links["next"]:
-			url = r.links["next"]["url"]
+		page_urls = _page_urls_from_last(r.links)
+		if page_urls and workers > 1:
+			from multiprocessing.pool import ThreadPool
+			pool = ThreadPool(min(workers, len(page_urls)))
+			try:
+				for retrieved_issues in pool.imap(lambda u: fetch(u)[0], page_urls):
+					logger.debug("+ %d entries" % len(retrieved_issues))
+					raw_entries += retrieved_issues
+			finally:
+				pool.close()
+				pool.join()
+
 		else:
-			break
+			while r.links and "next" in r.links and "url" in r.links["next"]:
+				retrieved_issues, r = fetch(r.links["next"]["url"])
+				logger.debug("+ %d entries" % len(retrieved_issues))
+				raw_entries += retrieved_issues
 
 	logger.debug("Found %d unfiltered entries" % len(raw_entries))
-	entries = filter(entry_filter, raw_entries)
-	logger.debug("%d entries left after filter" % len(entries))
+	with phase("conversion"):
+		entries = filter(entry_filter, raw_entries)
+		logger.debug("%d entries left after filter" % len(entries))
+
+		return filter(lambda x: x is not None, map(converter, entries))
+
+
+def get_repo_comments(token, repo, since):
+	"""
+	Retrieves all comments on any issue or PR in ``repo`` created or updated since ``since``, in order of creation.
+
+	:param token: token to use
+	:param repo:  repository for which to retrieve the comments
+	:param since: datetime after which comments must have been created or updated
+	:return: a :class:`CommentIndex` of the retrieved comments
+	"""
+
+	if mirror.active() is not None:
+		index = CommentIndex(since)
+		for comment in mirror.active().repo_comments(since):
+			index.add(comment)
+		return index
+
+	url = REPO_COMMENTS_SINCE_URL.format(repo=repo, since=urllib.quote(since.isoformat()))
+	index = CommentIndex(since)
+	for comment in get_from_api(token, url, fields=COMMENT_FIELDS):
+		index.add(comment)
+	logger.debug("Indexed %d comments on %d issues" % (index.count, len(index.by_issue)))
+	return index
+
+
+class CommentIndex(object):
+	"""
+	In-memory index of comments grouped by issue, as retrieved from the repository wide comment stream.
+
+	The index is only complete for comments created or updated after ``since``.
+	"""
+
+	def __init__(self, since):
+		self.since = since
+		self.by_issue = dict()
+		self.count = 0
+
+	def add(self, comment):
+		self.by_issue.setdefault(comment["issue_url"], []).append(comment)
+		self.count += 1
+
+	def covers(self, since):
+		"""Whether the index contains all comments created or updated after ``since``."""
+		return since is not None and since >= self.since
+
+	def comments_for(self, issue_url, since=None):
+		comments = self.by_issue.get(issue_url, [])
+		if since is None:
+			return list(comments)
+		return [comment for comment in comments if dateutil.parser.parse(comment["updated_at"]) >= since]
+
+	def last_comment_by(self, issue_url, user_id):
+		"""
+		The last comment by ``user_id`` on the issue that is contained in the index. Note that None only means
+		there's no such comment after ``since``.
+		"""
+		for comment in reversed(self.by_issue.get(issue_url, [])):
+			if comment["user"]["id"] == user_id:
+				return comment
+		return None
+
+
+class ScanStats(object):
+	"""
+	Bookkeeping for streaming scans via :func:`iter_from_api`, tracks what was fetched and what could be skipped.
+	"""
+
+	def __init__(self):
+		self.pages = 0
+		self.bytes = 0
+		self.entries = 0
+		self.skipped_entries = 0
+		self.skipped_pages = 0
+
+	@property
+	def saved_bytes(self):
+		"""Estimated number of bytes not downloaded, based on the average size of the entries fetched so far."""
+		if not self.entries:
+			return 0
+		return self.skipped_entries * self.bytes // self.entries
+
+	def __str__(self):
+		return "{pages} pages/{bytes} bytes fetched, ~{skipped_pages} pages/~{saved_bytes} bytes saved".format(pages=self.pages,
+		                                                                                                       bytes=self.bytes,
+		                                                                                                       skipped_pages=self.skipped_pages,
+		                                                                                                       saved_bytes=self.saved_bytes)
+
+
+def iter_pages(headers, url, stats=None, fields=None):
+	"""
+	Lazily iterates over the pages of the paginated list endpoint ``url``, following the ``rel="next"`` links only
+	as far as the caller consumes the pages.
+
+	:param headers: headers to use for requests against API
+	:param url:     URL of the first page
+	:param stats:   optional :class:`ScanStats` to update
+	:param fields:  fields to project the entries onto, see ``ISSUE_FIELDS``
+	:return: generator over tuples of the page's entries and the URL of the next page (None for the last page)
+	"""
+
+	while url:
+		logger.debug("Retrieving entries from url %s" % url)
+		entries, r, size = fetch_page(headers, url, fields=fields)
+
+		url = r.links["next"]["url"] if r.links and "next" in r.links and "url" in r.links["next"] else None
+		if stats is not None:
+			stats.pages += 1
+			stats.bytes += size
+			stats.entries += len(entries)
+
+		yield entries, url
+
+
+def iter_from_api(headers, url, stats=None, fields=None):
+	"""
+	Lazily iterates over all entries of the paginated list endpoint ``url``, following the ``rel="next"`` links only
+	as far as the caller consumes the entries. Stopping the iteration early thus saves the remaining requests.
+
+	:param headers: headers to use for requests against API
+	:param url:     URL of the first page
+	:param stats:   optional :class:`ScanStats` to update
+	:param fields:  fields to project the entries onto, see ``ISSUE_FIELDS``
+	:return: generator over all entries
+	"""
+
+	for entries, _ in iter_pages(headers, url, stats=stats, fields=fields):
+		for entry in entries:
+			yield entry
+
+
+def iter_comments(headers, comments_url, since=None, stats=None, live=False):
+	"""
+	Lazily iterates over the comments at ``comments_url``, see :func:`iter_from_api`.
+
+	:param headers:      headers to use for requests against API
+	:param comments_url: the comments URL of the issue or PR
+	:param since:        if set only comments created or updated after this datetime will be fetched
+	:param stats:        optional :class:`ScanStats` to update
+	:param live:         whether to always ask the API, even if reading from a mirror
+	:return: generator over the comments
+	"""
+
+	if mirror.active() is not None and not live:
+		return iter(mirror.active().comments(_issue_url(comments_url), since=since))
+
+	url = "{url}?per_page={per_page}".format(url=comments_url, per_page=COMMENTS_PER_PAGE)
+	if since is not None:
+		url += "&since={since}".format(since=urllib.quote(since.isoformat()))
+	return iter_from_api(headers, url, stats=stats, fields=COMMENT_FIELDS)
+
+
+def get_last_comment_by(headers, comments_url, user_id, comment_count=None, stats=None):
+	"""
+	Finds the most recent comment made by ``user_id`` at ``comments_url``.
+
+	Comments are scanned newest first. If ``comment_count`` is known the last page is requested directly, otherwise
+	the ``rel="last"`` link of the first page is followed. From there ``rel="prev"`` links are followed until a
+	matching comment is found, so usually only one or two requests are needed regardless of the length of the thread.
+
+	:param headers:       headers to use for requests against API
+	:param comments_url:  the comments URL of the issue or PR
+	:param user_id:       id of the user whose last comment to find
+	:param comment_count: number of comments on the issue if known
+	:param stats:         optional :class:`ScanStats` to update
+	:return: the comment or None if the user never commented
+	"""
+
+	if mirror.active() is not None:
+		for comment in reversed(mirror.active().comments(_issue_url(comments_url))):
+			if comment["user"]["id"] == user_id:
+				return comment
+		return None
 
-	return filter(lambda x: x is not None, map(converter, entries))
+	last_page = 1
+	if comment_count:
+		last_page = max(1, (comment_count + COMMENTS_PER_PAGE - 1) // COMMENTS_PER_PAGE)
+
+	url = "{url}?per_page={per_page}&page={page}".format(url=comments_url, per_page=COMMENTS_PER_PAGE, page=last_page)
+	jumped = comment_count is not None
+	while url:
+		logger.debug("Retrieving comments from url %s" % url)
+		comments, r, size = fetch_page(headers, url, fields=COMMENT_FIELDS)
+
+		if not jumped and r.links and "last" in r.links and "url" in r.links["last"]:
+			# we started at the first page and there are more, jump to the last one
+			jumped = True
+			url = r.links["last"]["url"]
+			continue
+		jumped = True
+
+		if stats is not None:
+			stats.pages += 1
+			stats.bytes += size
+			stats.entries += len(comments)
+
+		for comment in reversed(comments):
+			if comment["user"]["id"] == user_id:
+				return comment
+
+		url = r.links["prev"]["url"] if r.links and "prev" in r.links and "url" in r.links["prev"] else None
+
+	return None
+
+
+def _issue_url(comments_url):
+	return comments_url[:-len("/comments")] if comments_url.endswith("/comments") else comments_url
+
+
+def _page_urls_from_last(links):
+	"""
+	Derives the URLs of all pages following the first one from the ``rel="next"`` and ``rel="last"`` links of the
+	first page's response.
+
+	:param links: the links of the response to the first page
+	:return: list of URLs of pages 2 to last, or None if they can't be derived
+	"""
+
+	if not links or not "next" in links or not "last" in links:
+		return None
+
+	next_url = links["next"].get("url")
+	last_url = links["last"].get("url")
+	if not next_url or not last_url:
+		return None
+
+	parsed = urlparse.urlparse(last_url)
+	query = urlparse.parse_qsl(parsed.query, keep_blank_values=True)
+	pages = [value for key, value in query if key == "page"]
+	if len(pages) != 1 or not pages[0].isdigit():
+		return None
+	last_page = int(pages[0])
+
+	urls = []
+	for page in range(2, last_page + 1):
+		page_query = [(key, str(page) if key == "page" else value) for key, value in query]
+		urls.append(urlparse.urlunparse(parsed._replace(query=urllib.urlencode(page_query))))
+	return urls
+
+
+# the YAML loader for config files, created on first use
+_config_loader = None
+
+# parsed config files by path, along with the mtime and size they were parsed at
+_config_cache = dict()
+
+
+def config_loader():
+	"""
+	:return: the YAML loader to use for config files, the C accelerated one if available, parsing timestamps with
+	         their time zone
+	"""
+
+	global _config_loader
+	if _config_loader is None:
+		import yaml
+
+		try:
+			base = yaml.CSafeLoader
+		except AttributeError:
+			# libyaml not available
+			base = yaml.SafeLoader
+
+		class ConfigLoader(base):
+			pass
+
+		def datetime_constructor(loader, node):
+			return dateutil.parser.parse(node.value)
+		ConfigLoader.add_constructor(u'tag:yaml.org,2002:timestamp', datetime_constructor)
+
+		_config_loader = ConfigLoader
+	return _config_loader
 
 
 def load_config(file):
 	"""
 	Loads a config from the file
 
+	The parsed file is cached as long as its mtime and size stay the same, so loading an unchanged config again, e.g.
+	for the follow-up pass of a run, doesn't parse it again.
+
 	:param file: the file from which to load the config
 	:return: the loaded config represented as a dictionary, might be empty if config file was not found or empty
 	"""
 	import yaml
 	import os
 
-	def datetime_constructor(loader, node):
-		return dateutil.parser.parse(node.value)
-	yaml.SafeLoader.add_constructor(u'tag:yaml.org,2002:timestamp', datetime_constructor)
-
 	config = None
 	if file is not None and os.path.exists(file) and os.path.isfile(file):
-		with open(file, "r") as f:
-			config = yaml.safe_load(f)
+		stat = os.stat(file)
+		key = os.path.abspath(file)
+
+		cached = _config_cache.get(key)
+		if cached is not None and cached[0] == (stat.st_mtime, stat.st_size):
+			config = cached[1]
+		else:
+			with phase("config"):
+				with open(file, "r") as f:
+					config = yaml.load(f, Loader=config_loader())
+			_config_cache[key] = ((stat.st_mtime, stat.st_size), config)
 
 	if config is None:
 		config = {}
 
-	return config
+	# callers fill in defaults and override values, they must not change the cached config
+	return _copy_containers(config)
+
+
+def _copy_containers(value):
+	"""
+	Copies the dicts and lists of a parsed config, everything else YAML produces is immutable and can be shared.
+	"""
+
+	if isinstance(value, dict):
+		return dict((key, _copy_containers(item)) for key, item in value.items())
+	elif isinstance(value, list):
+		return map(_copy_containers, value)
+	return value
 
 
 def update_config(filename, since=datetime.datetime.utcnow()):
@@ -200,27 +1079,295 @@ def update_config(filename, since=datetime.datetime.utcnow()):
 	import shutil
 
 	if filename is not None and os.path.exists(filename) and os.path.isfile(filename):
-		# load config from file
-		with open(filename, "r") as f:
-			config = yaml.safe_load(f)
-		if config is None:
-			return
+		with phase("config_writeback"):
+			# load config from file
+			with open(filename, "r") as f:
+				config = yaml.load(f, Loader=config_loader())
+			if config is None:
+				return
 
-		# update since
-		config["since"] = since.replace(tzinfo=dateutil.tz.tzutc())
+			# update since, but never move it back, a run that took longer than a later one must not undo its progress
+			since = since.replace(tzinfo=dateutil.tz.tzutc())
+			previous = config.get("since")
+			if isinstance(previous, datetime.datetime):
+				if previous.tzinfo is None:
+					previous = previous.replace(tzinfo=dateutil.tz.tzutc())
+				if previous > since:
+					logger.warn("%s already has a later since (%s) than this run (%s), keeping it" % (filename, previous.isoformat(), since.isoformat()))
+					return
+			config["since"] = since
 
-		# write back the config
-		tmpfilename = filename + ".tmp"
-		try:
-			with open(tmpfilename, "w") as f:
-				yaml.safe_dump(config, f, default_flow_style=False, indent="    ", allow_unicode=True)
-			shutil.copyfile(tmpfilename, filename)
-		finally:
-			os.remove(tmpfilename)
+			# write back the config
+			tmpfilename = filename + ".tmp"
+			try:
+				with open(tmpfilename, "w") as f:
+					yaml.safe_dump(config, f, default_flow_style=False, indent="    ", allow_unicode=True)
+				shutil.copyfile(tmpfilename, filename)
+			finally:
+				os.remove(tmpfilename)
+
+			# the mtime might not have changed if the file was loaded within the same second
+			_config_cache.pop(os.path.abspath(filename), None)
 
 		logger.info("Saved current date and time for next run")
 
 
+##~~ running bots
+
+
+def add_common_arguments(parser):
+	"""
+	Adds the CLI arguments shared by all bots to ``parser``, see :func:`merge_common_arguments` and :func:`run_bot`.
+
+	:param parser: the ``argparse.ArgumentParser`` to add the arguments to
+	"""
+
+	parser.add_argument("--plan", action="store", dest="plan",
+	                    help="File to write the planned actions to as JSON, combine with --dry-run to only plan. Defaults to not set")
+	parser.add_argument("--dead-letters", action="store", dest="dead_letters",
+	                    help="File to save actions that failed to, they are retried during the next run. Defaults to <config>.failed.json if a config file is used, otherwise failed actions are only logged")
+	parser.add_argument("--max-runtime", action="store", dest="max_runtime", type=int,
+	                    help="Maximum runtime of the run in seconds, once exceeded the remaining work is left to the next run. Defaults to no limit")
+	parser.add_argument("--max-requests", action="store", dest="max_requests", type=int,
+	                    help="Maximum number of API requests of the run, once exceeded the remaining work is left to the next run. Defaults to no limit")
+	parser.add_argument("--mirror", action="store", dest="mirror",
+	                    help="Read issues, PRs and comments from the local mirror maintained by gitissuebot sync instead of the API, only writes go to the API then")
+	parser.add_argument("--shard-dir", action="store", dest="shard_dir",
+	                    help="Directory shared by all workers to split the work between, enables sharding. Each worker only processes its consistent-hash share of the repositories and uses only its share of the rate limit")
+	parser.add_argument("--shard-worker", action="store", dest="shard_worker",
+	                    help="Id of this worker when sharding, defaults to the host name")
+	parser.add_argument("--shard-range", action="store", dest="shard_range", type=int,
+	                    help="Split the repository into ranges of this many consecutive issue numbers to shard them across the workers, instead of assigning the whole repository to one worker")
+	parser.add_argument("--lease-db", action="store", dest="lease_db",
+	                    help="SQLite file shared by redundant instances, enables leader election. Only the instance holding the lease for the bot and repository is active, the others exit or stand by. A combined run holds the leases of all the bots it runs")
+	parser.add_argument("--lease-holder", action="store", dest="lease_holder",
+	                    help="Id of this instance for leader election, defaults to the host name")
+	parser.add_argument("--standby", action="store_true", dest="lease_standby",
+	                    help="If another instance is active, wait and take over if its lease lapses instead of exiting right away")
+	parser.add_argument("--lock", action="store", dest="lock",
+	                    help="Lock file making sure only one run per bot and repository is going on at a time. Defaults to one file per bot in the temporary directory, a combined run locks those of all the bots it runs")
+	parser.add_argument("--coalesce", action="store_true", dest="coalesce",
+	                    help="If another run is still going on, have it do a follow-up pass once it's done instead of just exiting")
+	parser.add_argument("--log-json", action="store_true", dest="log_json",
+	                    help="Log JSON lines with the repository and the issue or PR, decision, duration and request count where applicable, written in the background so a slow log sink doesn't stall the run")
+	parser.add_argument("--log-sample", action="store", dest="log_sample", type=int,
+	                    help="With --log-json, only log the info lines of every n-th issue or PR, for very large runs. Warnings and errors are always logged")
+	parser.add_argument("--trace", action="store", dest="trace",
+	                    help="Trace the run and write the spans of the run, the listings and their pages, the evaluation of each issue or PR and the API requests to the given file, in the OpenTelemetry JSON format")
+	parser.add_argument("--dry-run", action="store_true", dest="dryrun",
+	                    help="Just print what would be done without actually doing it")
+	parser.add_argument("-v", "--version", action="store_true", dest="version",
+	                    help="Print the version and exit")
+	parser.add_argument("--debug", action="store_true", dest="debug",
+	                    help="Enable debug logging")
+	parser.add_argument("--profile", action="store", dest="profile", nargs="?", const="profile",
+	                    help="Profile the run and write per phase cProfile stats and resource usage to the given directory, defaults to ./profile if no directory is given. Send SIGUSR1 to dump the stats collected so far")
+	parser.add_argument("--record", action="store", dest="record",
+	                    help="Record all requests and responses of the run to the given cassette file, with tokens scrubbed")
+	parser.add_argument("--replay", action="store", dest="replay",
+	                    help="Answer all requests of the run from the given cassette file instead of the API")
+	parser.add_argument("--replay-latency", action="store", dest="replay_latency", type=float, default=1.0,
+	                    help="Factor to apply to the recorded latencies when replaying, 0 to not wait at all. Defaults to 1")
+
+
+def merge_common_arguments(config, args):
+	"""
+	Merges the CLI arguments shared by all bots into ``config``.
+
+	:param config: the config loaded from the config file, if any
+	:param args:   the parsed CLI arguments, see :func:`add_common_arguments`
+	"""
+
+	if args.plan is not None:
+		config["plan"] = args.plan
+	if args.dead_letters is not None:
+		config["dead_letters"] = args.dead_letters
+	elif args.config is not None and not config.get("dead_letters"):
+		config["dead_letters"] = args.config + ".failed.json"
+	if args.max_runtime is not None:
+		config["max_runtime"] = args.max_runtime
+	if args.max_requests is not None:
+		config["max_requests"] = args.max_requests
+	if args.mirror is not None:
+		config["mirror"] = args.mirror
+	if args.shard_dir is not None:
+		config["shard_dir"] = args.shard_dir
+	if args.shard_worker is not None:
+		config["shard_worker"] = args.shard_worker
+	if args.shard_range is not None:
+		config["shard_range"] = args.shard_range
+	if args.lease_db is not None:
+		config["lease_db"] = args.lease_db
+	if args.lease_holder is not None:
+		config["lease_holder"] = args.lease_holder
+	config["lease_standby"] = config["lease_standby"] if "lease_standby" in config and config["lease_standby"] else False or args.lease_standby
+	if args.lock is not None:
+		config["lock"] = args.lock
+	config["coalesce"] = config["coalesce"] if "coalesce" in config and config["coalesce"] else False or args.coalesce
+	config["log_json"] = config["log_json"] if "log_json" in config and config["log_json"] else False or args.log_json
+	if args.log_sample is not None:
+		config["log_sample"] = args.log_sample
+	if args.trace is not None:
+		config["trace"] = args.trace
+	config["dryrun"] = config["dryrun"] if "dryrun" in config and config["dryrun"] else False or args.dryrun
+	config["debug"] = config["debug"] if "debug" in config and config["debug"] else False or args.debug
+
+
+def apply_common_defaults(config, name, bots=None):
+	"""
+	Fills in the defaults of the config values shared by all bots, to be called from the bots' ``validate_config``.
+
+	:param config: the config to validate, ``repo`` must already be set
+	:param name:   name of the bot
+	:param bots:   names of the bots the run covers if it runs several, defaults to just ``name``
+	"""
+
+	if bots is None:
+		bots = [name]
+
+	if not "debug" in config or config["debug"] is None:
+		config["debug"] = False
+	if not "dryrun" in config:
+		config["dryrun"] = False
+	if not "plan" in config or not config["plan"]:
+		config["plan"] = None
+	if not "dead_letters" in config or not config["dead_letters"]:
+		config["dead_letters"] = None
+	if not "max_runtime" in config:
+		config["max_runtime"] = None
+	if not "max_requests" in config:
+		config["max_requests"] = None
+	if not "mirror" in config or not config["mirror"]:
+		config["mirror"] = None
+	if not "shard_dir" in config or not config["shard_dir"]:
+		config["shard_dir"] = None
+	if not "shard_worker" in config or not config["shard_worker"]:
+		config["shard_worker"] = None
+	if not "shard_range" in config or config["shard_range"] is None:
+		config["shard_range"] = 0
+	if not "shard_timeout" in config or config["shard_timeout"] is None:
+		config["shard_timeout"] = sharding.MEMBER_TIMEOUT
+	if not "lease_db" in config or not config["lease_db"]:
+		config["lease_db"] = None
+	if not "lease_holder" in config or not config["lease_holder"]:
+		config["lease_holder"] = None
+	if not "lease_ttl" in config or not config["lease_ttl"]:
+		config["lease_ttl"] = leases.LEASE_TTL
+	if not "lease_standby" in config or config["lease_standby"] is None:
+		config["lease_standby"] = False
+	if not "lock" in config or not config["lock"]:
+		config["lock"] = [runlock.default_path(bot, config["repo"]) for bot in bots]
+	if not "coalesce" in config or config["coalesce"] is None:
+		config["coalesce"] = False
+	if not "log_json" in config or config["log_json"] is None:
+		config["log_json"] = False
+	if not "log_sample" in config or not config["log_sample"]:
+		config["log_sample"] = None
+	if not "trace" in config or not config["trace"]:
+		config["trace"] = None
+
+
+def run_bot(name, config, args, run, bots=None):
+	"""
+	Runs a bot on the validated ``config``: sets up logging, the cassette, the mirror, sharding, the run lock, the
+	lease, tracing and the budget as configured, calls ``run(config, file=..., dryrun=...)`` - again for each
+	follow-up pass other runs asked for, continuing from the ``since`` the previous pass returned - and tears
+	everything down again. Exits the application if the run fails,
+	the lock and lease are always released.
+
+	:param name:   name of the bot
+	:param config: the validated config
+	:param args:   the parsed CLI arguments, see :func:`add_common_arguments`
+	:param run:    function doing one pass over the repository and returning the ``since`` to continue from
+	:param bots:   names of the bots the run covers if it runs several, it then holds the leases of all of them.
+	               Defaults to just ``name``
+	"""
+
+	if bots is None:
+		bots = [name]
+
+	# setup logger
+	setup_logging(debug=config["debug"], structured=config["log_json"], sample=config["log_sample"], repo=config["repo"])
+
+	# record or replay the requests if requested - before anything is acquired that would need to be released again
+	try:
+		if args.replay:
+			cassette.replay(args.replay, latency_scale=args.replay_latency)
+		elif args.record:
+			cassette.record(args.record)
+	except (IOError, ValueError) as e:
+		logger.error("Could not read cassette: %s" % e)
+		sys.exit(-1)
+
+	# read from the local mirror if configured
+	if config["mirror"]:
+		try:
+			mirror.enable(config["mirror"], config["repo"])
+		except ValueError as e:
+			logger.error(str(e))
+			sys.exit(-1)
+
+	# only work on this worker's share if sharding is configured
+	if config["shard_dir"]:
+		shard = sharding.enable(config["shard_dir"], config["repo"], worker=config["shard_worker"],
+		                        range_size=config["shard_range"], timeout=config["shard_timeout"])
+		if not shard.owns_repo():
+			logger.info("%s is handled by worker %s, nothing to do" % (config["repo"], shard.repo_owner))
+			sharding.finish()
+			return
+
+		share = sharding.request_budget(config["token"])
+		if share is not None and (config["max_requests"] is None or share < config["max_requests"]):
+			logger.info("Limiting this worker to %d requests, its share of the remaining rate limit" % share)
+			config["max_requests"] = share
+
+	# only one run per bot and repository at a time on this host, a combined run excludes those of all its bots
+	if not runlock.acquire(config["lock"], coalesce=config["coalesce"]):
+		sharding.finish()
+		return
+
+	# only one of several redundant instances is active per bot and repository
+	if config["lease_db"]:
+		names = ["{bot}:{repo}".format(bot=bot, repo=config["repo"]) for bot in bots]
+		if not leases.acquire(config["lease_db"], names, holder=config["lease_holder"],
+		                      ttl=config["lease_ttl"], standby=config["lease_standby"]):
+			runlock.release()
+			sharding.finish()
+			return
+
+	try:
+		# trace the run if requested
+		if config["trace"]:
+			tracing.enable(config["trace"], name, repo=config["repo"], dryrun=config["dryrun"])
+
+		# limit the run if requested
+		budget.enable(max_runtime=config["max_runtime"], max_requests=config["max_requests"])
+
+		while True:
+			since = run(config, file=args.config, dryrun=config["dryrun"])
+			if not runlock.follow_up():
+				break
+
+			# the follow-up pass continues from where this one left off, with or without a config file to save that in
+			config["since"] = since
+	except leases.LeaseLost as e:
+		# another instance is active now, neither dead letter what's left nor save the progress for it
+		logger.error("%s, aborting the run" % e)
+		sys.exit(-1)
+	except:
+		logger.exception("Error during execution")
+		sys.exit(-1)
+	finally:
+		runlock.release()
+		leases.release()
+		sharding.finish()
+		cassette.finish()
+		tracing.finish()
+		budget.report()
+		concurrency.report()
+		profiling.report()
+
+
 def print_version():
 	from gitissuebot import _version
 	print(_version.get_versions()["version"])
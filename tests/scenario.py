@@ -0,0 +1,176 @@
+# coding=utf-8
+from __future__ import print_function, absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
+
+import datetime
+import json
+import logging
+import os
+import re
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import dateutil.tz
+import yaml
+
+from gitissuebot import actions, cassette, util
+from gitissuebot.benchmark import SyntheticApi, BOT_ID, REPO, scenario_config, _iso
+
+
+def _quiet_logging():
+	# the bots log to stdout once they run, everything else is dropped
+	root = logging.getLogger()
+	for handler in list(root.handlers):
+		root.removeHandler(handler)
+		handler.close()
+	root.addHandler(logging.NullHandler())
+
+_quiet_logging()
+
+
+class ScenarioApi(SyntheticApi):
+	"""
+	:class:`~gitissuebot.benchmark.SyntheticApi` that records the writes it receives and can be told to fail them.
+	Comments posted to it are added to the issue, so the bots see them like they would on GitHub.
+
+	:param size:     number of issues
+	:param on_write: function called with each write before it is answered, e.g. to simulate something happening
+	                 concurrently
+	"""
+
+	def __init__(self, size, on_write=None, **kwargs):
+		SyntheticApi.__init__(self, size, **kwargs)
+		self.on_write = on_write
+		self.writes = []
+		self.urls = []
+		self._failures = dict()
+
+	def fail(self, number, statuses, applied=False):
+		"""
+		Answers the next writes on issue ``number`` with ``statuses``, one per write.
+
+		:param applied: whether the failed writes take effect anyway, like when a proxy in front of the API times out
+		"""
+
+		self._failures[number] = [(status, applied) for status in statuses]
+
+	def written(self, method=None):
+		"""
+		:return: sorted numbers of the issues that received successful writes, optionally only of ``method``
+		"""
+
+		return sorted(set(write["number"] for write in self.writes if write["status"] < 400 and (method is None or write["method"] == method)))
+
+	def request(self, method, url, headers=None, **kwargs):
+		method = method.upper()
+		with self._lock:
+			self.urls.append((method, url))
+		if not method in ("POST", "PATCH"):
+			return SyntheticApi.request(self, method, url, headers=headers, **kwargs)
+
+		with self._lock:
+			self.requests += 1
+			number = int(re.search(r"/issues/(\d+)", url).group(1))
+			body = json.loads(kwargs.get("data") or "{}")
+
+			status, applied = 201 if method == "POST" else 200, True
+			if self._failures.get(number):
+				status, applied = self._failures[number].pop(0)
+
+			self.writes.append(dict(method=method, number=number, body=body, status=status))
+			if applied and method == "POST":
+				now = datetime.datetime.utcnow().replace(tzinfo=dateutil.tz.tzutc())
+				comments = self.comments[number]
+				comments.append({"id": number * 10 + len(comments) + 1, "user": {"login": "gitissuebot", "id": BOT_ID},
+				                 "body": body["body"], "issue_url": self.issues[number - 1]["url"],
+				                 "created_at": _iso(now), "updated_at": _iso(now)})
+				self.issues[number - 1]["comments"] = len(comments)
+
+		if self.on_write is not None:
+			self.on_write(method, number, body)
+		return self._respond(url, status, {"id": 1} if status < 400 else {"message": "Failed"})
+
+
+class ScenarioTestCase(unittest.TestCase):
+	"""
+	Runs bots in-process against a :class:`ScenarioApi`, with their configs and state files in a temporary directory.
+	"""
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self._patched = []
+
+		# retries don't need to wait for anything
+		self.patch(actions, "RETRY_BACKOFF", 0)
+		util._config_cache.clear()
+
+	def tearDown(self):
+		for obj, name, value in reversed(self._patched):
+			setattr(obj, name, value)
+		cassette.serve(None)
+
+		_quiet_logging()
+		shutil.rmtree(self.directory)
+
+	def patch(self, obj, name, value):
+		self._patched.append((obj, name, getattr(obj, name)))
+		setattr(obj, name, value)
+
+	def serve(self, api):
+		"""
+		Answers all requests made from now on via ``api``.
+		"""
+
+		cassette.serve(api)
+
+	def path(self, name):
+		return os.path.join(self.directory, name)
+
+	def write_config(self, scenario, api, name="config.yaml", **values):
+		"""
+		Writes the config of the benchmark ``scenario`` to the temporary directory, updated with ``values``.
+
+		:return: path of the config file
+		"""
+
+		config = scenario_config(scenario, api.now)
+		config["lock"] = self.path(name + ".lock")
+		config.update(values)
+
+		path = self.path(name)
+		with open(path, "w") as f:
+			yaml.safe_dump(config, f, default_flow_style=False)
+		return path
+
+	def read_config(self, path):
+		with open(path, "r") as f:
+			return yaml.load(f, Loader=util.config_loader())
+
+	def run_bot(self, bot, api, config_file, *args):
+		"""
+		Runs ``bot`` with the config file and further CLI ``args`` against ``api``.
+
+		:return: tuple of the run's log output and its exit code, None if it didn't exit
+		"""
+
+		self.serve(api)
+
+		stdout = sys.stdout
+		sys.stdout = output = StringIO.StringIO()
+		code = None
+		try:
+			bot.main(bot.argparser().parse_args(["-c", config_file] + list(args)))
+		except SystemExit as e:
+			code = e.code
+		finally:
+			sys.stdout = stdout
+			util._config_cache.clear()
+		return output.getvalue(), code
@@ -0,0 +1,115 @@
+# coding=utf-8
+from __future__ import print_function, absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
+
+import os
+import unittest
+
+from scenario import ScenarioApi, ScenarioTestCase, REPO
+from gitissuebot import actions, approve
+from gitissuebot.util import auth_headers, convert_to_internal
+
+
+class ActionsTest(ScenarioTestCase):
+
+	def setUp(self):
+		ScenarioTestCase.setUp(self)
+		self.api = ScenarioApi(10)
+		self.serve(self.api)
+		self.headers = auth_headers("benchmark", repo=REPO)
+		actions.start()
+
+	def tearDown(self):
+		actions.finish()
+		ScenarioTestCase.tearDown(self)
+
+	def issue(self, number):
+		return convert_to_internal(self.api.issues[number - 1])
+
+	def label(self, number, label):
+		issue = self.issue(number)
+		before = list(issue["labels"])
+		issue["labels"].append(label)
+		actions.set_labels(issue, before, self.headers)
+
+	def writes(self, number):
+		return [(write["method"], write["status"]) for write in self.api.writes if write["number"] == number]
+
+	def test_retries_failed_write(self):
+		self.api.fail(5, [502])
+		self.label(5, "bug")
+
+		self.assertEqual([], actions.flush(self.headers))
+		self.assertEqual([("PATCH", 502), ("PATCH", 200)], self.writes(5))
+
+	def test_doesnt_repost_comment_created_despite_failure(self):
+		self.api.fail(3, [502], applied=True)
+		actions.comment(self.issue(3), "Please add the missing information", self.headers)
+
+		self.assertEqual([], actions.flush(self.headers))
+		self.assertEqual([("POST", 502)], self.writes(3))
+		self.assertEqual(1, len([comment for comment in self.api.comments[3] if comment["body"] == "Please add the missing information"]))
+
+	def test_reposts_comment_lost_in_failure(self):
+		self.api.fail(3, [502])
+		actions.comment(self.issue(3), "Please add the missing information", self.headers)
+
+		self.assertEqual([], actions.flush(self.headers))
+		self.assertEqual([("POST", 502), ("POST", 201)], self.writes(3))
+		self.assertEqual(1, len([comment for comment in self.api.comments[3] if comment["body"] == "Please add the missing information"]))
+
+	def test_drops_rejected_actions(self):
+		self.api.fail(3, [422])
+		actions.comment(self.issue(3), "Closing", self.headers)
+		actions.close(self.issue(3), self.headers)
+
+		# the issue isn't closed without its comment, and nothing is left to retry
+		self.assertEqual([], actions.flush(self.headers))
+		self.assertEqual([("POST", 422)], self.writes(3))
+
+	def test_replays_dead_letters(self):
+		self.api.fail(5, [502] * actions.MAX_ATTEMPTS)
+		self.label(5, "bug")
+		actions.close(self.issue(5), self.headers)
+		self.label(6, "bug")
+
+		dead_letters = self.path("failed.json")
+		failed = actions.flush(self.headers, dead_letters=dead_letters)
+		self.assertEqual([actions.LABELS, actions.CLOSE], [action["type"] for action in failed])
+		self.assertEqual([("PATCH", 200)], self.writes(6))
+		self.assertTrue(os.path.isfile(dead_letters))
+
+		# labels changed meanwhile are kept
+		self.api.issues[4]["labels"].append({"name": "request"})
+		self.api.writes = []
+		actions.replay(dead_letters, self.headers)
+
+		self.assertEqual([("PATCH", 200), ("PATCH", 200)], self.writes(5))
+		self.assertEqual(["incomplete_issue", "request", "bug"], self.api.writes[0]["body"]["labels"])
+		self.assertEqual("closed", self.api.writes[1]["body"]["state"])
+		self.assertFalse(os.path.exists(dead_letters))
+
+	def test_run_replays_what_failed_during_the_last_one(self):
+		api = ScenarioApi(100)
+		api.fail(94, [502] * actions.MAX_ATTEMPTS)
+		config_file = self.write_config("approve", api)
+
+		output, code = self.run_bot(approve, api, config_file)
+		self.assertIsNone(code)
+		self.assertNotIn(94, api.written())
+		self.assertTrue(os.path.isfile(config_file + ".failed.json"))
+
+		api.writes = []
+		output, code = self.run_bot(approve, api, config_file)
+		self.assertIsNone(code)
+		self.assertIn("Replaying 2 failed action(s)", output)
+		self.assertEqual([94], api.written("POST"))
+		self.assertEqual([94], api.written("PATCH"))
+		self.assertFalse(os.path.exists(config_file + ".failed.json"))
+
+
+if __name__ == "__main__":
+	unittest.main()
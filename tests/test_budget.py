@@ -0,0 +1,75 @@
+# coding=utf-8
+from __future__ import print_function, absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
+
+import datetime
+import unittest
+
+import dateutil.parser, dateutil.tz
+
+from scenario import ScenarioApi, ScenarioTestCase
+from gitissuebot import approve, autolabel, budget
+
+
+class BudgetTest(ScenarioTestCase):
+
+	def tearDown(self):
+		budget.enable()
+		ScenarioTestCase.tearDown(self)
+
+	def test_rewinds_since_to_deferred_entries(self):
+		now = datetime.datetime.utcnow().replace(tzinfo=dateutil.tz.tzutc())
+		entries = [dict(number=number, updated=now - datetime.timedelta(days=number)) for number in range(1, 6)]
+
+		budget.enable(max_requests=1)
+		processed = []
+		for entry in budget.within_budget(entries, deferral=lambda x: ("issue", str(x["number"]), x["updated"])):
+			processed.append(entry["number"])
+			budget.count_request()
+
+		self.assertEqual([1], processed)
+		self.assertTrue(budget.deferred())
+		self.assertEqual(entries[-1]["updated"], budget.deferred_since(now))
+
+	def test_next_run_picks_up_deferred_issues(self):
+		api = ScenarioApi(100)
+		config_file = self.write_config("autolabel", api)
+		since = self.read_config(config_file)["since"]
+		listed = [issue for issue in api.issues if not "pull_request" in issue and dateutil.parser.parse(issue["updated_at"]) >= since]
+
+		# the listing alone exhausts the budget
+		output, code = self.run_bot(autolabel, api, config_file, "--max-requests", "1")
+		self.assertIsNone(code)
+		self.assertIn("deferred %d entries to the next run" % len(listed), output)
+		self.assertEqual([], api.written())
+		self.assertEqual(min(dateutil.parser.parse(issue["updated_at"]) for issue in listed), self.read_config(config_file)["since"])
+
+		output, code = self.run_bot(autolabel, api, config_file)
+		self.assertIsNone(code)
+		self.assertEqual([issue["number"] for issue in listed if issue["title"].startswith("[Request]")], api.written())
+
+	def test_deferred_issues_dont_rewind_before_since(self):
+		reference = ScenarioApi(100)
+		self.run_bot(approve, reference, self.write_config("approve", reference, name="reference.yaml"))
+
+		api = ScenarioApi(100)
+		config_file = self.write_config("approve", api)
+		since = self.read_config(config_file)["since"]
+
+		output, code = self.run_bot(approve, api, config_file, "--max-requests", "3")
+		self.assertIsNone(code)
+		self.assertIn("re-validation: #85", output)
+		self.assertEqual(since, self.read_config(config_file)["since"])
+
+		# #85 was only listed because there was no deadline index yet, it must not get lost
+		output, code = self.run_bot(approve, api, config_file)
+		self.assertIsNone(code)
+		self.assertIn("Processing \"Something is broken #85\"", output)
+		self.assertEqual(reference.written(), api.written())
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,75 @@
+# coding=utf-8
+from __future__ import print_function, absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
+
+import datetime
+import json
+import os
+import unittest
+
+import dateutil.parser
+
+from scenario import ScenarioApi, ScenarioTestCase, REPO
+from gitissuebot import actions, approve
+from gitissuebot.checkpoint import Checkpoint
+from gitissuebot.util import auth_headers
+
+
+class CheckpointTest(ScenarioTestCase):
+
+	def test_resumes_issues_whose_writes_failed(self):
+		api = ScenarioApi(100)
+		api.fail(94, [502] * actions.MAX_ATTEMPTS)
+		config_file = self.write_config("approve", api, checkpoint=self.path("checkpoint.json"))
+		since = self.read_config(config_file)["since"]
+
+		output, code = self.run_bot(approve, api, config_file, "--dead-letters", "")
+		self.assertIsNone(code)
+		self.assertIn("the next run will resume from the checkpoint", output)
+		self.assertEqual(since, self.read_config(config_file)["since"])
+
+		with open(self.path("checkpoint.json"), "r") as f:
+			state = json.load(f)
+		self.assertNotIn(api.issues[93]["id"], state["processed"])
+		self.assertIn(api.issues[96]["id"], state["processed"])
+
+		# the next run only retries the issue that failed and then moves on to where the first attempt started
+		api.writes = []
+		output, code = self.run_bot(approve, api, config_file, "--dead-letters", "")
+		self.assertIsNone(code)
+		self.assertIn("Resuming run", output)
+		self.assertEqual([94], api.written())
+		self.assertFalse(os.path.exists(self.path("checkpoint.json")))
+		self.assertEqual(dateutil.parser.parse(state["started"]), self.read_config(config_file)["since"])
+
+	def test_completes_listing_marked_after_iterating(self):
+		api = ScenarioApi(50)
+		self.serve(api)
+		checkpoint = Checkpoint(self.path("checkpoint.json"), api.now)
+		url = "https://api.github.com/repos/{repo}/issues?state=open&per_page=100".format(repo=REPO)
+
+		entries = list(checkpoint.iterate("all", auth_headers("benchmark", repo=REPO), url))
+		self.assertEqual(50, len(entries))
+		self.assertFalse(checkpoint.complete)
+
+		# like a batch of writes going through once the listing was exhausted
+		for entry in entries:
+			checkpoint.mark_processed(entry["id"])
+		self.assertTrue(checkpoint.complete)
+
+	def test_starts_over_for_different_since(self):
+		api = ScenarioApi(10)
+		self.serve(api)
+		checkpoint = Checkpoint(self.path("checkpoint.json"), api.now)
+		checkpoint.mark_processed(1)
+		checkpoint.save()
+
+		self.assertTrue(Checkpoint(self.path("checkpoint.json"), api.now).is_processed(1))
+		self.assertFalse(Checkpoint(self.path("checkpoint.json"), api.now - datetime.timedelta(days=1)).is_processed(1))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,97 @@
+# coding=utf-8
+from __future__ import print_function, absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
+
+import contextlib
+import os
+import sqlite3
+import time
+import unittest
+
+from scenario import ScenarioApi, ScenarioTestCase, REPO
+from gitissuebot import actions, approve, leases
+from gitissuebot.leases import Lease, LeaseLost
+
+
+NAME = "approve:{repo}".format(repo=REPO)
+
+
+class LeaseTest(ScenarioTestCase):
+
+	def setUp(self):
+		ScenarioTestCase.setUp(self)
+		self.db = self.path("leases.db")
+
+	def tearDown(self):
+		leases.release()
+		ScenarioTestCase.tearDown(self)
+
+	def lapse(self, name):
+		# the holder hung and stopped renewing its lease
+		with contextlib.closing(sqlite3.connect(self.db)) as connection:
+			connection.execute("update leases set expires = ? where name = ?", [time.time() - 1, name])
+			connection.commit()
+
+	def test_fences_off_previous_holder(self):
+		a = Lease(self.db, NAME, "a")
+		b = Lease(self.db, NAME, "b")
+		self.assertTrue(a.try_acquire())
+		self.assertFalse(b.try_acquire())
+
+		self.lapse(NAME)
+		self.assertTrue(b.try_acquire())
+		self.assertEqual(a.generation + 1, b.generation)
+		self.assertEqual(1, b.metrics()["failovers"])
+
+		# the previous holder can neither renew nor release the lease anymore once it wakes up again
+		self.assertRaises(LeaseLost, a.renew)
+		self.assertFalse(a.release())
+		self.assertEqual("b", b.state()["holder"])
+		self.assertIsNone(b.state()["released"])
+
+		self.assertTrue(b.release())
+		self.assertTrue(a.try_acquire())
+		self.assertEqual(2, a.metrics()["handovers"])
+
+	def test_acquires_all_leases_or_none(self):
+		self.assertTrue(Lease(self.db, "prcheck:" + REPO, "b").try_acquire())
+
+		self.assertFalse(leases.acquire(self.db, [NAME, "prcheck:" + REPO], holder="a"))
+		self.assertIsNone(Lease(self.db, NAME, "a").state())
+
+		self.assertTrue(leases.acquire(self.db, [NAME, "autolabel:" + REPO], holder="a"))
+		leases.check()
+
+	def test_run_aborts_when_lease_is_lost(self):
+		def take_over(method, number, body):
+			if leases._leases and not leases._leases[0].lost:
+				self.lapse(NAME)
+				Lease(self.db, NAME, "b").try_acquire()
+
+				# what the renewal thread does once it notices
+				lease = leases._leases[0]
+				try:
+					lease.renew()
+				except LeaseLost:
+					lease.lost = True
+
+		api = ScenarioApi(100, on_write=take_over)
+		config_file = self.write_config("approve", api)
+		since = self.read_config(config_file)["since"]
+
+		output, code = self.run_bot(approve, api, config_file, "--lease-db", self.db, "--lease-holder", "a")
+		self.assertEqual(-1, code)
+		self.assertIn("Lost lease {name}, another instance might be active, aborting the run".format(name=NAME), output)
+
+		# only the writes already in flight went through, nothing is left for the next run to replay
+		self.assertLessEqual(len(api.writes), actions.WRITE_WORKERS)
+		self.assertFalse(os.path.exists(config_file + ".failed.json"))
+		self.assertEqual(since, self.read_config(config_file)["since"])
+		self.assertEqual("b", Lease(self.db, NAME, "b").state()["holder"])
+
+
+if __name__ == "__main__":
+	unittest.main()
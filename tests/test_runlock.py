@@ -0,0 +1,85 @@
+# coding=utf-8
+from __future__ import print_function, absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
+
+import os
+import unittest
+import urlparse
+
+import dateutil.parser
+
+from scenario import ScenarioApi, ScenarioTestCase
+from gitissuebot import autolabel, runlock
+from gitissuebot.runlock import RunLock
+
+
+class RunLockTest(ScenarioTestCase):
+
+	def setUp(self):
+		ScenarioTestCase.setUp(self)
+		self.lock = self.path("bot.lock")
+
+	def tearDown(self):
+		runlock.release()
+		ScenarioTestCase.tearDown(self)
+
+	def test_excludes_overlapping_runs(self):
+		self.assertTrue(runlock.acquire(self.lock))
+		self.assertFalse(RunLock(self.lock).try_acquire())
+
+		self.assertFalse(runlock.acquire(self.lock))
+		self.assertFalse(os.path.exists(self.lock + ".pending"))
+
+		self.assertFalse(runlock.follow_up())
+		self.assertTrue(RunLock(self.lock).try_acquire())
+
+	def test_coalesces_overlapping_runs_into_one_follow_up(self):
+		self.assertTrue(runlock.acquire(self.lock))
+
+		# any number of runs started meanwhile only cause one more pass
+		self.assertFalse(runlock.acquire(self.lock, coalesce=True))
+		self.assertFalse(runlock.acquire(self.lock, coalesce=True))
+		self.assertTrue(os.path.exists(self.lock + ".pending"))
+
+		self.assertTrue(runlock.follow_up())
+		self.assertFalse(RunLock(self.lock).try_acquire())
+		self.assertFalse(runlock.follow_up())
+		self.assertTrue(RunLock(self.lock).try_acquire())
+
+	def test_acquires_all_locks_or_none(self):
+		other = RunLock(self.path("other.lock"))
+		self.assertTrue(other.try_acquire())
+
+		self.assertFalse(runlock.acquire([self.lock, self.path("other.lock")]))
+		self.assertTrue(RunLock(self.lock).try_acquire())
+
+	def test_run_does_follow_up_pass_from_where_it_left_off(self):
+		requested = []
+		def start_another_run(method, number, body):
+			# the writes run in parallel, so another run might be started more than once - it's still one follow-up
+			if not requested:
+				requested.append(runlock.acquire(self.lock, coalesce=True))
+
+		api = ScenarioApi(100, on_write=start_another_run)
+		config_file = self.write_config("autolabel", api, lock=self.lock)
+		since = self.read_config(config_file)["since"]
+
+		output, code = self.run_bot(autolabel, api, config_file, "--coalesce")
+		self.assertIsNone(code)
+		self.assertTrue(requested)
+		self.assertFalse(any(requested))
+		self.assertEqual(1, output.count("doing a follow-up pass"))
+
+		listings = [dateutil.parser.parse(urlparse.parse_qs(urlparse.urlparse(url).query)["since"][0]) for method, url in api.urls if "/issues?" in url]
+		self.assertEqual(2, len(listings))
+		self.assertEqual(since, listings[0])
+		self.assertGreater(listings[1], since)
+		self.assertGreater(self.read_config(config_file)["since"], listings[1])
+		self.assertFalse(os.path.exists(self.lock + ".pending"))
+
+
+if __name__ == "__main__":
+	unittest.main()
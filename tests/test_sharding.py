@@ -0,0 +1,96 @@
+# coding=utf-8
+from __future__ import print_function, absolute_import
+
+__author__ = "Gina Häußge <osd@foosel.net>"
+__license__ = "GNU Affero General Public License http://www.gnu.org/licenses/agpl.html"
+__copyright__ = "Copyright (C) 2014 Gina Häußge - Released under terms of the AGPLv3 License"
+
+import json
+import os
+import time
+import unittest
+
+from scenario import ScenarioApi, ScenarioTestCase
+from gitissuebot import approve, sharding
+from gitissuebot.sharding import HashRing, Membership
+
+
+KEYS = ["repo#{}".format(key) for key in range(1000)]
+
+
+class HashRingTest(unittest.TestCase):
+
+	def owners(self, members):
+		ring = HashRing(members)
+		return dict((key, ring.owner(key)) for key in KEYS)
+
+	def test_spreads_keys_over_all_members(self):
+		owners = self.owners(["a", "b", "c"])
+		self.assertEqual(owners, self.owners(["c", "a", "b"]))
+		for member in ("a", "b", "c"):
+			self.assertGreater(owners.values().count(member), len(KEYS) // 5)
+
+	def test_joining_member_only_takes_keys(self):
+		before = self.owners(["a", "b", "c"])
+		after = self.owners(["a", "b", "c", "d"])
+
+		moved = [key for key in KEYS if before[key] != after[key]]
+		self.assertTrue(moved)
+		self.assertEqual(set(["d"]), set(after[key] for key in moved))
+
+	def test_leaving_member_only_hands_over_its_keys(self):
+		before = self.owners(["a", "b", "c"])
+		after = self.owners(["a", "c"])
+
+		moved = [key for key in KEYS if before[key] != after[key]]
+		self.assertEqual(set(["b"]), set(before[key] for key in moved))
+		self.assertEqual([key for key in KEYS if before[key] == "b"], moved)
+
+
+class ShardingTest(ScenarioTestCase):
+
+	def test_membership(self):
+		directory = self.path("shards")
+		a = Membership(directory, "a", timeout=60)
+		b = Membership(directory, "b", timeout=60)
+		a.join()
+		b.join()
+		self.assertEqual(["a", "b"], a.members())
+
+		# b stopped renewing its membership without leaving
+		with open(b._path("b"), "w") as f:
+			json.dump(dict(worker="b", renewed=time.time() - 61), f)
+		self.assertEqual(["a"], a.members())
+
+		a.leave()
+		self.assertFalse(os.path.exists(a._path("a")))
+		self.assertEqual(["b"], b.members())
+
+	def test_workers_split_the_work(self):
+		reference = ScenarioApi(100)
+		self.run_bot(approve, reference, self.write_config("approve", reference, name="reference.yaml"))
+
+		directory = self.path("shards")
+		written = dict()
+		for worker, other in (("a", "b"), ("b", "a")):
+			# the other worker is running as well
+			Membership(directory, other).join()
+
+			api = ScenarioApi(100)
+			config_file = self.write_config("approve", api, name="{}.yaml".format(worker))
+			output, code = self.run_bot(approve, api, config_file, "--shard-dir", directory, "--shard-worker", worker, "--shard-range", "1")
+			self.assertIsNone(code)
+			self.assertIn("Worker {} is one of 2 worker(s)".format(worker), output)
+			written[worker] = set(api.written())
+
+			# and left again once it was done
+			self.assertFalse(os.path.exists(Membership(directory, worker)._path(worker)))
+			self.assertIsNone(sharding.active())
+
+		self.assertTrue(written["a"] and written["b"])
+		self.assertFalse(written["a"] & written["b"])
+		self.assertEqual(reference.written(), sorted(written["a"] | written["b"]))
+
+
+if __name__ == "__main__":
+	unittest.main()